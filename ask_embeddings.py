@@ -3,14 +3,29 @@ from random import shuffle
 import os
 import glob
 import json
-import copy
 import random
 import hashlib
-from time import sleep
+import math
+import mmap
+import multiprocessing
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from time import monotonic, sleep, time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where compiling the same libraries from several processes at
+    # once isn't supported.
+    fcntl = None
 
 import numpy as np
-import openai
-from transformers import GPT2TokenizerFast
+
+# openai and transformers take seconds and hundreds of MB to import, and serving
+# queries needs neither, so they're only imported by the functions that use them.
 
 EMBEDDINGS_MODEL_ID = "openai.com:text-embedding-ada-002"
 COMPLETION_MODEL_NAME = "text-davinci-003"
@@ -19,10 +34,106 @@ EXPECTED_EMBEDDING_LENGTH = {
     'openai.com:text-embedding-ada-002': 1536
 }
 
+# The most tokens each embedding model accepts in a single text.
+MAX_EMBEDDING_INPUT_TOKENS = {
+    'openai.com:text-embedding-ada-002': 8191
+}
+
+# Embeddings fetched from the API are cached in this file, so that text is
+# never embedded twice, and once it holds more than EMBEDDING_CACHE_MAX_BYTES of
+# embeddings the least recently used are evicted. By default it is shared by
+# every library converted in this directory.
+EMBEDDING_CACHE_FILE = os.getenv('EMBEDDING_CACHE_FILE', 'cache/embeddings.sqlite')
+EMBEDDING_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# Settings for EmbeddingClient. Each request packs up to EMBEDDING_BATCH_SIZE
+# texts of up to EMBEDDING_BATCH_TOKENS tokens in total, and up to
+# EMBEDDING_CONCURRENCY requests are in flight at once. Failed requests are
+# retried after EMBEDDING_RETRY_BASE_SECONDS, doubling with each attempt up to
+# EMBEDDING_RETRY_MAX_SECONDS, and EMBEDDING_RATE_LIMIT_BACKOFF_FACTOR times
+# longer after rate limit errors.
+EMBEDDING_BATCH_SIZE = 100
+EMBEDDING_BATCH_TOKENS = 100000
+EMBEDDING_CONCURRENCY = 4
+EMBEDDING_MAX_RETRIES = 8
+EMBEDDING_RETRY_BASE_SECONDS = 1
+EMBEDDING_RETRY_MAX_SECONDS = 60
+EMBEDDING_RATE_LIMIT_BACKOFF_FACTOR = 4
+
 SEPARATOR = "\n"
 MAX_CONTEXT_LEN_IN_TOKENS = 2048
 
+# A deliberately low guess of a chunk's token_count, used by Library.query to
+# decide how many candidates to select before filling a token budget. If the
+# guess was too high, the candidate set is widened and selection repeated.
+QUERY_CANDIDATE_TOKEN_ESTIMATE = 100
+
+# Settings for the InvertedFileIndex used by queries with search='approximate'.
+APPROXIMATE_INDEX_ITERATIONS = 10
+APPROXIMATE_INDEX_SAMPLE_SIZE = 50000
+APPROXIMATE_INDEX_MIN_NPROBE = 8
+
+# Libraries can keep a quantized copy of their embeddings for queries to score
+# candidates against. The top QUANTIZED_RERANK_FACTOR times as many candidates
+# as are needed are then re-ranked with the full precision embeddings.
+LEGAL_QUANTIZATIONS = set(['float16', 'int8'])
+QUANTIZED_RERANK_FACTOR = 4
+# Quantized scores can be off from the exact ones by up to about this much, so
+# a query's min_similarity first keeps the candidates whose quantized score is
+# within this much of it, and is then applied to their exact scores.
+QUANTIZED_SIMILARITY_SLACK = {'float16': 0.001, 'int8': 0.01}
+QUANTIZATION_BLOCK_SIZE = 16384
+
+# The access_tag partitions of a library are scored a contiguous run of rows
+# at a time as long as their runs average at least this many rows. Otherwise
+# their rows are copied out of the embedding matrix to score them.
+ACCESS_PARTITION_MIN_RUN_LENGTH = 64
+
+# How many queries of a batch are scored together by Library.query_batch(). Each
+# adds a column to the matrix of scores, so this bounds its size.
+QUERY_BATCH_SIZE = 64
+
+# How many base64 encoded embeddings each Library keeps for serializing.
+EMBEDDING_BASE64_CACHE_SIZE = 4096
+
+# The defaults for QueryResultCache: the most bytes of responses it holds, and
+# the most seconds it keeps each one.
+QUERY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+QUERY_CACHE_MAX_AGE = 60 * 60
+
 LIBRARY_DIR = 'libraries'
+
+# Libraries may also be stored in a binary format, described in format.md: a
+# compact metadata file with this extension, next to a memory-mappable .npy
+# file with the same name plus BINARY_EMBEDDINGS_EXTENSION.
+BINARY_LIBRARY_EXTENSION = '.polymath'
+BINARY_EMBEDDINGS_EXTENSION = '.npy'
+BINARY_EMBEDDINGS_DTYPE = np.dtype('<f4')
+# The chunk fields stored as columns in binary metadata files. Embeddings are
+# stored separately.
+BINARY_COLUMNS = ['text', 'token_count', 'info', 'similarity', 'access_tag']
+
+# The host compiles all of the libraries it serves into this binary library,
+# and loads it directly on startup as long as the manifest next to it shows
+# that none of the source library files have changed.
+COMPILED_LIBRARY_FILE = 'compiled/library' + BINARY_LIBRARY_EXTENSION
+COMPILED_MANIFEST_EXTENSION = '.manifest.json'
+COMPILED_INDEX_EXTENSION = '.ivf.npz'
+COMPILED_LOCK_EXTENSION = '.lock'
+# Libraries in these directories are in .gcloudignore, so they're only served
+# in development. They're left out of the compiled library, so that it was
+# compiled from the same files that are deployed with it, and merged into it
+# after it is loaded.
+UNDEPLOYED_LIBRARY_DIRS = [os.path.join(LIBRARY_DIR, 'third_party')]
+
+# How many processes load_multiple_libraries() parses JSON library files in. None
+# means one per core.
+LIBRARY_LOAD_PROCESSES = None
+
+# How often, in seconds, a LibraryWatcher checks whether its library files have
+# changed.
+LIBRARY_RELOAD_INTERVAL = 10
+
 SAMPLE_LIBRARIES_FILE = 'sample-content.json'
 
 CURRENT_VERSION = 0
@@ -31,47 +142,104 @@ DEFAULT_PRIVATE_ACCESS_TAG = 'unpublished'
 
 DEFAULT_CONFIG_FILE = 'host.SECRET.json'
 
-def permitted_access(access_token):
+class AccessControl:
     """
-    Returns the set of permitted access tags, whether to include restricted_count in the result,
-    and a message to return in the library if any results were filtered.
+    Resolves access_tokens to the access_tags they grant, as configured in a
+    host config file like host.SECRET.json (see README.md).
+
+    The file is parsed once into a dict keyed by a hash of each token, and is
+    only parsed again when its inode, mtime or size changes, or when
+    reload() is called.
     """
 
-    # TODO: allow overriding this
-    access_file = DEFAULT_CONFIG_FILE
-    if not os.path.exists(access_file):
-        return set([]), False, ""
+    def __init__(self, filename=DEFAULT_CONFIG_FILE):
+        self.filename = filename
+        # A tuple of (file signature, dict of token hash to access_tags,
+        # include_restricted_count, restricted_message), replaced as a whole
+        # so concurrent requests always see a consistent configuration.
+        self._state = None
 
-    # TODO: don't load this file every time
-    with open(DEFAULT_CONFIG_FILE, 'r') as f:
-        data = json.load(f)
 
-    restricted = data.get('restricted', {})
-    include_restricted_count = restricted.get('count', False)
-    restricted_message = restricted.get('message', "")
+    def _signature(self):
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
 
-    if not access_token:
-        return set([]), include_restricted_count, restricted_message
 
-    if 'tokens' not in data:
-        raise Exception(f'The data in {access_file} did not contain a key of "tokens" as expected')
-    
-    private_access_tag = data['default_private_access_tag'] if 'default_private_access_tag' in data else DEFAULT_PRIVATE_ACCESS_TAG
+    @staticmethod
+    def _token_hash(access_token):
+        return hashlib.sha256(access_token.encode()).hexdigest()
 
-    token_record = None
-    for record in data['tokens'].values():
-        if 'token' not in record:
-            continue
-        if record['token'] == access_token:
-            token_record = record
-            break
-    
-    if not token_record:
-        return set([]), include_restricted_count, restricted_message
 
-    tags = token_record['access_tags'] if 'access_tags' in token_record else [private_access_tag]
+    def reload(self):
+        """
+        Parses the config file again, whether or not it appears to have changed.
+        """
+        signature = self._signature()
+        if signature is None:
+            self._state = (None, None, False, "")
+            return
+        with open(self.filename, 'r') as f:
+            data = json.load(f)
+
+        restricted = data.get('restricted', {})
+        include_restricted_count = restricted.get('count', False)
+        restricted_message = restricted.get('message', "")
+
+        tokens = None
+        if 'tokens' in data:
+            private_access_tag = data['default_private_access_tag'] if 'default_private_access_tag' in data else DEFAULT_PRIVATE_ACCESS_TAG
+            tokens = {}
+            for record in data['tokens'].values():
+                if 'token' not in record:
+                    continue
+                tags = record['access_tags'] if 'access_tags' in record else [private_access_tag]
+                token_hash = self._token_hash(record['token'])
+                # The first record with a token wins, as it always has.
+                if token_hash not in tokens:
+                    tokens[token_hash] = frozenset(tags)
+
+        self._state = (signature, tokens, include_restricted_count, restricted_message)
+
+
+    def permitted_access(self, access_token):
+        """
+        Returns the set of permitted access tags, whether to include restricted_count in the result,
+        and a message to return in the library if any results were filtered.
+        """
+        state = self._state
+        if state is None or state[0] != self._signature():
+            self.reload()
+            state = self._state
+        signature, tokens, include_restricted_count, restricted_message = state
+
+        if signature is None:
+            return frozenset(), False, ""
 
-    return set(tags), include_restricted_count, restricted_message
+        if not access_token:
+            return frozenset(), include_restricted_count, restricted_message
+
+        if tokens is None:
+            raise Exception(f'The data in {self.filename} did not contain a key of "tokens" as expected')
+
+        tags = tokens.get(self._token_hash(access_token))
+        if tags is None:
+            return frozenset(), include_restricted_count, restricted_message
+        return tags, include_restricted_count, restricted_message
+
+
+# TODO: allow overriding the config file
+default_access_control = AccessControl()
+
+
+def permitted_access(access_token):
+    """
+    Returns the set of permitted access tags, whether to include restricted_count in the result,
+    and a message to return in the library if any results were filtered.
+    """
+    return default_access_control.permitted_access(access_token)
 
 
 def canonical_id_for_chunk(chunk):
@@ -125,22 +293,287 @@ def get_embedding_model_name_from_id(model_id):
 
 
 def get_embedding(text, model_id=EMBEDDINGS_MODEL_ID):
-    # Occasionally, API returns an error.
-    # Retry a few times before giving up.
-    retry_count = 10
-    while retry_count > 0:
+    return get_embeddings([text], model_id)[0]
+
+
+def get_embeddings(texts, model_id=EMBEDDINGS_MODEL_ID, token_counts=None):
+    return EmbeddingClient(model_id, cache=default_embedding_cache()).get_embeddings(texts, token_counts)
+
+
+class EmbeddingCache:
+    """
+    A persistent cache of embeddings, keyed by the embedding model and a hash
+    of the text, so that text that was embedded before, for any library, is
+    never sent to the API again. It's an SQLite database, so several
+    processes can share it. Once it holds more than max_bytes of embeddings,
+    the least recently used are evicted.
+    """
+
+    def __init__(self, filename=EMBEDDING_CACHE_FILE, max_bytes=EMBEDDING_CACHE_MAX_BYTES):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(filename, timeout=60, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL, last_used REAL NOT NULL)')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)')
+
+
+    @staticmethod
+    def key(text, model_id=EMBEDDINGS_MODEL_ID):
+        return hashlib.sha256((model_id + '\n' + text).encode('utf-8')).hexdigest()
+
+
+    def get_embeddings(self, texts, model_id=EMBEDDINGS_MODEL_ID):
+        """
+        Returns the cached embedding of each of texts, or None for the ones
+        that aren't cached.
+        """
+        keys = [EmbeddingCache.key(text, model_id) for text in texts]
+        found = {}
+        with self._lock:
+            # Stay well under SQLite's limit on the number of parameters.
+            for start in range(0, len(keys), 500):
+                block = keys[start:start + 500]
+                placeholders = ','.join('?' * len(block))
+                rows = self._connection.execute(
+                    f'SELECT key, embedding FROM embeddings WHERE key IN ({placeholders})', block).fetchall()
+                found.update(rows)
+                self._connection.execute(
+                    f'UPDATE embeddings SET last_used = ? WHERE key IN ({placeholders})', [time()] + block)
+        return [np.frombuffer(found[key], dtype=BINARY_EMBEDDINGS_DTYPE) if key in found else None for key in keys]
+
+
+    def put_embeddings(self, texts, embeddings, model_id=EMBEDDINGS_MODEL_ID):
+        now = time()
+        rows = [(EmbeddingCache.key(text, model_id), np.asarray(embedding, dtype=BINARY_EMBEDDINGS_DTYPE).tobytes(), now)
+                for text, embedding in zip(texts, embeddings)]
+        with self._lock:
+            self._connection.execute('BEGIN')
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO embeddings (key, embedding, last_used) VALUES (?, ?, ?)', rows)
+            self._connection.execute('COMMIT')
+            self._evict()
+
+
+    def _evict(self):
+        count, total_bytes = self._connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(LENGTH(embedding)), 0) FROM embeddings').fetchone()
+        if total_bytes <= self.max_bytes:
+            return
+        # Evict down to 90% of max_bytes, so that every put doesn't evict.
+        evicted_count = math.ceil((total_bytes - self.max_bytes * 0.9) / (total_bytes / count))
+        self._connection.execute(
+            'DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)', (evicted_count,))
+
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+
+
+_default_embedding_cache = None
+_default_embedding_cache_opened = False
+
+
+def default_embedding_cache():
+    """
+    Returns the EmbeddingCache at EMBEDDING_CACHE_FILE, shared by everything
+    in the process, or None if it can't be opened.
+    """
+    global _default_embedding_cache, _default_embedding_cache_opened
+    if not _default_embedding_cache_opened:
+        _default_embedding_cache_opened = True
         try:
-            result = openai.Embedding.create(
-                model=get_embedding_model_name_from_id(model_id),
-                input=text
-            )
-            break
-        except Exception as e:
-            print(f'openai.Embedding.create error: {e}')
-            print("Retrying in 20 seconds ...")
-            sleep(20)
-            retry_count -= 1
-    return result["data"][0]["embedding"]
+            _default_embedding_cache = EmbeddingCache()
+        except (OSError, sqlite3.Error) as e:
+            print(f'Could not open the embedding cache at {EMBEDDING_CACHE_FILE}: {e}')
+    return _default_embedding_cache
+
+
+class EmbeddingClient:
+    """
+    Fetches embeddings from the OpenAI API. Texts are packed into requests of
+    up to batch_size texts and batch_tokens tokens, and up to concurrency
+    requests are in flight at once.
+
+    Failed requests are retried with exponential backoff and jitter. Errors
+    that retrying can't fix, like an invalid request or an exhausted quota,
+    are raised right away. A rate limit error pauses every request, not
+    just the one that hit it.
+    """
+
+    def __init__(self, model_id=EMBEDDINGS_MODEL_ID, batch_size=EMBEDDING_BATCH_SIZE, batch_tokens=EMBEDDING_BATCH_TOKENS,
+                 concurrency=EMBEDDING_CONCURRENCY, max_retries=EMBEDDING_MAX_RETRIES, cache=None):
+        """
+        If cache, an EmbeddingCache, is provided, texts are looked up in it
+        first, and only the ones it doesn't have are fetched and added to it.
+        """
+        self.model_id = model_id
+        self.cache = cache
+        self.batch_size = batch_size
+        self.batch_tokens = batch_tokens
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self._paused_until = 0
+        # Totals over every call, for report().
+        self.text_count = 0
+        self.cached_count = 0
+        self.token_count = 0
+        self.request_count = 0
+        self.retry_count = 0
+        self.seconds = 0
+
+
+    def get_embeddings(self, texts, token_counts=None):
+        """
+        Returns the embedding of each of texts, in order. token_counts are
+        the token counts of texts, which are counted if not provided.
+        """
+        texts = list(texts)
+        if self.cache is None:
+            return self._fetch_embeddings(texts, token_counts)
+        embeddings = self.cache.get_embeddings(texts, self.model_id)
+        uncached = [index for index, embedding in enumerate(embeddings) if embedding is None]
+        with self._lock:
+            self.cached_count += len(texts) - len(uncached)
+        if not uncached:
+            return embeddings
+        uncached_texts = [texts[index] for index in uncached]
+        fetched = self._fetch_embeddings(
+            uncached_texts, [token_counts[index] for index in uncached] if token_counts else None)
+        self.cache.put_embeddings(uncached_texts, fetched, self.model_id)
+        for index, embedding in zip(uncached, fetched):
+            embeddings[index] = embedding
+        return embeddings
+
+
+    def _fetch_embeddings(self, texts, token_counts=None):
+        if not texts:
+            return []
+        start = monotonic()
+        if len(texts) == 1:
+            # There's nothing to pack, so no need to load the tokenizer.
+            batches = [[0]]
+            token_count = 0
+        else:
+            if token_counts is None:
+                token_counts = get_token_counts(texts)
+            batches = self._batches(token_counts)
+            token_count = sum(token_counts)
+        embeddings = [None] * len(texts)
+        executor = ThreadPoolExecutor(min(self.concurrency, len(batches)))
+        try:
+            futures = [executor.submit(self._request, [texts[index] for index in batch]) for batch in batches]
+            for batch, future in zip(batches, futures):
+                for index, embedding in zip(batch, future.result()):
+                    embeddings[index] = embedding
+        finally:
+            executor.shutdown(cancel_futures=True)
+        with self._lock:
+            self.text_count += len(texts)
+            self.token_count += token_count
+            self.seconds += monotonic() - start
+        return embeddings
+
+
+    def _batches(self, token_counts):
+        """
+        Returns lists of indexes of texts to request together.
+        """
+        max_input_tokens = MAX_EMBEDDING_INPUT_TOKENS.get(self.model_id)
+        batches = []
+        batch = []
+        batch_tokens = 0
+        for index, token_count in enumerate(token_counts):
+            if max_input_tokens and token_count > max_input_tokens:
+                raise Exception(
+                    f'Text {index} has {token_count} tokens, but {self.model_id} accepts at most {max_input_tokens}')
+            if batch and (len(batch) >= self.batch_size or batch_tokens + token_count > self.batch_tokens):
+                batches.append(batch)
+                batch = []
+                batch_tokens = 0
+            batch.append(index)
+            batch_tokens += token_count
+        batches.append(batch)
+        return batches
+
+
+    def _request(self, texts):
+        import openai
+        attempt = 0
+        while True:
+            delay = self._paused_until - monotonic()
+            if delay > 0:
+                sleep(delay)
+            with self._lock:
+                self.request_count += 1
+            try:
+                response = openai.Embedding.create(
+                    model=get_embedding_model_name_from_id(self.model_id),
+                    input=texts
+                )
+                return [item['embedding'] for item in sorted(response['data'], key=lambda item: item['index'])]
+            except openai.error.OpenAIError as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None or attempt >= self.max_retries:
+                    raise
+                print(f'openai.Embedding.create error: {e}')
+                print(f'Retrying in {delay:.1f} seconds ...')
+                with self._lock:
+                    self.retry_count += 1
+                    if isinstance(e, openai.error.RateLimitError):
+                        self._paused_until = max(self._paused_until, monotonic() + delay)
+                sleep(delay)
+                attempt += 1
+
+
+    def _retry_delay(self, error, attempt):
+        """
+        Returns how many seconds to wait before retrying a request that
+        failed with error for the attempt'th time, or None if retrying won't
+        help.
+        """
+        import openai
+        if isinstance(error, (openai.error.InvalidRequestError, openai.error.AuthenticationError,
+                              openai.error.PermissionError)):
+            return None
+        delay = EMBEDDING_RETRY_BASE_SECONDS * 2 ** attempt
+        retry_after = 0
+        if isinstance(error, openai.error.RateLimitError):
+            if error.code == 'insufficient_quota':
+                return None
+            # Rate limits take a while to recover, so start from a longer
+            # delay, and never retry before the API says to.
+            delay *= EMBEDDING_RATE_LIMIT_BACKOFF_FACTOR
+            try:
+                retry_after = float((error.headers or {}).get('retry-after'))
+            except (TypeError, ValueError):
+                pass
+        delay = min(delay, EMBEDDING_RETRY_MAX_SECONDS)
+        # Wait a random half to all of the delay, so that requests that failed
+        # together don't all retry at the same moment.
+        return max(delay / 2 + random.uniform(0, delay / 2), retry_after)
+
+
+    def report(self):
+        """
+        Returns a summary of the throughput so far.
+        """
+        seconds = max(self.seconds, 1e-9)
+        result = (f'Fetched {self.text_count} embeddings ({self.token_count} tokens) in {self.request_count} requests '
+                  f'({self.retry_count} retried) in {self.seconds:.1f}s: '
+                  f'{self.text_count / seconds:.1f} embeddings/s, {self.token_count / seconds:.0f} tokens/s')
+        if self.cache is not None:
+            result += f'. Found {self.cached_count} in the cache'
+        return result
 
 
 def load_data_file(file):
@@ -148,10 +581,407 @@ def load_data_file(file):
         return json.load(f)
 
 
+def is_binary_library_file(filename):
+    return filename.endswith(BINARY_LIBRARY_EXTENSION)
+
+
+def binary_embeddings_filename(filename):
+    return filename + BINARY_EMBEDDINGS_EXTENSION
+
+
+def load_binary_data_file(filename):
+    """
+    Loads a library in the binary format.
+
+    Returns a tuple of (data, embeddings), where data is a library dict whose
+    chunks are missing embeddings, and embeddings is a read-only memory-mapped
+    matrix with one row per chunk in data['content'] order, or None if the
+    library omits embeddings.
+    """
+    metadata = load_data_file(filename)
+    ids = metadata.pop('ids')
+    columns = metadata.pop('columns')
+    content = {}
+    for row, chunk_id in enumerate(ids):
+        chunk = {}
+        for field, values in columns.items():
+            value = values[row]
+            if value is not None:
+                chunk[field] = value
+        content[chunk_id] = chunk
+    metadata['content'] = content
+
+    embeddings_filename = binary_embeddings_filename(filename)
+    if not os.path.exists(embeddings_filename):
+        return metadata, None
+    embeddings = np.load(embeddings_filename, mmap_mode='r')
+    if embeddings.dtype != BINARY_EMBEDDINGS_DTYPE or embeddings.ndim != 2:
+        raise Exception(
+            f'{embeddings_filename} must contain a 2-dimensional array of little-endian float32')
+    if len(embeddings) != len(ids):
+        raise Exception(
+            f'{embeddings_filename} had {len(embeddings)} embeddings but {filename} had {len(ids)} chunks')
+    # A plain ndarray view of the np.memmap, so rows sliced from it are cheap.
+    return metadata, embeddings.view(np.ndarray)
+
+
+def library_filenames_in_directory(directory):
+    """
+    Returns the library files anywhere within directory. If a library is in
+    both the JSON and the binary format, only the binary one is returned.
+    """
+    json_filenames = glob.glob(os.path.join(directory, '**/*.json'), recursive=True)
+    binary_filenames = glob.glob(os.path.join(directory, '**/*' + BINARY_LIBRARY_EXTENSION), recursive=True)
+    binary_bases = set([os.path.splitext(filename)[0] for filename in binary_filenames])
+    json_filenames = [filename for filename in json_filenames if os.path.splitext(filename)[0] not in binary_bases]
+    return sorted(json_filenames + binary_filenames)
+
+
+def _nearest_centroids(matrix, centroids, block_size=8192):
+    """
+    Returns the index of the most similar centroid for each row of matrix.
+    """
+    result = np.empty(len(matrix), dtype=np.int64)
+    for start in range(0, len(matrix), block_size):
+        block = matrix[start:start + block_size]
+        result[start:start + block_size] = np.argmax(block @ centroids.T, axis=1)
+    return result
+
+
+class InvertedFileIndex:
+    """
+    An approximate nearest neighbour index over the rows of an embedding
+    matrix. The rows are clustered with k-means into lists, and a query only
+    scores the rows in the nprobe lists whose centroids are most similar to it.
+    """
+
+    def __init__(self, centroids, rows, offsets):
+        # centroids[i] is the centroid of list i, whose rows are
+        # rows[offsets[i]:offsets[i + 1]].
+        self.centroids = centroids
+        self.rows = rows
+        self.offsets = offsets
+
+
+    @classmethod
+    def build(cls, matrix, list_count=None, iterations=APPROXIMATE_INDEX_ITERATIONS, sample_size=APPROXIMATE_INDEX_SAMPLE_SIZE, seed=0):
+        """
+        Clusters the rows of matrix into list_count lists, by default the
+        square root of the number of rows. The centroids are trained on a
+        random sample of at most sample_size rows.
+        """
+        row_count = len(matrix)
+        if list_count is None:
+            list_count = int(round(np.sqrt(row_count)))
+        list_count = max(1, min(list_count, row_count))
+        rng = np.random.default_rng(seed)
+        sample = matrix
+        if row_count > sample_size:
+            sample = matrix[np.sort(rng.choice(row_count, size=sample_size, replace=False))]
+        centroids = np.array(sample[rng.choice(len(sample), size=list_count, replace=False)], dtype=np.float32)
+        for _ in range(iterations):
+            assignments = _nearest_centroids(sample, centroids)
+            counts = np.bincount(assignments, minlength=list_count)
+            filled = counts > 0
+            order = np.argsort(assignments, kind='stable')
+            starts = (np.cumsum(counts) - counts)[filled]
+            sums = np.add.reduceat(sample[order], starts, axis=0)
+            # Embeddings are compared by dot product, so keep the centroids
+            # on the unit sphere like the embeddings themselves.
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            centroids[filled] = sums / norms
+        assignments = _nearest_centroids(matrix, centroids)
+        rows = np.argsort(assignments, kind='stable')
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=list_count))))
+        return cls(centroids, rows, offsets)
+
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(data['centroids'], data['rows'], data['offsets'])
+
+
+    def save(self, filename):
+        temporary_filename = f'{filename}.{os.getpid()}.tmp'
+        with open(temporary_filename, 'wb') as f:
+            np.savez(f, centroids=self.centroids, rows=self.rows, offsets=self.offsets)
+        os.replace(temporary_filename, filename)
+
+
+    @property
+    def list_count(self):
+        return len(self.centroids)
+
+
+    @property
+    def row_count(self):
+        return len(self.rows)
+
+
+    @property
+    def default_nprobe(self):
+        return min(self.list_count, max(APPROXIMATE_INDEX_MIN_NPROBE, self.list_count // 16))
+
+
+    def candidate_rows(self, query_embedding, nprobe=None):
+        """
+        Returns the rows in the nprobe lists whose centroids are most similar
+        to query_embedding.
+        """
+        if nprobe is None:
+            nprobe = self.default_nprobe
+        nprobe = min(nprobe, self.list_count)
+        scores = self.centroids @ query_embedding
+        lists = np.arange(self.list_count)
+        if nprobe < self.list_count:
+            lists = np.argpartition(-scores, nprobe)[:nprobe]
+        return np.concatenate([self.rows[self.offsets[list_index]:self.offsets[list_index + 1]] for list_index in lists])
+
+
+class QuantizedEmbeddings:
+    """
+    A compressed copy of an embedding matrix for scoring query candidates.
+
+    'float16' halves the size of each embedding. 'int8' quarters it, storing
+    each embedding as int8s plus one float32 scale, so that row i is
+    approximately values[i] * scales[i].
+    """
+
+    def __init__(self, matrix, quantization):
+        self.quantization = quantization
+        self.scales = None
+        if quantization == 'float16':
+            self.values = np.empty(matrix.shape, dtype=np.float16)
+        else:
+            self.values = np.empty(matrix.shape, dtype=np.int8)
+            self.scales = np.empty(len(matrix), dtype=np.float32)
+        for start in range(0, len(matrix), QUANTIZATION_BLOCK_SIZE):
+            block = np.asarray(matrix[start:start + QUANTIZATION_BLOCK_SIZE], dtype=np.float32)
+            end = start + len(block)
+            if self.scales is None:
+                self.values[start:end] = block
+                continue
+            scales = np.abs(block).max(axis=1) / 127
+            scales[scales == 0] = 1
+            self.values[start:end] = np.rint(block / scales[:, None])
+            self.scales[start:end] = scales
+
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+
+    def score(self, query_embedding, rows=None):
+        """
+        Returns the approximate similarity of query_embedding to each of rows,
+        which may be an array or a slice, or to every row if rows is None.
+        query_embedding may also be a matrix with one query per column, in
+        which case so is the result.
+        """
+        if rows is None:
+            rows = slice(0, len(self.values))
+        is_slice = isinstance(rows, slice)
+        count = rows.stop - rows.start if is_slice else len(rows)
+        result = np.empty((count,) + query_embedding.shape[1:], dtype=np.float32)
+        # Widen to float32 a block at a time, so that scoring never holds a
+        # full precision copy of the matrix.
+        for start in range(0, count, QUANTIZATION_BLOCK_SIZE):
+            if is_slice:
+                block_rows = slice(rows.start + start, min(rows.start + start + QUANTIZATION_BLOCK_SIZE, rows.stop))
+            else:
+                block_rows = rows[start:start + QUANTIZATION_BLOCK_SIZE]
+            block = self.values[block_rows].astype(np.float32) @ query_embedding
+            if self.scales is not None:
+                scales = self.scales[block_rows]
+                block *= scales[:, None] if block.ndim > 1 else scales
+            result[start:start + len(block)] = block
+        return result
+
+
+class AccessPartitions:
+    """
+    A library's chunks grouped by their access_tag (None for chunks without
+    one), so that queries only score and budget the chunks a caller may see.
+    """
+
+    def __init__(self, library):
+        content = library._data['content']
+        rows = {}
+        for row, chunk_id in enumerate(library._embedding_ids):
+            rows.setdefault(content[chunk_id].get('access_tag'), []).append(row)
+        # The embedding matrix rows of the chunks with each access_tag, in
+        # order, and the same rows as a list of slices of the matrix, one for
+        # each contiguous run of them, so they can be scored without copying
+        # them and without scoring any other rows. The compiled library puts
+        # each access_tag's rows in one run, and libraries merged from files
+        # usually have a run per file. If the runs are too short to be worth
+        # scoring one at a time, the list is just the array of rows.
+        self.rows = {}
+        self.scored_rows = {}
+        for access_tag, tag_rows in rows.items():
+            tag_rows = np.array(tag_rows, dtype=np.int64)
+            self.rows[access_tag] = tag_rows
+            run_starts = np.flatnonzero(np.diff(tag_rows) != 1) + 1
+            if len(tag_rows) < (len(run_starts) + 1) * ACCESS_PARTITION_MIN_RUN_LENGTH:
+                self.scored_rows[access_tag] = [tag_rows]
+                continue
+            self.scored_rows[access_tag] = [slice(int(run[0]), int(run[-1]) + 1)
+                                            for run in np.split(tag_rows, run_starts)]
+        self.chunk_counts = {}
+        for _, chunk in library.chunks:
+            access_tag = chunk.get('access_tag')
+            self.chunk_counts[access_tag] = self.chunk_counts.get(access_tag, 0) + 1
+        self.row_count = library._embedding_count
+        self._visible_masks = {}
+
+
+    def visible_tags(self, visible_access_tags):
+        """
+        Returns the access_tags of the partitions a caller with
+        visible_access_tags may see, or None if they may see all of them.
+        """
+        tags = [access_tag for access_tag in self.chunk_counts if access_tag is None or access_tag in visible_access_tags]
+        if len(tags) == len(self.chunk_counts):
+            return None
+        return tags
+
+
+    def visible_mask(self, visible_access_tags):
+        """
+        Returns a boolean array of which rows a caller with
+        visible_access_tags may see.
+        """
+        tags = frozenset(self.visible_tags(visible_access_tags) or self.rows.keys())
+        if tags not in self._visible_masks:
+            mask = np.zeros(self.row_count, dtype=bool)
+            for access_tag in tags:
+                if access_tag in self.rows:
+                    mask[self.rows[access_tag]] = True
+            self._visible_masks[tags] = mask
+        return self._visible_masks[tags]
+
+
+    def restricted_count(self, visible_access_tags):
+        """
+        Returns how many chunks a caller with visible_access_tags may not see.
+        """
+        return sum(count for access_tag, count in self.chunk_counts.items() if access_tag is not None and access_tag not in visible_access_tags)
+
+
+class QueryResultCache:
+    """
+    A bounded cache of serialized query responses. Once it holds more than
+    max_bytes of them the least recently used are evicted, and each is
+    evicted max_age seconds after it was added. Counts its hits and misses.
+    """
+
+    def __init__(self, max_bytes=QUERY_CACHE_MAX_BYTES, max_age=QUERY_CACHE_MAX_AGE):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._next_sweep = 0
+
+
+    @staticmethod
+    def key(permitted, **query_arguments):
+        """
+        Returns the cache key of a query: a hash of its arguments and of the
+        result of permitted_access() for its access_token, rather than the
+        token itself, so that tokens granting the same access share entries.
+        Returns None if the query's result isn't deterministic.
+        """
+        if query_arguments.get('sort') == 'random' and not query_arguments.get('seed'):
+            return None
+        visible_access_tags, include_restricted_count, restricted_message = permitted
+        key = [sorted(query_arguments.items()), sorted(visible_access_tags, key=str),
+               include_restricted_count, restricted_message]
+        return hashlib.sha256(json.dumps(key, default=str).encode('utf-8')).hexdigest()
+
+
+    def get(self, key):
+        """
+        Returns the response cached for key, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and monotonic() - entry[0] > self.max_age:
+                self._remove(key)
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+
+    def put(self, key, value):
+        """
+        Caches value, a bytes response, for key.
+        """
+        if len(value) > self.max_bytes:
+            return
+        now = monotonic()
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (now, value)
+            self.nbytes += len(value)
+            while self.nbytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            # Entries that are never asked for again would otherwise only be
+            # evicted once they became the least recently used.
+            if now >= self._next_sweep:
+                expired = [entry_key for entry_key, (added, _) in self._entries.items() if now - added > self.max_age]
+                for entry_key in expired:
+                    self._remove(entry_key)
+                self.evictions += len(expired)
+                self._next_sweep = now + self.max_age
+
+
+    def _remove(self, key):
+        _, value = self._entries.pop(key)
+        self.nbytes -= len(value)
+
+
+    def clear(self):
+        """
+        Removes every entry, e.g. because the library they came from changed.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.nbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
 class Library:
-    def __init__(self, data=None, blob=None, filename=None, access_tag=None):
+    def __init__(self, data=None, blob=None, filename=None, access_tag=None, skip_validation=False):
+        embeddings = None
         if filename:
-            data = load_data_file(filename)
+            if is_binary_library_file(filename):
+                data, embeddings = load_binary_data_file(filename)
+            else:
+                data = load_data_file(filename)
         if blob:
             data = json.loads(blob)
         if data:
@@ -173,16 +1003,23 @@ class Library:
         if access_tag == True:
             access_tag = DEFAULT_PRIVATE_ACCESS_TAG
 
-        for _, chunk in self._data['content'].items():
-            if 'embedding' not in chunk:
-                continue
-            chunk['embedding'] = vector_from_base64(chunk['embedding'])
+        # The library files this library was loaded from, if it was loaded by
+        # load_multiple_libraries(): filename to (library_file_signature(),
+        # the chunk_ids it contributed).
+        self._sources = {}
+
+        self._reset_embeddings()
+        if embeddings is not None:
+            self._adopt_embeddings(list(self.chunk_ids), embeddings)
+        else:
+            self._index_embeddings(self.chunk_ids)
 
         if access_tag:
             for chunk_id in self.chunk_ids:
                 self.set_chunk_field(chunk_id, access_tag=access_tag)
 
-        self.validate()
+        if not skip_validation:
+            self.validate()
 
 
     def validate(self):
@@ -344,12 +1181,40 @@ class Library:
         self._details['message'] = value
 
 
+    @property
+    def import_manifest(self):
+        """
+        Returns what convert.main recorded about each source file this library
+        was imported from, so re-imports can skip the unchanged ones, or {}.
+        """
+        if 'import_manifest' not in self._data:
+            return {}
+        return self._data['import_manifest']
+
+
+    @import_manifest.setter
+    def import_manifest(self, value):
+        self._data['import_manifest'] = value
+
+
     def extend(self, other : 'Library'):
         if other.embedding_model != self.embedding_model:
             raise Exception('The other library had a different embedding model')
         # TODO: handle key collisions; keys are only guaranteed to be unique
         # within a single library.
-        self._data['content'].update(other._data['content'])
+        content = self._data['content']
+        for chunk_id, chunk in other.chunks:
+            if chunk_id in content:
+                # As in set_chunk(), the replaced chunk keeps its own copy of
+                # its embedding, and gives up its row if the new one has none.
+                self._detach_embedding(chunk_id)
+                if 'embedding' not in chunk:
+                    self._unindex_embedding(chunk_id)
+            # Shallow copy so that our embedding matrix owns the views stored
+            # in our chunks without reaching into the other library's chunks.
+            content[chunk_id] = dict(chunk)
+        self._access_partitions = None
+        self._index_embeddings(other._embedding_ids[:other._embedding_count])
 
 
     def reset(self):
@@ -358,6 +1223,148 @@ class Library:
             'embedding_model': EMBEDDINGS_MODEL_ID,
             'content': {}
         }
+        self._reset_embeddings()
+
+
+    def _reset_embeddings(self):
+        # Every embedding lives in one contiguous float32 matrix. Row i holds
+        # the embedding for _embedding_ids[i], and each chunk's 'embedding' is
+        # a view of its row. The matrix may have spare capacity past
+        # _embedding_count so that appending a chunk is amortized O(1).
+        self._embeddings = None
+        self._embedding_count = 0
+        self._embedding_ids = []
+        self._embedding_rows = {}
+        self._approximate_index = None
+        self._quantization = None
+        self._quantized_embeddings = None
+        self._access_partitions = None
+        self._base64_embeddings = OrderedDict()
+        self._base64_embeddings_lock = threading.Lock()
+
+
+    def _reserve_embedding_rows(self, row_count, dimensions):
+        matrix = self._embeddings
+        if matrix is not None:
+            if matrix.shape[1] != dimensions:
+                raise Exception(
+                    f'Embedding had the wrong length, expected {matrix.shape[1]}')
+            if len(matrix) >= row_count and matrix.flags.writeable:
+                return
+        capacity = row_count
+        if matrix is not None:
+            # Only grow geometrically when more rows are needed. A read-only
+            # matrix that already has room is copied at the same size, so
+            # that repeatedly freezing and modifying a library doesn't keep
+            # doubling it.
+            capacity = max(row_count, 2 * len(matrix) if row_count > len(matrix) else len(matrix))
+        new_matrix = np.empty((capacity, dimensions), dtype=np.float32)
+        if matrix is not None:
+            new_matrix[:self._embedding_count] = matrix[:self._embedding_count]
+        self._embeddings = new_matrix
+        content = self._data['content']
+        for row, chunk_id in enumerate(self._embedding_ids):
+            content[chunk_id]['embedding'] = new_matrix[row]
+
+
+    def _index_embeddings(self, chunk_ids):
+        """
+        Copies the embeddings of the given chunks into the embedding matrix,
+        decoding them from base64 first if necessary.
+        """
+        content = self._data['content']
+        vectors = []
+        for chunk_id in chunk_ids:
+            chunk = content[chunk_id]
+            if 'embedding' not in chunk:
+                continue
+            vector = chunk['embedding']
+            if isinstance(vector, str):
+                vector = vector_from_base64(vector)
+            vectors.append((chunk_id, vector))
+        if not vectors:
+            return
+        self._approximate_index = None
+        self._quantized_embeddings = None
+        self._access_partitions = None
+        new_row_count = sum(
+            1 for chunk_id, _ in vectors if chunk_id not in self._embedding_rows)
+        self._reserve_embedding_rows(
+            self._embedding_count + new_row_count, len(vectors[0][1]))
+        matrix = self._embeddings
+        for chunk_id, vector in vectors:
+            if len(vector) != matrix.shape[1]:
+                raise Exception(
+                    f'{chunk_id} had the wrong length of embedding, expected {matrix.shape[1]}')
+            self._base64_embeddings.pop(chunk_id, None)
+            row = self._embedding_rows.get(chunk_id)
+            if row is None:
+                row = self._embedding_count
+                self._embedding_ids.append(chunk_id)
+                self._embedding_rows[chunk_id] = row
+                self._embedding_count += 1
+            matrix[row] = vector
+            content[chunk_id]['embedding'] = matrix[row]
+
+
+    def _adopt_embeddings(self, chunk_ids, matrix):
+        """
+        Uses matrix, e.g. one memory-mapped from disk, as the embedding
+        matrix without copying it. Row i is the embedding of chunk_ids[i].
+        If the matrix is read-only it is copied on the first modification.
+        """
+        self._embeddings = matrix
+        self._embedding_ids = chunk_ids
+        self._embedding_rows = {chunk_id: row for row, chunk_id in enumerate(chunk_ids)}
+        self._embedding_count = len(chunk_ids)
+        self._base64_embeddings.clear()
+        self._approximate_index = None
+        self._quantized_embeddings = None
+        self._access_partitions = None
+        content = self._data['content']
+        for chunk_id, vector in zip(chunk_ids, matrix):
+            content[chunk_id]['embedding'] = vector
+
+
+    def freeze_embeddings(self):
+        """
+        Marks the embedding matrix read-only. Processes forked afterwards,
+        like preloaded gunicorn workers, then share its memory instead of
+        each holding a copy. Modifying the library afterwards copies it.
+        """
+        if self._embeddings is not None:
+            self._embeddings.setflags(write=False)
+
+
+    def _unindex_embedding(self, chunk_id):
+        row = self._embedding_rows.pop(chunk_id, None)
+        if row is None:
+            return
+        self._base64_embeddings.pop(chunk_id, None)
+        self._approximate_index = None
+        self._quantized_embeddings = None
+        self._access_partitions = None
+        self._reserve_embedding_rows(
+            self._embedding_count, self._embeddings.shape[1])
+        last_row = self._embedding_count - 1
+        if row != last_row:
+            moved_chunk_id = self._embedding_ids[last_row]
+            self._embeddings[row] = self._embeddings[last_row]
+            self._embedding_ids[row] = moved_chunk_id
+            self._embedding_rows[moved_chunk_id] = row
+            self._data['content'][moved_chunk_id]['embedding'] = self._embeddings[row]
+        self._embedding_ids.pop()
+        self._embedding_count -= 1
+
+
+    def _detach_embedding(self, chunk_id):
+        """
+        Gives a chunk that is leaving the library its own copy of its
+        embedding, since its row in the matrix is about to be reused.
+        """
+        chunk = self._data['content'].get(chunk_id)
+        if chunk and chunk_id in self._embedding_rows:
+            chunk['embedding'] = np.array(chunk['embedding'])
 
 
     @property
@@ -383,6 +1390,9 @@ class Library:
 
 
     def delete_chunk(self, chunk_id):
+        self._access_partitions = None
+        self._detach_embedding(chunk_id)
+        self._unindex_embedding(chunk_id)
         del self._data["content"][chunk_id]
 
 
@@ -397,8 +1407,15 @@ class Library:
     def set_chunk(self, chunk_id, chunk):
         if self.omit_whole_chunk:
             return
+        if self._data["content"].get(chunk_id) is not chunk:
+            self._detach_embedding(chunk_id)
+        self._access_partitions = None
         self._data["content"][chunk_id] = chunk
         self._strip_chunk(chunk)
+        if 'embedding' in chunk:
+            self._index_embeddings([chunk_id])
+        else:
+            self._unindex_embedding(chunk_id)
 
 
     def set_chunk_field(self, chunk_id, text=None, embedding=None, token_count=None, info=None, access_tag=None):
@@ -409,7 +1426,7 @@ class Library:
         chunk = self._data["content"][chunk_id]
         if text != None:
             chunk["text"] = text
-        if embedding != None:
+        if embedding is not None:
             chunk["embedding"] = embedding
         if token_count != None:
             chunk["token_count"] = token_count
@@ -417,7 +1434,10 @@ class Library:
             chunk["info"] = info
         if access_tag != None:
             chunk["access_tag"] = access_tag
+        self._access_partitions = None
         self._strip_chunk(chunk)
+        if embedding is not None and 'embedding' in chunk:
+            self._index_embeddings([chunk_id])
 
 
     def delete_chunk_field(self, chunk_id, fields=None):
@@ -426,7 +1446,10 @@ class Library:
         if chunk_id not in self._data["content"]:
             return
         chunk = self._data["content"][chunk_id]
+        self._access_partitions = None
         for field in fields:
+            if field == 'embedding':
+                self._unindex_embedding(chunk_id)
             del chunk[field]
         if len(chunk) == 0:
             self.delete_chunk(chunk_id)
@@ -435,34 +1458,397 @@ class Library:
     def serializable(self, include_access_tag=False):
         """
         Returns a dict representing the data in the library that is suitable for
-        being serialized e.g. into JSON.
+        being serialized e.g. into JSON. It shares values like info with the
+        library's chunks, so don't modify it.
         """
-        result = copy.deepcopy(self._data)
-        for _, chunk in result['content'].items():
-            if not include_access_tag and 'access_tag' in chunk:
-                del chunk['access_tag']
-            if 'embedding' not in chunk:
+        result = {}
+        for key, value in self._data.items():
+            if key == 'content':
+                value = {chunk_id: self._serializable_chunk(chunk_id, include_access_tag=include_access_tag)
+                         for chunk_id in self.chunk_ids}
+            result[key] = value
+        return result
+
+
+    def _serializable_chunk(self, chunk_id, fields_to_omit=(), text=None, similarity=None, include_access_tag=False, cache_embedding=True):
+        """
+        Returns a new dict of the chunk's fields, with its embedding base64
+        encoded and text and similarity replaced if provided. Values like
+        info are shared with the chunk rather than copied. Set
+        cache_embedding to False when every chunk is being serialized once,
+        so they don't push the popular ones out of the cache.
+        """
+        chunk = self._data['content'][chunk_id]
+        result = {}
+        for field, value in chunk.items():
+            if field in fields_to_omit:
                 continue
-            chunk['embedding'] = base64_from_vector(
-                chunk['embedding']).decode('ascii')
+            if field == 'access_tag' and not include_access_tag:
+                continue
+            if field == 'embedding':
+                if cache_embedding:
+                    value = self._embedding_base64(chunk_id)
+                else:
+                    value = base64_from_vector(value).decode('ascii')
+            elif field == 'text' and text is not None:
+                value = text
+            result[field] = value
+        if similarity is not None and 'similarity' not in fields_to_omit:
+            result['similarity'] = similarity
         return result
 
 
-    def save(self, filename):
-        result = self.serializable()
-        with open(filename, 'w') as f:
-            json.dump(result, f, indent='\t')
+    def _embedding_base64(self, chunk_id):
+        """
+        Returns the base64 encoding of a chunk's embedding, caching the most
+        recently used ones so popular chunks aren't encoded on every request.
+        """
+        cache = self._base64_embeddings
+        with self._base64_embeddings_lock:
+            if chunk_id in cache:
+                cache.move_to_end(chunk_id)
+                return cache[chunk_id]
+        value = base64_from_vector(self._data['content'][chunk_id]['embedding']).decode('ascii')
+        with self._base64_embeddings_lock:
+            cache[chunk_id] = value
+            if len(cache) > EMBEDDING_BASE64_CACHE_SIZE:
+                cache.popitem(last=False)
+        return value
+
+
+    def save(self, filename, indent='\t'):
+        """
+        Saves the library in the binary format if filename has its extension,
+        and as JSON otherwise, indented with indent or as compact as possible
+        if it's None.
+        """
+        if is_binary_library_file(filename):
+            self._save_binary(filename)
+            return
+        # As in _save_binary, write to a temporary file and rename it into
+        # place so that a failed save never leaves a partial library behind.
+        temporary_filename = f'{filename}.{os.getpid()}.tmp'
+        try:
+            with open(temporary_filename, 'w') as f:
+                self._write_json(f, indent)
+            os.replace(temporary_filename, filename)
+        finally:
+            if os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
+
+
+    def _write_json(self, f, indent='\t'):
+        """
+        Writes the same JSON as json.dump(self.serializable(), f, indent=indent),
+        with separators=(',', ':') if indent is None, but one chunk at a time,
+        encoding each embedding as it goes, so that only one chunk's worth of
+        JSON is ever held in memory.
+        """
+        if isinstance(indent, int):
+            indent = ' ' * indent
+        if indent is None:
+            pad = ''
+            newline = ''
+            separators = (',', ':')
+        else:
+            pad = indent
+            newline = '\n'
+            separators = (',', ': ')
+
+        def write_member(index, key, value, depth):
+            text = json.dumps(value, indent=indent, separators=separators)
+            if newline:
+                text = text.replace('\n', newline + pad * depth)
+            f.write((',' if index else '') + newline + pad * depth +
+                    json.dumps(key) + separators[1] + text)
+
+        if not self._data:
+            f.write('{}')
+            return
+        f.write('{')
+        for index, (key, value) in enumerate(self._data.items()):
+            if key != 'content':
+                write_member(index, key, value, 1)
+                continue
+            if not value:
+                write_member(index, key, {}, 1)
+                continue
+            f.write((',' if index else '') + newline + pad + json.dumps(key) + separators[1] + '{')
+            for chunk_index, chunk_id in enumerate(value):
+                write_member(chunk_index, chunk_id, self._serializable_chunk(chunk_id, cache_embedding=False), 2)
+            f.write(newline + pad + '}')
+        f.write(newline + '}')
+
+
+    def _save_binary(self, filename, include_access_tag=False, chunk_ids=None):
+        metadata = {key: value for key, value in self._data.items() if key != 'content'}
+        ids = list(chunk_ids if chunk_ids is not None else self.chunk_ids)
+        metadata['ids'] = ids
+        content = self._data['content']
+        columns = {}
+        for field in BINARY_COLUMNS:
+            if field == 'access_tag' and not include_access_tag:
+                continue
+            values = [content[chunk_id].get(field) for chunk_id in ids]
+            if any(value is not None for value in values):
+                columns[field] = values
+        metadata['columns'] = columns
+
+        embeddings_filename = binary_embeddings_filename(filename)
+        # Write to temporary files and then rename them into place, so
+        # that readers, including a memory map of the files being replaced,
+        # never see a partially written library.
+        temporary_embeddings_filename = f'{embeddings_filename}.{os.getpid()}.tmp'
+        has_embeddings = 'embedding' not in self.fields_to_omit and not self.omit_whole_chunk and len(ids)
+        if has_embeddings:
+            rows = []
+            for chunk_id in ids:
+                if chunk_id not in self._embedding_rows:
+                    raise Exception(f'{chunk_id} is missing embedding')
+                rows.append(self._embedding_rows[chunk_id])
+            rows = np.array(rows)
+            # Fill the file through a memory map a block at a time so that
+            # saving never holds a second full copy of the matrix.
+            output = np.lib.format.open_memmap(temporary_embeddings_filename, mode='w+',
+                                               dtype=BINARY_EMBEDDINGS_DTYPE, shape=(len(ids), self._embeddings.shape[1]))
+            block_size = 4096
+            for start in range(0, len(rows), block_size):
+                output[start:start + block_size] = self._embeddings[rows[start:start + block_size]]
+            output.flush()
+            del output
+
+        temporary_filename = f'{filename}.{os.getpid()}.tmp'
+        with open(temporary_filename, 'w') as f:
+            json.dump(metadata, f, separators=(',', ':'))
+        if has_embeddings:
+            os.replace(temporary_embeddings_filename, embeddings_filename)
+        elif os.path.exists(embeddings_filename):
+            os.remove(embeddings_filename)
+        os.replace(temporary_filename, filename)
     
 
+    @property
+    def quantization(self):
+        """
+        Returns None, or the type of quantized copy of the embeddings that
+        queries score candidates against, one of LEGAL_QUANTIZATIONS.
+        """
+        return self._quantization
+
+
+    @quantization.setter
+    def quantization(self, value):
+        if value is not None and value not in LEGAL_QUANTIZATIONS:
+            raise Exception(
+                f'quantization {value} is not one of the legal options: {LEGAL_QUANTIZATIONS}')
+        self._quantization = value
+        self._quantized_embeddings = None
+
+
+    @property
+    def quantized_embeddings(self):
+        """
+        Returns the QuantizedEmbeddings for the library's quantization,
+        building them first if necessary, or None if it isn't quantized.
+        """
+        if self._quantization and self._quantized_embeddings is None and self._embedding_count:
+            if not self.embeddings_memory_mapped:
+                # Re-ranking still needs the full precision embeddings, so
+                # the quantized copy only saves memory if they're mapped from
+                # a binary library, like the compiled one.
+                print(f'Quantizing embeddings to {self._quantization}, but the full precision ones aren\'t memory-mapped, so they stay in memory too')
+            self._quantized_embeddings = QuantizedEmbeddings(
+                self._embeddings[:self._embedding_count], self._quantization)
+        return self._quantized_embeddings
+
+
+    @property
+    def embeddings_memory_mapped(self):
+        """
+        Returns whether the full precision embeddings are memory-mapped from a
+        binary library file, so that only the rows that are read are paged
+        in, rather than held in memory.
+        """
+        array = self._embeddings
+        while array is not None:
+            if isinstance(array, (np.memmap, mmap.mmap)):
+                return True
+            array = getattr(array, 'base', None)
+        return False
+
+
+    @property
+    def embeddings_nbytes(self):
+        """
+        Returns the number of bytes of embeddings the library holds in memory:
+        its quantized copy, if any, plus the full precision embeddings unless
+        they're memory-mapped.
+        """
+        result = 0
+        if self._embeddings is not None and not self.embeddings_memory_mapped:
+            result += self._embeddings.nbytes
+        if self.quantized_embeddings:
+            result += self.quantized_embeddings.nbytes
+        return result
+
+
+    def _score(self, query_embedding):
+        """
+        Returns the similarity of query_embedding to every embedding in the
+        library, indexed by row, as a single matrix-vector product.
+        """
+        if self._embeddings is None:
+            return np.empty(0, dtype=np.float32)
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        return self._embeddings[:self._embedding_count] @ query_embedding
+
+
     def similarities(self, query_embedding):
-        items = sorted([
-            (vector_similarity(query_embedding, item['embedding']), issue_id)
-            for issue_id, item
-            in self.chunks], reverse=True)
-        return {key: value for value, key in items}
+        scores = self._score(query_embedding)
+        return {self._embedding_ids[row]: scores[row] for row in np.argsort(scores)[::-1]}
+
+
+    def _top_rows(self, rows, scores, k, reverse=False):
+        """
+        Returns the (at most) k entries of rows with the highest scores, most
+        similar first, or the lowest scores if reverse is set, along with
+        their scores. scores[i] is the score of rows[i]. Only the k winners
+        are sorted; the rest are partitioned away in linear time.
+        """
+        keys = scores if reverse else -scores
+        if k < len(rows):
+            selection = np.argpartition(keys, k)[:k]
+            selection = selection[np.argsort(keys[selection], kind='stable')]
+        else:
+            selection = np.argsort(keys, kind='stable')
+        return rows[selection], scores[selection]
+
+
+    def _similarity_context(self, rows, scores, count, count_type_is_chunk=False, reverse=False, rerank_embedding=None, min_similarity=None):
+        """
+        Returns the same dict as get_context() would for rows ranked by score,
+        but only selects and sorts as many candidates as count needs, widening
+        the candidate set only if the budget was not filled.
+
+        If rerank_embedding is provided, the scores are treated as estimates:
+        a few times more candidates than needed are selected by them, and
+        then ranked by their exact similarity to rerank_embedding, dropping
+        any whose exact similarity is below min_similarity.
+
+        Also returns a dict of chunk_id to similarity for the candidates.
+        """
+        if count < 0:
+            candidate_count = len(rows)
+        elif count_type_is_chunk:
+            candidate_count = count + 1
+        else:
+            candidate_count = count // QUERY_CANDIDATE_TOKEN_ESTIMATE + 1
+        while True:
+            if rerank_embedding is None:
+                candidates, candidate_scores = self._top_rows(rows, scores, candidate_count, reverse)
+                considered_count = len(candidates)
+            else:
+                candidates, _ = self._top_rows(rows, scores, candidate_count * QUANTIZED_RERANK_FACTOR, reverse)
+                considered_count = len(candidates)
+                exact_scores = self._embeddings[candidates] @ rerank_embedding
+                if min_similarity is not None:
+                    above_minimum = exact_scores >= min_similarity
+                    candidates, exact_scores = candidates[above_minimum], exact_scores[above_minimum]
+                candidates, candidate_scores = self._top_rows(
+                    candidates, exact_scores, candidate_count, reverse)
+            chunk_ids = [self._embedding_ids[row] for row in candidates]
+            context = get_context(chunk_ids, self, count,
+                                  count_type_is_chunk=count_type_is_chunk)
+            # get_context stopping before the end of the candidates means
+            # the budget was filled, so more candidates can't change it.
+            if len(context) < len(candidates) or considered_count == len(rows):
+                return context, dict(zip(chunk_ids, candidate_scores))
+            candidate_count *= 2
+
+
+    @property
+    def approximate_index(self):
+        """
+        Returns the InvertedFileIndex used for search='approximate' queries,
+        building it first if necessary, or None if there are no embeddings.
+        """
+        if self._approximate_index is None and self._embedding_count:
+            self._approximate_index = InvertedFileIndex.build(
+                self._embeddings[:self._embedding_count])
+        return self._approximate_index
+
+
+    @approximate_index.setter
+    def approximate_index(self, value):
+        if value is not None and value.row_count != self._embedding_count:
+            raise Exception('The approximate index was built for a different set of embeddings')
+        self._approximate_index = value
+
+
+    @property
+    def access_partitions(self):
+        if self._access_partitions is None:
+            self._access_partitions = AccessPartitions(self)
+        return self._access_partitions
+
+
+    def _score_rows(self, query_embedding, rows):
+        """
+        Returns the similarity of query_embedding to each of rows, which may
+        be an array or a slice, using the quantized embeddings if there are any.
+        query_embedding may also be a matrix with one query per column, to
+        score several queries in one pass over the embeddings.
+        """
+        quantized_embeddings = self.quantized_embeddings
+        if quantized_embeddings:
+            return quantized_embeddings.score(query_embedding, rows)
+        return self._embeddings[rows] @ query_embedding
+
+
+    def _candidate_scores(self, query_embedding, search='exact', nprobe=None, visible_access_tags=None):
+        """
+        Returns a tuple of (rows, scores) of the candidate rows for a query
+        and their similarity to it. For an exact search that is every row
+        whose chunk a caller with visible_access_tags may see; the others are
+        never scored. For exact searches query_embedding may also be a matrix
+        with one query per column, in which case scores has a column per query.
+        """
+        visible_access_tags = frozenset(visible_access_tags or ())
+        partitions = self.access_partitions
+        visible_tags = partitions.visible_tags(visible_access_tags)
+        if search == 'approximate':
+            index = self.approximate_index
+            if index is None:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+            rows = index.candidate_rows(query_embedding, nprobe)
+            if visible_tags is not None:
+                rows = rows[partitions.visible_mask(visible_access_tags)[rows]]
+            return rows, self._score_rows(query_embedding, rows)
+        if visible_tags is None:
+            return np.arange(self._embedding_count), self._score_rows(query_embedding, slice(0, self._embedding_count))
+        rows = [np.empty(0, dtype=np.int64)]
+        scores = [np.empty((0,) + query_embedding.shape[1:], dtype=np.float32)]
+        for access_tag in visible_tags:
+            if access_tag not in partitions.rows:
+                continue
+            rows.append(partitions.rows[access_tag])
+            for scored_rows in partitions.scored_rows[access_tag]:
+                scores.append(self._score_rows(query_embedding, scored_rows))
+        return np.concatenate(rows), np.concatenate(scores)
 
 
-    def query(self, version=None, query_embedding=None, query_embedding_model=None, count=0, count_type='token', sort='similarity', sort_reversed=False, seed=None, omit='embedding', access_token=''):
+    def _query_chunks(self, version=None, query_embedding=None, query_embedding_model=None, count=0, count_type='token', sort='similarity', sort_reversed=False, seed=None, omit='embedding', access_token='', min_similarity=None, search='exact', nprobe=None, permitted=None, candidates=None):
+        """
+        Does the work of query(): checks the arguments and selects the chunks
+        to return. permitted is the result of permitted_access(access_token)
+        and candidates the result of _candidate_scores() for query_embedding,
+        if the caller already has them.
+
+        Returns a tuple of (omit, chunks, details), where omit is the
+        canonical omit configuration of the result, chunks is a list of
+        (chunk_id, possibly_truncated_text, similarity or None) and details
+        is the details dict of the result.
+        """
         # We do our own defaulting so that servers that call us can pass the result
         # of request.get() directly and if it's None, we'll use the default.
         if count_type == None:
@@ -471,6 +1857,8 @@ class Library:
             sort = 'similarity'
         if omit == None:
             omit = 'embedding'
+        if search == None:
+            search = 'exact'
 
         if count == 0:
             raise Exception('count must be greater than 0')
@@ -490,110 +1878,670 @@ class Library:
             raise Exception(
                 f'count_type {count_type} is not one of the legal options: {LEGAL_COUNT_TYPES}')
 
-        result = Library()
+        if search not in LEGAL_SEARCHES:
+            raise Exception(
+                f'search {search} is not one of the legal options: {LEGAL_SEARCHES}')
+
+        if nprobe is not None and (not isinstance(nprobe, (int, np.integer)) or isinstance(nprobe, bool) or nprobe < 1):
+            raise Exception(f'nprobe must be an integer of at least 1 but it was {nprobe}')
 
         omit_whole_chunk, _, canonical_omit_configuration = keys_to_omit(
             omit)
 
-        result.omit = canonical_omit_configuration
+        if permitted is None:
+            permitted = permitted_access(access_token)
+        visible_access_tags, include_restricted_count, restricted_message = permitted
 
-        similarities_dict = None
-        if query_embedding:
+        rows = None
+        if _query_needs_scores(query_embedding, sort, min_similarity):
             # TODO: support query_embedding being base64 encoded or a raw vector of
             # floats
             embedding = vector_from_base64(query_embedding)
-            similarities_dict = self.similarities(embedding)
+            if candidates is None:
+                candidates = self._candidate_scores(embedding, search, nprobe, visible_access_tags)
+            rows, scores = candidates
+            if min_similarity is not None:
+                slack = QUANTIZED_SIMILARITY_SLACK[self.quantization] if self.quantized_embeddings else 0
+                above_minimum = scores >= min_similarity - slack
+                rows, scores = rows[above_minimum], scores[above_minimum]
+                if slack and sort != 'similarity':
+                    # These won't be re-ranked, so check the exact cutoff now.
+                    scores = self._embeddings[rows] @ embedding
+                    above_minimum = scores >= min_similarity
+                    rows, scores = rows[above_minimum], scores[above_minimum]
+
+        count_type_is_chunk = count_type == 'chunk'
 
         # The default sort for 'any' or 'similarity' if there was no query set.
-        chunk_ids = None 
-        if sort == 'similarity' and similarities_dict:
-            chunk_ids = list(similarities_dict.keys())
+        chunk_dict = None
+        similarities = None
+        if sort == 'similarity' and rows is not None:
+            rerank_embedding = embedding if self.quantized_embeddings else None
+            chunk_dict, similarities = self._similarity_context(rows, scores, count,
+                                                                count_type_is_chunk=count_type_is_chunk, reverse=sort_reversed,
+                                                                rerank_embedding=rerank_embedding, min_similarity=min_similarity)
         if sort == 'random':
-            chunk_ids = list(self.chunk_ids)
+            if rows is not None:
+                chunk_ids = [self._embedding_ids[row] for row in rows]
+            else:
+                chunk_ids = [chunk_id for chunk_id, chunk in self.chunks
+                             if 'access_tag' not in chunk or chunk['access_tag'] in visible_access_tags]
             rng = random.Random()
             rng.seed(None if not seed else seed)
             rng.shuffle(chunk_ids)
-            result.omit = 'embedding,similarity'
+            _, _, canonical_omit_configuration = keys_to_omit('embedding,similarity')
+            if sort_reversed:
+                chunk_ids.reverse()
+            chunk_dict = get_context(chunk_ids, self, count,
+                                     count_type_is_chunk=count_type_is_chunk)
 
-        if not chunk_ids:
+        if chunk_dict is None:
             raise Exception('Invalid type of sort was specified')
 
-        if sort_reversed:
-            chunk_ids.reverse()
-
-        count_type_is_chunk = count_type == 'chunk'
+        # Restricted chunks were never candidates, so this is every chunk in
+        # the library that the access_token doesn't grant access to.
+        restricted_count = self.access_partitions.restricted_count(visible_access_tags)
+
+        chunks = []
+        if not omit_whole_chunk:
+            for chunk_id, chunk_text in chunk_dict.items():
+                # Note: if the text was truncated then technically the embedding isn't
+                # necessarily right anymore. But, like, whatever.
+                similarity = None
+                if similarities is not None:
+                    # the similarity is float32, but only float64 is JSON serializable
+                    similarity = float(similarities[chunk_id])
+                chunks.append((chunk_id, chunk_text, similarity))
+
+        details = {
+            'counts': {
+                'chunks': len(chunk_dict)
+            }
+        }
 
-        chunk_dict = get_context(chunk_ids, self, count,
-                                count_type_is_chunk=count_type_is_chunk)
+        if include_restricted_count:
+            details['counts']['restricted'] = restricted_count
 
-        visible_access_tags, include_restricted_count, restricted_message = permitted_access(access_token)
+        if restricted_message and restricted_count > 0:
+            details['message'] = 'Restricted results were omitted. ' + restricted_message
 
-        chunk_count = 0
-        restricted_count = 0
+        return canonical_omit_configuration, chunks, details
 
-        for chunk_id, chunk_text in chunk_dict.items():
-            chunk = copy.deepcopy(self.chunk(chunk_id))
-            if 'access_tag' in chunk:
-                if chunk['access_tag'] not in visible_access_tags:
-                    restricted_count += 1
-                    continue
 
-            chunk_count += 1
+    def query(self, version=None, query_embedding=None, query_embedding_model=None, count=0, count_type='token', sort='similarity', sort_reversed=False, seed=None, omit='embedding', access_token='', min_similarity=None, search='exact', nprobe=None):
+        """
+        Returns a new Library of the chunks that best match the arguments,
+        whose chunks' fields other than text and similarity are shared with
+        this library.
+        """
+        omit, chunks, details = self._query_chunks(version=version, query_embedding=query_embedding, query_embedding_model=query_embedding_model,
+                                                   count=count, count_type=count_type, sort=sort, sort_reversed=sort_reversed, seed=seed,
+                                                   omit=omit, access_token=access_token, min_similarity=min_similarity, search=search, nprobe=nprobe)
+        return self._query_result(omit, chunks, details)
 
-            if omit_whole_chunk:
-                continue
 
-            # Note: if the text was truncated then technically the embedding isn't
-            # necessarily right anymore. But, like, whatever.
-            chunk['text'] = chunk_text
-            if similarities_dict:
-                # the similarity is float32, but only float64 is JSON serializable
-                chunk['similarity'] = float(
-                    similarities_dict[chunk_id])
+    def _query_result(self, omit, chunks, details):
+        result = Library()
+        result.omit = omit
+        for chunk_id, text, similarity in chunks:
+            chunk = dict(self.chunk(chunk_id))
+            chunk['text'] = text
+            if similarity is not None:
+                chunk['similarity'] = similarity
             result.set_chunk(chunk_id, chunk)
+        result._details = details
+        return result
 
-        result.count_chunks = chunk_count
 
-        if include_restricted_count:
-            result.count_restricted = restricted_count
-        
-        if restricted_message and restricted_count > 0:
-            result.message = 'Restricted results were omitted. ' + restricted_message
+    def query_serializable(self, *args, **kwargs):
+        """
+        Takes the same arguments as query() and returns the same thing as
+        query(...).serializable(), but builds it straight from this library's
+        chunks, without building a Library or copying chunks, and with
+        base64 embeddings from a cache.
+        """
+        return self._serializable_query_result(*self._query_chunks(*args, **kwargs))
 
-        return result
+
+    def _serializable_query_result(self, omit, chunks, details):
+        _, fields_to_omit, _ = keys_to_omit(omit)
+        content = {}
+        for chunk_id, text, similarity in chunks:
+            content[chunk_id] = self._serializable_chunk(chunk_id, fields_to_omit, text, similarity)
+        return {
+            'version': CURRENT_VERSION,
+            'embedding_model': self.embedding_model,
+            'content': content,
+            'omit': omit,
+            'details': details
+        }
 
 
-def load_default_libraries(fail_on_empty=False) -> Library:
-    files = glob.glob(os.path.join(LIBRARY_DIR, '**/*.json'), recursive=True)
+    def query_batch(self, queries, version=None, access_token=''):
+        """
+        Runs a batch of queries, returning a list with the result Library of
+        each. Each of queries is a dict of the keyword arguments of query(),
+        other than version and access_token which are shared by the batch.
+
+        This is much faster than running the queries one at a time: the
+        access_token is only resolved once, and the exact searches are scored
+        QUERY_BATCH_SIZE queries at a time with one pass over the embeddings.
+        """
+        return [self._query_result(*result) for result in self._query_batch_chunks(queries, version, access_token)]
+
+
+    def query_batch_serializable(self, queries, version=None, access_token=''):
+        """
+        Returns the same thing as [result.serializable() for result in
+        query_batch(...)], without building a Library for each result.
+        """
+        return [self._serializable_query_result(*result) for result in self._query_batch_chunks(queries, version, access_token)]
+
+
+    def _query_batch_chunks(self, queries, version, access_token):
+        """
+        Yields the result of _query_chunks() for each of queries, scoring the
+        exact searches together.
+        """
+        for query in queries:
+            illegal_keys = set(query) - LEGAL_BATCH_QUERY_KEYS
+            if illegal_keys:
+                raise Exception(
+                    f'queries may not include {sorted(illegal_keys)}; the legal options are: {LEGAL_BATCH_QUERY_KEYS}')
+        permitted = permitted_access(access_token)
+        visible_access_tags, _, _ = permitted
+        for start in range(0, len(queries), QUERY_BATCH_SIZE):
+            block = queries[start:start + QUERY_BATCH_SIZE]
+            # The queries in the block that score every visible chunk, whose
+            # embeddings become the columns of a single query matrix.
+            scored = [index for index, query in enumerate(block)
+                      if query.get('search') in (None, 'exact') and _query_needs_scores(
+                          query.get('query_embedding'), query.get('sort'), query.get('min_similarity'))]
+            candidates = {}
+            if scored:
+                matrix = np.stack([vector_from_base64(block[index]['query_embedding']) for index in scored], axis=1)
+                rows, scores = self._candidate_scores(matrix, 'exact', visible_access_tags=visible_access_tags)
+                for column, index in enumerate(scored):
+                    candidates[index] = (rows, scores[:, column])
+            for index, query in enumerate(block):
+                yield self._query_chunks(version=version, access_token=access_token, permitted=permitted,
+                                         candidates=candidates.get(index), **query)
+
+
+def _query_needs_scores(query_embedding, sort, min_similarity):
+    """
+    Returns whether a query with these arguments scores chunks against its
+    query_embedding.
+    """
+    return bool(query_embedding) and (sort in (None, 'similarity') or min_similarity is not None)
+
+
+def load_default_libraries(fail_on_empty=False, compiled_filename=None) -> Library:
+    files = library_filenames_in_directory(LIBRARY_DIR)
     if len(files):
-        return load_multiple_libraries(files)
+        return load_multiple_libraries(files, compiled_filename)
     if fail_on_empty:
         raise Exception('No libraries were in the default library directory.')
     return Library(filename=SAMPLE_LIBRARIES_FILE)
 
 
-def load_libraries_in_directory(directory) -> Library:
-    files = glob.glob(os.path.join(directory, '**/*.json'), recursive=True)
-    return load_multiple_libraries(files)
+def load_libraries_in_directory(directory, compiled_filename=None) -> Library:
+    files = library_filenames_in_directory(directory)
+    return load_multiple_libraries(files, compiled_filename)
 
 
-def load_libraries(file=None, fail_on_empty=False) -> Library:
+def load_libraries(file=None, fail_on_empty=False, compiled_filename=None) -> Library:
     if file:
+        if compiled_filename:
+            return load_compiled_libraries([file], compiled_filename)
         return Library(filename=file)
-    return load_default_libraries(fail_on_empty)
+    return load_default_libraries(fail_on_empty, compiled_filename)
 
 
-def load_multiple_libraries(library_file_names) -> Library:
+def load_multiple_libraries(library_file_names, compiled_filename=None, previous=None) -> Library:
+    """
+    Returns the libraries in library_file_names merged into one. If previous
+    is a library that was loaded from (some of) the same files, files that
+    haven't changed since are copied from it rather than loaded again.
+    """
+    if compiled_filename:
+        return load_compiled_libraries(library_file_names, compiled_filename, previous)
+    return _merge_library_files(library_file_names, previous)
+
+
+def library_file_signature(filename):
+    """
+    Returns the size and modification time of a library file, and of its
+    embeddings file if it's a binary library, to tell when it has changed.
+    """
+    filenames = [filename]
+    if is_binary_library_file(filename):
+        filenames.append(binary_embeddings_filename(filename))
+    signature = []
+    for name in filenames:
+        try:
+            stat = os.stat(name)
+        except FileNotFoundError:
+            signature.append(None)
+            continue
+        signature.append((stat.st_size, stat.st_mtime_ns))
+    return tuple(signature)
+
+
+def _merge_library_files(library_file_names, previous=None, processes=None):
+    previous_sources = previous._sources if previous else {}
+    signatures = {filename: library_file_signature(filename) for filename in library_file_names}
+    unchanged = set(filename for filename in library_file_names
+                    if filename in previous_sources and previous_sources[filename][0] == signatures[filename])
+    libraries = _load_library_files([filename for filename in library_file_names if filename not in unchanged], processes)
     result = Library()
-    for file in library_file_names:
-        library = Library(filename =file)
-        result.extend(library)
+    file_chunk_ids = {}
+    # The file each chunk_id was last loaded from. A chunk_id in more than one
+    # file ends up with the chunk from the last of them.
+    owners = {}
+    collisions = {}
+    for filename in library_file_names:
+        if filename in unchanged:
+            chunk_ids = previous_sources[filename][1]
+            for chunk_id in chunk_ids:
+                result.set_chunk(chunk_id, dict(previous.chunk(chunk_id)))
+        else:
+            library = next(libraries)
+            chunk_ids = list(library.chunk_ids)
+            result.extend(library)
+        for chunk_id in chunk_ids:
+            if chunk_id in owners:
+                collisions.setdefault((owners[chunk_id], filename), []).append(chunk_id)
+            owners[chunk_id] = filename
+        file_chunk_ids[filename] = chunk_ids
+    for (earlier_filename, filename), chunk_ids in collisions.items():
+        print(f'{len(chunk_ids)} chunk_ids in {filename} were also in {earlier_filename}, e.g. {chunk_ids[0]}. Using the chunks from {filename}.')
+    # Only files none of whose chunks were replaced can be copied from the
+    # result later.
+    result._sources = {filename: (signatures[filename], chunk_ids)
+                       for filename, chunk_ids in file_chunk_ids.items()
+                       if all(owners[chunk_id] == filename for chunk_id in chunk_ids)}
     return result
 
 
+def file_sha256(filename):
+    """
+    Returns the hex SHA-256 of a file's contents. Both the compiled library's
+    manifest and convert's import manifest hash files with it.
+    """
+    hash_object = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hash_object.update(block)
+    return hash_object.hexdigest()
+
+
+def library_files_manifest(library_file_names, previous_manifest=None):
+    """
+    Returns a manifest of the size, mtime and content hash of each of the
+    given library files. A file whose size and mtime match its entry in
+    previous_manifest is assumed to be unchanged and isn't hashed again.
+    """
+    previous_entries = {}
+    if previous_manifest:
+        previous_entries = {entry['filename']: entry for entry in previous_manifest['files']}
+    filenames = []
+    for filename in library_file_names:
+        filenames.append(filename)
+        if is_binary_library_file(filename) and os.path.exists(binary_embeddings_filename(filename)):
+            filenames.append(binary_embeddings_filename(filename))
+    entries = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        entry = {
+            'filename': filename,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime
+        }
+        previous_entry = previous_entries.get(filename)
+        if previous_entry and previous_entry['size'] == entry['size'] and previous_entry['mtime'] == entry['mtime']:
+            entry['sha256'] = previous_entry['sha256']
+        else:
+            entry['sha256'] = file_sha256(filename)
+        entries.append(entry)
+    return {
+        'version': CURRENT_VERSION,
+        'embedding_model': EMBEDDINGS_MODEL_ID,
+        'files': entries
+    }
+
+
+def _manifest_key(manifest):
+    return (manifest.get('version'), manifest.get('embedding_model'),
+            [(entry['filename'], entry['sha256']) for entry in manifest.get('files', [])])
+
+
+def _load_library_files(library_file_names, processes=None):
+    """
+    Yields the Library loaded from each of library_file_names, in order.
+    JSON files are parsed, decoded and validated in parallel, in up to
+    processes (by default LIBRARY_LOAD_PROCESSES) processes. Binary files are
+    memory-mapped, which is already fast, so they're loaded here.
+
+    The processes are spawned rather than forked. This runs in
+    LibraryWatcher's thread in threaded host workers, and a process forked
+    from one with several threads can deadlock on a lock that another
+    thread held at the time.
+    """
+    if processes is None:
+        processes = LIBRARY_LOAD_PROCESSES or os.cpu_count() or 1
+    processes = min(processes, sum(1 for filename in library_file_names if not is_binary_library_file(filename)))
+    if processes <= 1:
+        for filename in library_file_names:
+            yield Library(filename=filename)
+        return
+    with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [None if is_binary_library_file(filename) else executor.submit(_library_file_parts, filename)
+                   for filename in library_file_names]
+        for filename, future in zip(library_file_names, futures):
+            if future is None:
+                yield Library(filename=filename)
+            else:
+                yield _library_from_parts(*future.result())
+
+
+def _library_file_parts(filename):
+    """
+    Loads a library file and returns its data without embeddings, its
+    embedding matrix and the chunk_id of each row, which is much cheaper to
+    send back from a process than each chunk's embedding separately.
+    """
+    library = Library(filename=filename)
+    for chunk in library._data['content'].values():
+        chunk.pop('embedding', None)
+    embeddings = library._embeddings
+    if embeddings is not None:
+        embeddings = embeddings[:library._embedding_count]
+    return library._data, embeddings, library._embedding_ids[:library._embedding_count]
+
+
+def _library_from_parts(data, embeddings, embedding_ids):
+    # Already validated by _library_file_parts().
+    library = Library(data=data, access_tag=False, skip_validation=True)
+    if embeddings is not None:
+        library._adopt_embeddings(embedding_ids, embeddings)
+    return library
+
+
+def load_compiled_libraries(library_file_names, compiled_filename=COMPILED_LIBRARY_FILE, previous=None) -> Library:
+    """
+    Returns the same library as load_multiple_libraries(library_file_names),
+    but loads it from the binary library at compiled_filename if that was
+    compiled from exactly these files with the same contents. Otherwise it
+    loads the files, copying unchanged ones from previous if provided, and
+    (re)compiles them to compiled_filename. Files in UNDEPLOYED_LIBRARY_DIRS
+    aren't compiled, but loaded and merged in separately.
+    """
+    deployed = [filename for filename in library_file_names if is_deployed_library_file(filename)]
+    undeployed = [filename for filename in library_file_names if not is_deployed_library_file(filename)]
+    if not deployed:
+        return _merge_library_files(undeployed, previous)
+    with _compiled_library_lock(compiled_filename):
+        result = _load_compiled_libraries(deployed, compiled_filename, previous)
+    if undeployed:
+        other = _merge_library_files(undeployed, previous)
+        result.extend(other)
+        # As in _merge_library_files, only files none of whose chunks were
+        # replaced can be copied from the result later.
+        replaced = set(other.chunk_ids)
+        result._sources = {filename: source for filename, source in result._sources.items()
+                           if replaced.isdisjoint(source[1])}
+        result._sources.update(other._sources)
+    return result
+
+
+def is_deployed_library_file(filename):
+    """
+    Returns whether filename is deployed, i.e. isn't in one of the
+    UNDEPLOYED_LIBRARY_DIRS.
+    """
+    path = os.path.abspath(filename)
+    for directory in UNDEPLOYED_LIBRARY_DIRS:
+        directory = os.path.abspath(directory)
+        if os.path.commonpath([path, directory]) == directory:
+            return False
+    return True
+
+
+@contextmanager
+def _compiled_library_lock(compiled_filename):
+    """
+    Holds an exclusive lock on compiled_filename while it is checked and
+    compiled, so that processes compiling the same files, like the host's
+    workers reloading after the same change, take turns and all but the
+    first find it already compiled.
+    """
+    lock_file = None
+    if fcntl:
+        try:
+            directory = os.path.dirname(compiled_filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            lock_file = open(compiled_filename + COMPILED_LOCK_EXTENSION, 'w')
+        except OSError:
+            # The compiled library can't be written either, and compiling
+            # will say so.
+            pass
+    if lock_file is None:
+        yield
+        return
+    with lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def _load_compiled_libraries(library_file_names, compiled_filename, previous):
+    manifest_filename = compiled_filename + COMPILED_MANIFEST_EXTENSION
+    previous_manifest = None
+    if os.path.exists(manifest_filename) and os.path.exists(compiled_filename):
+        previous_manifest = load_data_file(manifest_filename)
+    manifest = library_files_manifest(library_file_names, previous_manifest)
+
+    index_filename = compiled_filename + COMPILED_INDEX_EXTENSION
+
+    if previous_manifest and _manifest_key(previous_manifest) == _manifest_key(manifest):
+        manifest['sources'] = previous_manifest.get('sources', {})
+        if previous_manifest != manifest:
+            # Only mtimes changed, e.g. after a deploy. Record them so the
+            # next start doesn't need to hash the files again.
+            _save_manifest(manifest, manifest_filename)
+        # The libraries were validated when they were compiled.
+        result = Library(filename=compiled_filename, access_tag=False, skip_validation=True)
+        if os.path.exists(index_filename):
+            result.approximate_index = InvertedFileIndex.load(index_filename)
+        # The files match their hashes in the manifest, so their chunks are
+        # the ones it lists.
+        result._sources = {filename: (library_file_signature(filename), chunk_ids)
+                           for filename, chunk_ids in manifest['sources'].items()}
+        return result
+
+    print(f'Compiling libraries to {compiled_filename} ...')
+    result = _merge_library_files(library_file_names, previous)
+    sources = result._sources
+    manifest['sources'] = {filename: chunk_ids for filename, (_, chunk_ids) in sources.items()}
+    try:
+        directory = os.path.dirname(compiled_filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(index_filename):
+            os.remove(index_filename)
+        # Keep the chunks for each access_tag together, so that queries can
+        # score each AccessPartitions partition as one contiguous block.
+        chunk_ids = sorted(result.chunk_ids, key=lambda chunk_id: result.chunk(chunk_id).get('access_tag') or '')
+        result._save_binary(compiled_filename, include_access_tag=True, chunk_ids=chunk_ids)
+        # Serve from the compiled library so that its rows line up with the
+        # approximate index, and so that it is memory-mapped.
+        result = Library(filename=compiled_filename, access_tag=False, skip_validation=True)
+        result._sources = sources
+        if result.approximate_index:
+            result.approximate_index.save(index_filename)
+    except OSError as e:
+        print(f'Could not write compiled libraries to {compiled_filename}: {e}')
+        return result
+    _save_manifest(manifest, manifest_filename)
+    return result
+
+
+def _save_manifest(manifest, manifest_filename):
+    temporary_filename = f'{manifest_filename}.{os.getpid()}.tmp'
+    try:
+        with open(temporary_filename, 'w') as f:
+            json.dump(manifest, f, indent='\t')
+        os.replace(temporary_filename, manifest_filename)
+    except OSError as e:
+        print(f'Could not write {manifest_filename}: {e}')
+
+
+class LibraryWatcher:
+    """
+    Keeps a library loaded from the library files that load_libraries(file)
+    would load. Once started, a background thread checks the files every
+    interval seconds and, when any were added, changed or removed, loads a
+    new library, only loading the files that changed, and swaps it in.
+
+    Readers should call current() once per use: a swap never changes a
+    library that's already in use, so in-flight queries finish on the
+    library they started with.
+    """
+
+    def __init__(self, file=None, compiled_filename=None, interval=LIBRARY_RELOAD_INTERVAL, prepare=None, on_reload=None):
+        """
+        prepare is called with each new library before it's swapped in, and
+        on_reload with no arguments after each reload.
+        """
+        self.file = file
+        self.compiled_filename = compiled_filename
+        self.interval = interval
+        self.prepare = prepare
+        self.on_reload = on_reload
+        self.reload_seconds = None
+        self.reloaded_at = None
+        self._current = (None, 0)
+        self._signature = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self.check()
+
+
+    def current(self):
+        """
+        Returns a tuple of the current library and its generation, which
+        starts at 1 and goes up by one with each reload.
+        """
+        return self._current
+
+
+    @property
+    def library(self):
+        return self._current[0]
+
+
+    @property
+    def generation(self):
+        return self._current[1]
+
+
+    def _filenames(self):
+        if self.file:
+            return [self.file]
+        return library_filenames_in_directory(LIBRARY_DIR)
+
+
+    def check(self):
+        """
+        Loads and swaps in a new library if the files have changed since the
+        last one was loaded. Returns whether it did.
+        """
+        with self._lock:
+            filenames = self._filenames()
+            signature = [(filename, library_file_signature(filename)) for filename in filenames]
+            if signature == self._signature:
+                return False
+            if not filenames:
+                raise Exception('No libraries were in the default library directory.')
+            start = monotonic()
+            previous, generation = self._current
+            # Whether or not loading succeeds, don't try again until the
+            # files change again.
+            self._signature = signature
+            library = load_multiple_libraries(filenames, self.compiled_filename, previous=previous)
+            if previous and previous._approximate_index is not None:
+                # Build the new approximate index now, rather than in the
+                # first query that needs it.
+                library.approximate_index
+            if self.prepare:
+                self.prepare(library)
+            self._current = (library, generation + 1)
+            self.reload_seconds = monotonic() - start
+            self.reloaded_at = time()
+        if generation:
+            print(f'Reloaded libraries in {self.reload_seconds:.2f}s, generation {generation + 1} has {len(library.chunk_ids)} chunks')
+        if self.on_reload:
+            self.on_reload()
+        return True
+
+
+    def start(self):
+        """
+        Starts the background thread, unless it's running or interval is 0.
+        It doesn't survive a fork, so processes that fork, like gunicorn with
+        preload_app, must start it in each child.
+        """
+        if self.interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._thread = threading.Thread(target=self._watch, name='LibraryWatcher', daemon=True)
+        self._thread.start()
+
+
+    def _watch(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.check()
+            except Exception as e:
+                # Keep serving the current library until the files are fixed.
+                print(f'Could not reload libraries: {e}')
+
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def get_tokenizer():
+    """
+    Returns the GPT-2 tokenizer, loading it the first time it's needed and
+    sharing it for the rest of the process.
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                from transformers import GPT2TokenizerFast
+                _tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
+    return _tokenizer
+
+
 def get_token_count(text):
-    tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
-    return len(tokenizer.tokenize(text))
+    return len(get_tokenizer().tokenize(text))
+
+
+def get_token_counts(texts):
+    """
+    Returns the token count of each of texts. They're all tokenized in one
+    call to the fast tokenizer, which is much faster than calling
+    get_token_count() for each.
+    """
+    texts = list(texts)
+    if not texts:
+        return []
+    # verbose=False, because texts longer than GPT-2's context are fine to count.
+    encodings = get_tokenizer()(texts, add_special_tokens=False, verbose=False)
+    return [len(input_ids) for input_ids in encodings['input_ids']]
 
 
 def get_context(chunk_ids, library : Library, count=MAX_CONTEXT_LEN_IN_TOKENS, count_type_is_chunk=False):
@@ -651,6 +2599,9 @@ def get_chunk_infos_for_library(library : Library):
 
 LEGAL_SORTS = set(['similarity', 'any', 'random'])
 LEGAL_COUNT_TYPES = set(['token', 'chunk'])
+LEGAL_SEARCHES = set(['exact', 'approximate'])
+LEGAL_BATCH_QUERY_KEYS = set(['query_embedding', 'query_embedding_model', 'count', 'count_type', 'sort',
+                              'sort_reversed', 'seed', 'omit', 'min_similarity', 'search', 'nprobe'])
 LEGAL_OMIT_KEYS = set(
     ['*', '', 'similarity', 'embedding', 'token_count', 'info', 'access_tag'])
 
@@ -692,6 +2643,7 @@ def keys_to_omit(configuration=''):
 
 
 def get_completion(prompt):
+    import openai
     response = openai.Completion.create(
         model=COMPLETION_MODEL_NAME,
         prompt=prompt,
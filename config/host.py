@@ -19,9 +19,13 @@ def generate_token_for_user(user_id):
 
 
 def save_config_file(data, access_file=DEFAULT_CONFIG_FILE):
-    with open(access_file, 'w') as f:
+    # Replace the file rather than writing it in place, so a running host
+    # never reads it half-written and sees its inode change.
+    temporary_file = f'{access_file}.{os.getpid()}.tmp'
+    with open(temporary_file, 'w') as f:
         json.dump(data, f, indent='\t')
-    print(f"Don't forget to redeploy with the updated {access_file}")
+    os.replace(temporary_file, access_file)
+    print(f"Hosts running from this directory will pick up the change automatically. Don't forget to redeploy with the updated {access_file}")
 
 
 def load_config_file(access_file=DEFAULT_CONFIG_FILE):
@@ -0,0 +1,38 @@
+import argparse
+import os
+
+import ask_embeddings
+
+# Converts libraries between the JSON format and the binary format, both
+# described in format.md. The format of each file is determined by its
+# extension.
+
+
+def output_filename_for(filename):
+    base_filename, _ = os.path.splitext(filename)
+    if ask_embeddings.is_binary_library_file(filename):
+        return base_filename + '.json'
+    return base_filename + ask_embeddings.BINARY_LIBRARY_EXTENSION
+
+
+def convert(filename, output_filename=''):
+    if not output_filename:
+        output_filename = output_filename_for(filename)
+    # Pass an access_tag of False so that files under access/ don't pick up
+    # an access_tag that isn't stored in the file.
+    library = ask_embeddings.Library(filename=filename, access_tag=False)
+    library.save(output_filename)
+    return output_filename
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'filename', help=f'The library to convert, either a .json file or a {ask_embeddings.BINARY_LIBRARY_EXTENSION} file')
+    parser.add_argument(
+        '--output', help='The file to write. Defaults to the input file with the extension of the other format', default='')
+    args = parser.parse_args()
+
+    print(f'Converting {args.filename} ...')
+    output_filename = convert(args.filename, args.output)
+    print(f'Wrote {output_filename}')
@@ -1,10 +1,17 @@
 import argparse
 import json
+import re
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
 
 from cleantext import clean
+from cleantext.clean import normalize_whitespace, replace_urls
 
-MIN_CHUNK_SIZE = 500
-MAX_CHUNK_SIZE = 1500
+import ask_embeddings
+
+# Sizes are in GPT-2 tokens, the same tokens as a chunk's token_count.
+MIN_CHUNK_SIZE = 125
+MAX_CHUNK_SIZE = 375
 
 # The idea of a chunker is to take in a list of text strings and
 # chunk it into another list of text strings, where each string is
@@ -37,71 +44,170 @@ GOLDIELOCKS = {
 # In that case, it will be appended to the previous chunk.
 MEH_SIZE = GOLDIELOCKS["min"] / 2
 
-# TODO: Make this logic use GPT-2 tokenizer rather than character lengths.
+# Each line is tokenized once, and chunks are measured by adding up the
+# tokens of their lines, plus one for each newline joining them. That is
+# exact, since GPT-2 never merges tokens across a newline, so every chunk
+# comes out with its token_count and convert.main doesn't need to tokenize
+# it again.
+NEWLINE_TOKEN_COUNT = 1
+
+CLEAN_ARGUMENTS = {
+    "no_urls": True,
+    "lower": False,
+    "no_emoji": True
+}
+
+# Most lines are plain ASCII: printable characters, tabs and newlines, with no
+# & (which ftfy may unescape as an HTML entity) or \ (which clean() decodes as
+# an escape sequence). For those, all clean() does is turn backticks into
+# quotes, replace URLs and normalize whitespace, so get_clean_text does just
+# that and skips ftfy and transliteration, which are most of its cost.
+PLAIN_ASCII_PATTERN = re.compile(r"[\t\n -%'-\[\]-~]*")
+
+# Lines are only cleaned across processes when there are more than this many,
+# in batches of this many.
+CLEAN_BATCH_SIZE = 2000
+
+# The number of processes to clean lines in. None for one per CPU.
+CLEAN_PROCESSES = None
 
 
 def get_clean_text(text: str):
-    return clean(text,
-                 no_urls=True,
-                 lower=False,
-                 no_emoji=True)
+    if text.isascii() and PLAIN_ASCII_PATTERN.fullmatch(text):
+        text = replace_urls(text.replace("`", "'"))
+        if "\n" in text:
+            return normalize_whitespace(text)
+        # What normalize_whitespace does to a single line of ASCII.
+        return " ".join(text.split())
+    return clean(text, **CLEAN_ARGUMENTS)
 
 
-def make_chunky_sentences(text: str):
+def get_clean_texts(texts, processes=0):
+    """
+    Returns get_clean_text() of each of texts. If processes isn't 0, and
+    there are enough texts, they're cleaned in batches across that many
+    processes, or one per CPU if it's None.
+    """
+    texts = list(texts)
+    if processes == 0 or len(texts) <= CLEAN_BATCH_SIZE:
+        return [get_clean_text(text) for text in texts]
+    batches = [texts[start:start + CLEAN_BATCH_SIZE]
+               for start in range(0, len(texts), CLEAN_BATCH_SIZE)]
     result = []
-    while len(text) > MAX_CHUNK_SIZE:
-        split_index = text[:MAX_CHUNK_SIZE].rfind(".")
+    with ProcessPoolExecutor(processes) as executor:
+        for batch in executor.map(get_clean_texts, batches):
+            result.extend(batch)
+    return result
+
+
+def get_token_offsets(texts):
+    """
+    Returns the (start, end) character offsets of the tokens of each of
+    texts, tokenizing them all in one call.
+    """
+    if not texts:
+        return []
+    encodings = ask_embeddings.get_tokenizer()(
+        texts, add_special_tokens=False, return_offsets_mapping=True, verbose=False)
+    return encodings['offset_mapping']
+
+
+def join_lines(lines):
+    """
+    Joins lines, a list of (text, token offsets), with newlines, returning
+    the text and its token offsets.
+    """
+    texts = []
+    offsets = []
+    position = 0
+    for text, line_offsets in lines:
+        if texts:
+            offsets.append((position, position + 1))
+            position += 1
+        texts.append(text)
+        offsets.extend((start + position, end + position) for start, end in line_offsets)
+        position += len(text)
+    return "\n".join(texts), offsets
+
+
+def make_chunky_sentences(text: str, offsets=None):
+    """
+    Splits text into pieces of at most MAX_CHUNK_SIZE tokens, at the end of a
+    sentence where possible. Returns a list of (text, token_count).
+
+    offsets are the token offsets of text, if they're already known.
+    """
+    if offsets is None:
+        offsets = get_token_offsets([text])[0]
+    ends = [end for _, end in offsets]
+    result = []
+    start_token = 0
+    start = 0
+    while len(offsets) - start_token > MAX_CHUNK_SIZE:
+        window_end = offsets[start_token + MAX_CHUNK_SIZE - 1][1]
+        split_index = text.rfind(".", start, window_end)
         if split_index == -1:
-            result.append(text)
             break
-        result.append(text[:split_index + 1])
-        text = text[split_index + 1:].strip(" ")
-    if len(result) > 0 and len(text) < MEH_SIZE:
+        result.append(text[start:split_index + 1])
+        start = split_index + 1
+        while start < len(text) and text[start] == " ":
+            start += 1
+        start_token = bisect_right(ends, start)
+    text = text[start:]
+    if len(result) > 0 and len(offsets) - start_token < MEH_SIZE:
         result[-1] += text
     else:
         result.append(text)
-    return result
+    # Only pieces of oversized text get here, and splitting can change how
+    # the tokens either side of the split are merged, so count them again.
+    return list(zip(result, ask_embeddings.get_token_counts(result)))
 
 
-def create_chunks(sections):
+def create_chunks(sections, cleaned=False):
+    """
+    Yields (count, text, token_count) of chunks made from the lines of each
+    of sections. Set cleaned if the lines have already been through
+    get_clean_text().
+    """
     count = 0
     buffer = []
     buffer_size = 0
     for section in sections:
-        for line in section:
-            text = get_clean_text(line)
-            # Skip empty lines.
-            if not text:
-                continue
-            text_size = len(text)
-            buffer.append(text)
+        texts = section if cleaned else get_clean_texts(section)
+        # Skip empty lines.
+        texts = [text for text in texts if text]
+        for text, offsets in zip(texts, get_token_offsets(texts)):
+            text_size = len(offsets)
+            if buffer:
+                buffer_size += NEWLINE_TOKEN_COUNT
+            buffer.append((text, offsets))
             buffer_size += text_size
             # If too small, continue accumulating
             if (buffer_size) < GOLDIELOCKS["min"]:
                 continue
             # If too large, split up in multiple chunks
             if (buffer_size) > GOLDIELOCKS["max"]:
-                chunks = make_chunky_sentences("\n".join(buffer))
-                for chunk in chunks:
+                chunks = make_chunky_sentences(*join_lines(buffer))
+                for chunk, token_count in chunks:
                     count += 1
-                    yield (count, chunk)
-                    buffer = []
-                    buffer_size = 0
+                    yield (count, chunk, token_count)
+                buffer = []
+                buffer_size = 0
                 continue
             # If just right, yield it
             count += 1
-            yield (count, "\n".join(buffer))
+            yield (count, "\n".join(text for text, _ in buffer), buffer_size)
             buffer = []
             buffer_size = 0
         # Yield the last buffer
         if buffer:
             count += 1
-            yield (count, "\n".join(buffer))
+            yield (count, "\n".join(text for text, _ in buffer), buffer_size)
             buffer = []
             buffer_size = 0
 
 
-def generate_chunks(pages):
+def generate_chunks(pages, processes=CLEAN_PROCESSES, cleaned=False):
     """
     Main entry point for the Chunker.
 
@@ -110,17 +216,32 @@ def generate_chunks(pages):
     Returns chunks that can be used as output of the Importer.get_chunks
 
     Arguments:
-        pages -- Object that is an output of one of the importers.
+        pages -- Object that is an output of one of the importers, or an
+        iterable of its (page_id, page) items, e.g. streamed as each page is
+        parsed.
+        processes -- The number of processes to clean the lines of all the
+        pages in, up front, if pages is a dict. None for one per CPU.
+        cleaned -- Whether the lines of the pages have already been through
+        get_clean_text().
     """
-    for page_id, page in pages.items():
+    if isinstance(pages, dict) and not cleaned:
+        lines = [line for page in pages.values() for section in page["sections"] for line in section]
+        clean_lines = iter(get_clean_texts(lines, processes))
+        pages = {page_id: dict(page, sections=[[next(clean_lines) for _ in section] for section in page["sections"]])
+                 for page_id, page in pages.items()}
+        cleaned = True
+    if isinstance(pages, dict):
+        pages = pages.items()
+    for page_id, page in pages:
         sections = page["sections"]
         print(
             f"Processing {page['info']['url']} with {len(sections)} sections ...")
-        for chunk_id, chunk in create_chunks(sections):
+        for chunk_id, chunk, token_count in create_chunks(sections, cleaned=cleaned):
             yield (
                 f"{page_id}-{chunk_id}",
                 {
                     "text": chunk,
+                    "token_count": token_count,
                     "info": page["info"]
                 }
             )
@@ -141,7 +262,7 @@ if __name__ == "__main__":
     chunks = {
         "version": 0,
         "embedding_model": 'openai.com:text-embedding-ada-002',
-        "omit": 'embedding,token_count,similarity',
+        "omit": 'embedding,similarity',
         "content": content
     }
     print(f"Writing output to {args.output} ...")
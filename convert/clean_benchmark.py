@@ -0,0 +1,76 @@
+import argparse
+import glob
+import sys
+import time
+
+from bs4 import BeautifulSoup
+from cleantext import clean
+
+from .chunker import CLEAN_ARGUMENTS, get_clean_texts
+from .medium import MediumImporter
+from .substack import get_sections
+
+# Compares the chunker's get_clean_texts with calling clean-text's clean() on
+# each line, which is what the chunker used to do, on the lines of real
+# Substack and Medium exports. Exits with an error if they clean any line
+# differently.
+
+
+def substack_lines(path):
+    lines = []
+    for filename in glob.glob(f"{path}/posts/*.html"):
+        for section in get_sections(filename, []):
+            lines.extend(section)
+    return lines
+
+
+def medium_lines(path):
+    importer = MediumImporter()
+    lines = []
+    for filename in glob.glob(f"{path}/posts/*.html"):
+        with open(filename, 'r') as f:
+            soup = BeautifulSoup(f, "html.parser")
+        if soup.find('section', class_='e-content'):
+            lines.extend(importer.extract_chunks_from_soup(soup))
+    return lines
+
+
+def time_it(function):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--substack', action='append', default=[],
+                        help='Path to the root of a Substack export. Can be given more than once')
+    parser.add_argument('--medium', action='append', default=[],
+                        help='Path to the root of a Medium export. Can be given more than once')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='The number of processes for the parallel run. Defaults to one per CPU')
+    args = parser.parse_args()
+
+    lines = []
+    for path in args.substack:
+        lines.extend(substack_lines(path))
+    for path in args.medium:
+        lines.extend(medium_lines(path))
+    if not lines:
+        parser.error('No lines found, pass at least one --substack or --medium export')
+    ascii_count = sum(1 for line in lines if line.isascii())
+    print(f'{len(lines)} lines, {sum(len(line) for line in lines)} characters, {ascii_count / len(lines):.0%} ASCII')
+
+    expected, clean_seconds = time_it(lambda: [clean(line, **CLEAN_ARGUMENTS) for line in lines])
+    print(f'clean() per line: {clean_seconds:.2f}s')
+    failed = False
+    for name, processes in [('get_clean_texts', 0), ('get_clean_texts in parallel', args.processes)]:
+        result, seconds = time_it(lambda: get_clean_texts(lines, processes))
+        print(f'{name}: {seconds:.2f}s ({clean_seconds / seconds:.1f}x)')
+        differences = [index for index, (a, b) in enumerate(zip(result, expected)) if a != b]
+        if differences:
+            index = differences[0]
+            print(f'{name} cleaned {len(differences)} lines differently, e.g. {lines[index]!r} to {result[index]!r} rather than {expected[index]!r}')
+            failed = True
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,96 @@
+import argparse
+import base64
+import hashlib
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import ask_embeddings
+
+# A stand-in for the OpenAI embeddings endpoint, for trying out imports and
+# EmbeddingClient settings without an API key or spending money. Start it, then
+# run e.g. convert.main with OPENAI_API_BASE=http://127.0.0.1:<port>/v1 and any
+# OPENAI_API_KEY in the environment.
+#
+# Each text gets a random unit vector that is the same every time for the same
+# text. The stand-in can also be slow, and fail some requests with rate limit
+# or server errors, to see how the client copes.
+
+
+def embedding_for(text):
+    seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+    vector = np.random.default_rng(seed).normal(
+        size=ask_embeddings.EXPECTED_EMBEDDING_LENGTH[ask_embeddings.EMBEDDINGS_MODEL_ID]).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class EmbeddingHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if not self.path.endswith('/embeddings'):
+            self.send_json(404, {'error': {'message': f'Unknown path {self.path}', 'type': 'invalid_request_error'}})
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        texts = body.get('input', [])
+        if isinstance(texts, str):
+            texts = [texts]
+        args = self.server.args
+        time.sleep(args.latency + args.latency_per_text * len(texts))
+        failure = random.random()
+        if failure < args.rate_limit_rate:
+            self.send_json(429, {'error': {'message': 'Rate limit reached (stand-in)', 'type': 'requests'}},
+                           {'Retry-After': str(args.retry_after)})
+            return
+        if failure < args.rate_limit_rate + args.error_rate:
+            self.send_json(500, {'error': {'message': 'The server had an error (stand-in)', 'type': 'server_error'}})
+            return
+        data = []
+        for index, text in enumerate(texts):
+            embedding = embedding_for(text)
+            if body.get('encoding_format') == 'base64':
+                embedding = base64.b64encode(embedding.tobytes()).decode('ascii')
+            else:
+                embedding = embedding.tolist()
+            data.append({'object': 'embedding', 'index': index, 'embedding': embedding})
+        self.send_json(200, {'object': 'list', 'data': data, 'model': body.get('model'),
+                             'usage': {'prompt_tokens': 0, 'total_tokens': 0}})
+
+    def send_json(self, status, body, headers=None):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        if self.server.args.verbose:
+            super().log_message(format, *args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--port', help='Number of the port to run the stand-in on (8081 by default).', default=8081, type=int)
+    parser.add_argument(
+        '--latency', help='Seconds to wait before responding to each request', default=0.2, type=float)
+    parser.add_argument(
+        '--latency-per-text', help='Additional seconds to wait per text in a request', default=0.001, type=float)
+    parser.add_argument(
+        '--rate-limit-rate', help='The fraction of requests to fail with a rate limit error', default=0.0, type=float)
+    parser.add_argument(
+        '--retry-after', help='The Retry-After header of rate limit errors, in seconds', default=1, type=float)
+    parser.add_argument(
+        '--error-rate', help='The fraction of requests to fail with a server error', default=0.0, type=float)
+    parser.add_argument('--verbose', action='store_true',
+                        help='If set, will log each request')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), EmbeddingHandler)
+    server.args = args
+    print(f'Serving stand-in embeddings at http://127.0.0.1:{args.port}/v1')
+    server.serve_forever()
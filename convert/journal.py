@@ -0,0 +1,96 @@
+import json
+import os
+
+import ask_embeddings
+
+# convert.main only saves the library once every chunk has been processed, so
+# it also appends each batch of finished chunks, embeddings and all, to a
+# journal next to the output. If the import is interrupted, the next run with
+# the same output replays the journal first and so only processes the chunks
+# that hadn't been finished yet. The journal is removed once the library is
+# saved.
+
+JOURNAL_EXTENSION = '.journal'
+
+
+def journal_filename(output_filename):
+    return output_filename + JOURNAL_EXTENSION
+
+
+class ImportJournal:
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = None
+
+
+    def replay(self):
+        """
+        Returns a dict of chunk id to chunk of every chunk in the journal, with
+        embeddings base64 encoded. A partially written last record, from an
+        import that died while writing it, is ignored.
+        """
+        chunks = {}
+        if not os.path.exists(self.filename):
+            return chunks
+        with open(self.filename, 'r') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if record.get('embedding_model') != ask_embeddings.EMBEDDINGS_MODEL_ID:
+                    continue
+                chunks.update(record['content'])
+        return chunks
+
+
+    def append(self, chunks):
+        """
+        Appends chunks, a dict of chunk id to chunk, as one record, and makes
+        sure it's on disk before returning.
+        """
+        if not chunks:
+            return
+        if self._file is None:
+            directory = os.path.dirname(self.filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(self.filename, 'a+b')
+            self._truncate_partial_record()
+        content = {}
+        for id, chunk in chunks.items():
+            content[id] = {field: value for field, value in chunk.items() if field != 'embedding'}
+            if 'embedding' in chunk:
+                content[id]['embedding'] = ask_embeddings.base64_from_vector(chunk['embedding']).decode('ascii')
+        record = {'embedding_model': ask_embeddings.EMBEDDINGS_MODEL_ID, 'content': content}
+        self._file.write((json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8'))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+
+    def _truncate_partial_record(self):
+        # Drop a partially written last record so the next one starts on its
+        # own line.
+        size = self._file.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(0, end - 65536)
+            self._file.seek(start)
+            block = self._file.read(end - start)
+            newline = block.rfind(b'\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end != size:
+            self._file.truncate(end)
+
+
+    def remove(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
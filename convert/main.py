@@ -1,14 +1,17 @@
 import argparse
 import os
 import re
+from time import time
 
 import openai
 from dotenv import load_dotenv
 
 import ask_embeddings
 
+from .journal import ImportJournal, journal_filename
 from .medium import MediumImporter
 from .nakedlibrary import NakedLibraryImporter
+from .sources import manifest_key, source_entry, unchanged_entry
 from .substack import SubstackImporter
 
 IMPORTERS = {
@@ -17,6 +20,13 @@ IMPORTERS = {
     'medium': MediumImporter()
 }
 
+# How many new chunks to collect before fetching their embeddings and counting
+# their tokens together. Enough to keep several embedding requests in flight.
+CHUNK_BATCH_SIZE = 1000
+# The most seconds to go without processing the chunks collected so far, so
+# that a slow import still reaches its journal regularly.
+CHECKPOINT_SECONDS = 60
+
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
@@ -48,6 +58,14 @@ parser.add_argument('--overwrite', action='store_true',
                     help='If set, will ignore any existing output and overwrite it instead of incrementally extending it')
 parser.add_argument('--truncate', action='store_true',
                     help='If set, will only persist things to output from base that also had their ID in input')
+parser.add_argument('--full', action='store_true',
+                    help='If set, will parse every file of the input again, even the ones that haven\'t changed since the last import')
+parser.add_argument('--compact', action='store_true',
+                    help='If set, will write JSON output without indentation, which is smaller and faster to write')
+parser.add_argument('--restart', action='store_true',
+                    help='If set, will discard the journal of an interrupted import to the same output instead of resuming from it')
+parser.add_argument(
+    '--embedding-cache', help=f'The file to cache embeddings in, which can be shared by any number of libraries. Set to an empty string to not cache them. Defaults to {ask_embeddings.EMBEDDING_CACHE_FILE}', default=ask_embeddings.EMBEDDING_CACHE_FILE)
 for importer in IMPORTERS.values():
     if 'install_arguments' in dir(importer):
         importer.install_arguments(parser)
@@ -59,6 +77,10 @@ overwrite = args.overwrite
 output_filename = args.output
 base_filename = args.base
 truncate = args.truncate
+embedding_cache_filename = args.embedding_cache
+restart = args.restart
+compact = args.compact
+full = args.full
 
 importer = IMPORTERS[args.importer]
 
@@ -81,39 +103,175 @@ if not overwrite and os.path.exists(base_filename):
         f'Found {full_output_filename}, loading it as a base to incrementally extend.')
     result = ask_embeddings.Library(filename=base_filename)
 
+journal = ImportJournal(journal_filename(full_output_filename))
+if restart:
+    journal.remove()
+journaled_chunks = journal.replay()
+if journaled_chunks:
+    print(f'Resuming an interrupted import from the {len(journaled_chunks)} chunks in {journal.filename}')
+    for id, chunk in journaled_chunks.items():
+        result.set_chunk(id, chunk)
+
 print('Will process ' + ('all' if max_lines < 0 else str(max_lines)) + ' lines')
 
+
+embedding_cache = None
+if embedding_cache_filename:
+    embedding_cache = ask_embeddings.EmbeddingCache(embedding_cache_filename)
+embedding_client = ask_embeddings.EmbeddingClient(cache=embedding_cache)
+
+
+def add_chunks(chunks):
+    """
+    Fills in the embedding and token_count of each of chunks, a dict of id to
+    chunk, that doesn't have them, and adds them to the result and the
+    journal. The token counts are counted in one batch, and the embeddings
+    fetched in as few requests as possible.
+    """
+    texts = {id: strip_emoji(chunk.get('text', '')) for id, chunk in chunks.items()}
+    uncounted_ids = [id for id, chunk in chunks.items() if 'token_count' not in chunk]
+    if uncounted_ids:
+        print(f'Counting tokens for {len(uncounted_ids)} chunks')
+        token_counts = ask_embeddings.get_token_counts(
+            [texts[id] for id in uncounted_ids])
+        for id, token_count in zip(uncounted_ids, token_counts):
+            chunks[id]['token_count'] = token_count
+    unembedded_ids = [id for id, chunk in chunks.items() if 'embedding' not in chunk]
+    if unembedded_ids:
+        print(f'Fetching embeddings for {len(unembedded_ids)} chunks')
+        embeddings = embedding_client.get_embeddings(
+            [texts[id] for id in unembedded_ids], [chunks[id]['token_count'] for id in unembedded_ids])
+        for id, embedding in zip(unembedded_ids, embeddings):
+            chunks[id]['embedding'] = embedding
+        print(embedding_client.report())
+    for id, chunk in chunks.items():
+        result.set_chunk(id, chunk)
+    journal.append(chunks)
+
+
+# Importers that can say which file each chunk came from are only asked for
+# the chunks of the files that changed since the import the result was
+# based on. See sources.py.
+incremental = 'get_source_chunks' in dir(importer)
+previous_manifest = result.import_manifest
+import_manifest = {}
+changed_source_filenames = []
+source_chunk_ids = {}
+
 count = 0
 
 seen_ids = {}
 
-for id, chunk in importer.get_chunks(filename):
+new_chunks = {}
+
+modified = bool(journaled_chunks)
+
+last_checkpoint = time()
+
+
+def get_chunks():
+    """
+    Yields (source_filename, id, chunk) of the chunks to import, with a
+    source_filename of None if the importer doesn't say.
+    """
+    if not incremental:
+        for id, chunk in importer.get_chunks(filename):
+            yield (None, id, chunk)
+        return
+    source_filenames = importer.source_filenames(filename)
+    for source_filename in source_filenames:
+        key = manifest_key(filename, source_filename)
+        entry = None if full else unchanged_entry(previous_manifest.get(key), source_filename)
+        if entry is None:
+            changed_source_filenames.append(source_filename)
+            continue
+        import_manifest[key] = entry
+        for id in entry['chunk_ids']:
+            seen_ids[id] = True
+    print(f'{len(changed_source_filenames)} of {len(source_filenames)} files changed since the last import')
+    yield from importer.get_source_chunks(filename, changed_source_filenames)
+
+
+completed = True
+
+for source_filename, id, chunk in get_chunks():
     seen_ids[id] = True
     if max_lines >= 0 and count >= max_lines:
         print('Reached max lines')
+        completed = False
         break
-    if result.chunk(id):
+    if source_filename is not None:
+        source_chunk_ids.setdefault(source_filename, []).append(id)
+    existing_chunk = result.chunk(id)
+    if existing_chunk and source_filename is not None and existing_chunk.get('text') != chunk.get('text'):
+        # The file changed, and so did this chunk's text.
+        existing_chunk = None
+    if existing_chunk or id in new_chunks:
+        if existing_chunk and source_filename is not None and existing_chunk.get('info') != chunk.get('info'):
+            result.set_chunk_field(id, info=chunk.get('info'))
+            modified = True
         continue
     print(f'Processing new chunk {id} ({count + 1})')
-    text = strip_emoji(chunk.get('text', ''))
-    if 'embedding' not in chunk:
-        print(f'Fetching embedding for {id}')
-        chunk['embedding'] = ask_embeddings.get_embedding(text)
-    if 'token_count' not in chunk:
-        print(f'Fetching token_count for {id}')
-        chunk['token_count'] = ask_embeddings.get_token_count(text)
-    result.set_chunk(id, chunk)
+    new_chunks[id] = chunk
     count += 1
+    modified = True
+    if len(new_chunks) >= CHUNK_BATCH_SIZE or time() - last_checkpoint >= CHECKPOINT_SECONDS:
+        add_chunks(new_chunks)
+        new_chunks = {}
+        last_checkpoint = time()
+
+add_chunks(new_chunks)
 
 print(f'Loaded {count} new lines')
 
+if incremental:
+    for source_filename in changed_source_filenames:
+        key = manifest_key(filename, source_filename)
+        previous_entry = previous_manifest.get(key)
+        if not completed:
+            # Not every chunk of the changed files was processed, so leave
+            # them to be processed again next time.
+            if previous_entry:
+                import_manifest[key] = previous_entry
+            continue
+        chunk_ids = source_chunk_ids.get(source_filename, [])
+        # Delete the chunks the file no longer produces.
+        for chunk_id in set(previous_entry['chunk_ids'] if previous_entry else []) - set(chunk_ids):
+            if result.chunk(chunk_id) and chunk_id not in seen_ids:
+                result.delete_chunk(chunk_id)
+                modified = True
+        import_manifest[key] = source_entry(source_filename, chunk_ids)
+    for key, previous_entry in previous_manifest.items():
+        if key in import_manifest:
+            continue
+        if completed and not os.path.exists(os.path.join(filename, key)):
+            # The file was deleted, so delete its chunks, unless another
+            # file produces them now.
+            for chunk_id in previous_entry['chunk_ids']:
+                if result.chunk(chunk_id) and chunk_id not in seen_ids:
+                    result.delete_chunk(chunk_id)
+                    modified = True
+            continue
+        # The file is still there but wasn't imported this time, e.g.
+        # because of --max, or the import stopped early. Keep its entry so
+        # its chunks are still accounted for.
+        import_manifest[key] = previous_entry
+    if import_manifest != previous_manifest:
+        result.import_manifest = import_manifest
+        modified = True
+
 if truncate:
     for chunk_id in [id for id in result.chunk_ids]:
         if chunk_id in seen_ids:
             continue
         result.delete_chunk(chunk_id)
+        modified = True
 
 if not os.path.exists(ask_embeddings.LIBRARY_DIR):
     os.mkdir(ask_embeddings.LIBRARY_DIR)
 
-result.save(full_output_filename)
+if not modified and not overwrite and base_filename == full_output_filename and os.path.exists(full_output_filename):
+    print(f'Nothing changed, leaving {full_output_filename} as it is')
+else:
+    result.save(full_output_filename, indent=None if compact else '\t')
+journal.remove()
@@ -2,6 +2,7 @@ import glob
 import os
 from bs4 import BeautifulSoup
 from argparse import (ArgumentParser, Namespace)
+from .parsing import HTML_PARSER, parse_in_parallel
 
 
 class MediumImporter:
@@ -32,7 +33,7 @@ class MediumImporter:
     def output_base_filename(self, filename):
         profile_path = f"{filename}/profile/profile.html"
         with open(profile_path, "r") as f:
-            soup = BeautifulSoup(f, "html.parser")
+            soup = BeautifulSoup(f, HTML_PARSER)
             ele = soup.find('a', class_='u-url')
             username = ele.get_text(strip=True)
             return 'medium-' + username.replace('@','') + '-' + self._include
@@ -79,35 +80,57 @@ class MediumImporter:
         return [item for item in text if len(item) > 50]
 
 
+    def source_filenames(self, filename):
+        filenames = []
+        for file in glob.glob(f"{filename}/posts/*.html"):
+            base_filename = os.path.basename(file)
+            if base_filename.startswith('draft_'):
+                if self._include == 'published':
+                    print('Skipping draft ' + base_filename)
+                    continue
+            else:
+                if self._include == 'drafts':
+                    print('Skipping published post' + base_filename)
+                    continue
+            filenames.append(file)
+        return filenames
+
+
     def get_chunks(self, filename):
-        filenames = glob.glob(f"{filename}/posts/*.html")
-        for file in filenames:
-            with open(file, 'r') as f:
-                base_filename = os.path.basename(file)
-                if base_filename.startswith('draft_'):
-                    if self._include == 'published':
-                        print('Skipping draft ' + base_filename)
-                        continue
-                else:
-                    if self._include == 'drafts':
-                        print('Skipping published post' + base_filename)
-                        continue
-                soup = BeautifulSoup(f, "html.parser")
-                url = self.extract_url_from_soup(base_filename, soup)
-                image_url = self.extract_image_url_from_soup(soup)
-                title = self.extract_title_from_soup(soup)
-                description = self.extract_description_from_soup(soup)
-                slug = self.extract_slug_from_filename(base_filename)
-                info = {
-                    'url': url,
-                    'image_url': image_url,
-                    'title': title,
-                    'description': description
-                }
-                count = 0
-                for chunk in self.extract_chunks_from_soup(soup):
-                    yield (f"{slug}_{count}", {
-                        "text": chunk,
-                        "info": info
-                    })
-                    count += 1
+        for _, id, chunk in self.get_source_chunks(filename, self.source_filenames(filename)):
+            yield (id, chunk)
+
+
+    def get_source_chunks(self, filename, source_filenames):
+        # Posts are parsed across processes, and each one's chunks yielded as
+        # soon as it's parsed.
+        posts = parse_in_parallel(self.parse_post, source_filenames)
+        for source_filename, (slug, info, chunks) in zip(source_filenames, posts):
+            count = 0
+            for chunk in chunks:
+                yield (source_filename, f"{slug}_{count}", {
+                    "text": chunk,
+                    "info": info
+                })
+                count += 1
+
+
+    def parse_post(self, filename):
+        """
+        Returns the slug, info and chunks of the post in filename.
+        """
+        base_filename = os.path.basename(filename)
+        with open(filename, 'r') as f:
+            soup = BeautifulSoup(f, HTML_PARSER)
+        url = self.extract_url_from_soup(base_filename, soup)
+        image_url = self.extract_image_url_from_soup(soup)
+        title = self.extract_title_from_soup(soup)
+        description = self.extract_description_from_soup(soup)
+        slug = self.extract_slug_from_filename(base_filename)
+        info = {
+            'url': url,
+            'image_url': image_url,
+            'title': title,
+            'description': description
+        }
+        return (slug, info, self.extract_chunks_from_soup(soup))
@@ -1,25 +1,312 @@
-from time import sleep
+import codecs
+import json
+import os
+import random
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from itertools import islice
+from time import monotonic, sleep, time
+
 import urllib3
-from bs4 import BeautifulSoup
-
-def request_data(url):
-    http = urllib3.PoolManager()
-    html = http.request('GET', url).data
-    soup = BeautifulSoup(html, "html.parser")
-    og_data = {}
-    for meta in soup.find_all("meta"):
-        if "property" in meta.attrs and meta.attrs["property"].startswith("og:"):
-            og_data[meta.attrs["property"]] = meta.attrs["content"]
-    return og_data
+
+# Fetches the Open Graph metadata (the <meta property="og:..."> tags) of web
+# pages, e.g. the title, description and image of each Substack post.
+#
+# Sites rate limit crawlers, so requests share one connection pool, run a few
+# at a time, and are spaced out by a token bucket. Results are cached on disk
+# by URL, so re-running an import doesn't fetch them again. Once cached
+# metadata is older than OG_CACHE_MAX_AGE it is revalidated with the page's
+# ETag and Last-Modified, which usually just gets a 304 back.
+
+OG_CACHE_FILE = os.getenv('OG_CACHE_FILE', 'cache/og.sqlite')
+OG_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
+OG_CONCURRENCY = 4
+# The average requests per second, and how many can be made at once after
+# being idle.
+OG_REQUESTS_PER_SECOND = 2
+OG_BURST = 4
+OG_TIMEOUT_SECONDS = 30
+OG_MAX_RETRIES = 5
+OG_MAX_REDIRECTS = 5
+OG_RETRY_BASE_SECONDS = 2
+OG_RETRY_MAX_SECONDS = 60
+# Only this much of a page is read looking for the end of its <head>.
+OG_MAX_HEAD_BYTES = 1024 * 1024
+
+RETRY_STATUSES = set([429, 500, 502, 503, 504])
+
+
+class TokenBucket:
+    """
+    Lets callers of acquire() through at rate per second on average, and up
+    to capacity at once after being idle.
+    """
+
+    def __init__(self, rate=OG_REQUESTS_PER_SECOND, capacity=OG_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            sleep(wait)
+
+
+    def pause(self, seconds):
+        """
+        Holds every caller of acquire() back for at least seconds, e.g. when
+        the site says it's being asked too often.
+        """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+
+class OGCache:
+    """
+    A persistent cache of the Open Graph metadata of URLs, along with the
+    ETag and Last-Modified they were served with. It's an SQLite database,
+    so several imports can share it.
+    """
+
+    def __init__(self, filename=OG_CACHE_FILE):
+        self.filename = filename
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(filename, timeout=60, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS og (url TEXT PRIMARY KEY, og_data TEXT NOT NULL, etag TEXT, last_modified TEXT, fetched_at REAL NOT NULL)')
+
+
+    def get(self, url):
+        """
+        Returns (og_data, etag, last_modified, fetched_at) of url, or None if
+        it isn't cached.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT og_data, etag, last_modified, fetched_at FROM og WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        return (json.loads(row[0]),) + tuple(row[1:])
+
+
+    def put(self, url, og_data, etag=None, last_modified=None):
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO og (url, og_data, etag, last_modified, fetched_at) VALUES (?, ?, ?, ?, ?)',
+                                     (url, json.dumps(og_data), etag, last_modified, time()))
+
+
+    def touch(self, url):
+        with self._lock:
+            self._connection.execute('UPDATE og SET fetched_at = ? WHERE url = ?', (time(), url))
+
+
+class OGParser(HTMLParser):
+    """
+    Collects the og: meta tags of a page, and notes when its <head> is over
+    so that the rest of the page doesn't need to be read.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.og_data = {}
+        self.done = False
+
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'body':
+            self.done = True
+            return
+        if tag != 'meta':
+            return
+        attrs = dict(attrs)
+        property = attrs.get('property') or ''
+        if property.startswith('og:') and attrs.get('content') is not None:
+            self.og_data[property] = attrs['content']
+
+
+    def handle_endtag(self, tag):
+        if tag == 'head':
+            self.done = True
+
+
+class OGFetcher:
+    """
+    Fetches the Open Graph metadata of URLs with up to concurrency requests
+    at once, at most rate a second, retrying failures up to max_retries
+    times with exponential backoff.
+    """
+
+    def __init__(self, concurrency=OG_CONCURRENCY, rate=OG_REQUESTS_PER_SECOND, burst=OG_BURST,
+                 max_retries=OG_MAX_RETRIES, cache=None, max_age=OG_CACHE_MAX_AGE):
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.cache = cache
+        self.max_age = max_age
+        self._bucket = TokenBucket(rate, burst)
+        # Failures are retried by get(), but redirects, e.g. from a post's old
+        # slug, are followed here.
+        self._http = urllib3.PoolManager(maxsize=concurrency, block=True,
+                                         timeout=urllib3.Timeout(total=OG_TIMEOUT_SECONDS),
+                                         retries=urllib3.Retry(total=None, connect=0, read=0, status=0, other=0,
+                                                               redirect=OG_MAX_REDIRECTS))
+
+
+    def get(self, url):
+        """
+        Returns the og: properties of the page at url, or an empty dict if it
+        doesn't have any or couldn't be fetched.
+        """
+        cached = self.cache.get(url) if self.cache is not None else None
+        if cached is not None and time() - cached[3] < self.max_age:
+            return cached[0]
+        headers = {}
+        if cached is not None:
+            if cached[1]:
+                headers['If-None-Match'] = cached[1]
+            if cached[2]:
+                headers['If-Modified-Since'] = cached[2]
+        for attempt in range(self.max_retries + 1):
+            self._bucket.acquire()
+            retry_after = 0
+            try:
+                status, response_headers, og_data = self._request(url, headers)
+            except urllib3.exceptions.HTTPError as e:
+                problem = str(e)
+            else:
+                if status == 304 and cached is not None:
+                    self.cache.touch(url)
+                    return cached[0]
+                if status == 200 and og_data:
+                    if self.cache is not None:
+                        self.cache.put(url, og_data, response_headers.get('ETag'), response_headers.get('Last-Modified'))
+                    return og_data
+                if status == 200:
+                    # Substack sometimes serves a page without its metadata
+                    # when it's being asked too often.
+                    problem = 'no og: metadata'
+                elif status in RETRY_STATUSES:
+                    problem = f'status {status}'
+                    try:
+                        retry_after = float(response_headers.get('Retry-After'))
+                    except (TypeError, ValueError):
+                        pass
+                    if status == 429:
+                        self._bucket.pause(retry_after)
+                else:
+                    print(f'Could not fetch {url}: status {status}')
+                    return {}
+            if attempt == self.max_retries:
+                break
+            delay = min(OG_RETRY_BASE_SECONDS * 2 ** attempt, OG_RETRY_MAX_SECONDS)
+            # Wait a random half to all of the delay, so that requests that
+            # failed together don't all retry at the same moment.
+            delay = max(delay / 2 + random.uniform(0, delay / 2), retry_after)
+            print(f'Got {problem} for {url}. Retrying in {delay:.1f}s ...')
+            sleep(delay)
+        print(f'Giving up on {url} after {self.max_retries + 1} attempts: {problem}')
+        return cached[0] if cached is not None else {}
+
+
+    def get_many(self, urls):
+        """
+        Yields get(url) for each of urls, in order, as soon as each is ready,
+        fetching up to concurrency of them at once.
+        """
+        urls = iter(urls)
+        executor = ThreadPoolExecutor(self.concurrency)
+        try:
+            futures = deque(executor.submit(self.get, url) for url in islice(urls, self.concurrency * 2))
+            while futures:
+                result = futures.popleft().result()
+                for url in islice(urls, 1):
+                    futures.append(executor.submit(self.get, url))
+                yield result
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+
+    def _request(self, url, headers):
+        """
+        Returns the status, headers and og: metadata of url, reading only as
+        much of the page as it takes to get through its <head>.
+        """
+        response = self._http.request('GET', url, headers=headers, preload_content=False)
+        try:
+            parser = OGParser()
+            if response.status == 200:
+                charset = 'utf-8'
+                content_type = response.headers.get('Content-Type', '')
+                if 'charset=' in content_type:
+                    charset = content_type.split('charset=')[-1].split(';')[0].strip().strip('"')
+                try:
+                    decoder = codecs.getincrementaldecoder(charset)(errors='replace')
+                except LookupError:
+                    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+                read_bytes = 0
+                for data in response.stream(16384):
+                    parser.feed(decoder.decode(data))
+                    read_bytes += len(data)
+                    if parser.done or read_bytes >= OG_MAX_HEAD_BYTES:
+                        break
+            return response.status, response.headers, parser.og_data
+        finally:
+            # Drop the connection rather than read the rest of a page that
+            # was only partly read.
+            if not response.isclosed():
+                response.close()
+            response.release_conn()
+
+
+_default_fetcher = None
+_default_fetcher_lock = threading.Lock()
+
+
+def default_og_fetcher():
+    """
+    Returns the OGFetcher shared by everything in the process, caching in
+    OG_CACHE_FILE unless it's empty or can't be opened.
+    """
+    global _default_fetcher
+    with _default_fetcher_lock:
+        if _default_fetcher is None:
+            cache = None
+            if OG_CACHE_FILE:
+                try:
+                    cache = OGCache(OG_CACHE_FILE)
+                except (OSError, sqlite3.Error) as e:
+                    print(f'Could not open the Open Graph cache at {OG_CACHE_FILE}: {e}')
+            _default_fetcher = OGFetcher(cache=cache)
+    return _default_fetcher
+
 
 def get_og_data(url):
-    while True:
-        og_data = request_data(url)
-        if og_data:
-            break
-        print("Got empty response. Retrying in 20 seconds ...")
-        sleep(20)
-    return og_data
+    return default_og_fetcher().get(url)
+
 
 if __name__ == "__main__":
     og_data = get_og_data(
@@ -0,0 +1,101 @@
+import argparse
+import hashlib
+import random
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A stand-in for a site like Substack, for trying out the Open Graph fetcher
+# in convert/og.py without hitting a real site. Every path is a page with
+# og: metadata made from the path, and the same ETag and Last-Modified every
+# time, so conditional requests get a 304. The stand-in can also be slow, and
+# fail some requests with rate limit or server errors, or with a page missing
+# its metadata, to see how the fetcher copes. Paths under /moved/ are
+# permanently redirected to the same path without /moved, like a post whose
+# slug was changed.
+#
+# Point a Substack export's config.json substack_url at
+# http://127.0.0.1:<port> to import it against the stand-in.
+
+LAST_MODIFIED = formatdate(0, usegmt=True)
+MOVED_PREFIX = '/moved/'
+
+
+def page_for(path, body_bytes=0, og=True):
+    head = f'<title>{path}</title>'
+    if og:
+        head += (f'<meta property="og:title" content="Title of {path}">'
+                 f'<meta property="og:description" content="Description of {path}">'
+                 f'<meta property="og:image" content="https://example.com{path}.png">')
+    return f'<!DOCTYPE html><html><head>{head}</head><body>{"x" * body_bytes}</body></html>'.encode('utf-8')
+
+
+class OGHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        args = self.server.args
+        self.server.request_count += 1
+        time.sleep(args.latency)
+        failure = random.random()
+        if failure < args.rate_limit_rate:
+            self.send_page(429, b'Too many requests', {'Retry-After': str(args.retry_after)})
+            return
+        failure -= args.rate_limit_rate
+        if failure < args.error_rate:
+            self.send_page(500, b'Server error')
+            return
+        failure -= args.error_rate
+        if self.path.startswith(MOVED_PREFIX):
+            self.send_page(301, b'', {'Location': self.path[len(MOVED_PREFIX) - 1:]})
+            return
+        etag = '"' + hashlib.sha256(self.path.encode('utf-8')).hexdigest()[:16] + '"'
+        headers = {'ETag': etag, 'Last-Modified': LAST_MODIFIED}
+        if self.headers.get('If-None-Match') == etag:
+            self.send_page(304, b'', headers)
+            return
+        self.send_page(200, page_for(self.path, args.body_bytes, og=failure >= args.empty_rate), headers)
+
+    def send_page(self, status, content, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        try:
+            self.wfile.write(content)
+        except (BrokenPipeError, ConnectionResetError):
+            # The fetcher hangs up once it has read the <head>.
+            pass
+
+    def log_message(self, format, *args):
+        if self.server.args.verbose:
+            super().log_message(format, *args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--port', help='Number of the port to run the stand-in on (8082 by default).', default=8082, type=int)
+    parser.add_argument(
+        '--latency', help='Seconds to wait before responding to each request', default=0.1, type=float)
+    parser.add_argument(
+        '--body-bytes', help='The size of the body of each page, which the fetcher shouldn\'t need to read', default=100000, type=int)
+    parser.add_argument(
+        '--rate-limit-rate', help='The fraction of requests to fail with a rate limit error', default=0.0, type=float)
+    parser.add_argument(
+        '--retry-after', help='The Retry-After header of rate limit errors, in seconds', default=1, type=float)
+    parser.add_argument(
+        '--error-rate', help='The fraction of requests to fail with a server error', default=0.0, type=float)
+    parser.add_argument(
+        '--empty-rate', help='The fraction of requests to serve a page without og: metadata', default=0.0, type=float)
+    parser.add_argument('--verbose', action='store_true',
+                        help='If set, will log each request')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), OGHandler)
+    server.args = args
+    server.request_count = 0
+    print(f'Serving stand-in pages at http://127.0.0.1:{args.port}')
+    server.serve_forever()
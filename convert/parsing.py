@@ -0,0 +1,42 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+# The BeautifulSoup parser the importers parse posts with. Python's own
+# html.parser always works, but is slow. Set HTML_PARSER=lxml in the
+# environment, after a `pip install lxml`, to parse several times faster.
+HTML_PARSER = os.getenv('HTML_PARSER', 'html.parser')
+
+# The number of processes to parse posts in. None for one per CPU, 0 to parse
+# them one at a time in this process.
+PARSE_PROCESSES = None
+
+# How many posts per process to parse ahead of the one being chunked, so that
+# the processes stay busy without every parsed post piling up in memory.
+PARSE_AHEAD = 4
+
+
+def parse_in_parallel(function, items, processes=PARSE_PROCESSES):
+    """
+    Yields function(item) for each of items, in order, as soon as each is
+    ready. They're computed across processes, at most PARSE_AHEAD per
+    process ahead of the one last yielded. function must be picklable, e.g.
+    defined at the top level of a module.
+    """
+    if processes == 0:
+        for item in items:
+            yield function(item)
+        return
+    items = iter(items)
+    executor = ProcessPoolExecutor(processes)
+    try:
+        ahead = (processes or os.cpu_count() or 1) * PARSE_AHEAD
+        futures = deque(executor.submit(function, item) for item in islice(items, ahead))
+        while futures:
+            result = futures.popleft().result()
+            for item in islice(items, 1):
+                futures.append(executor.submit(function, item))
+            yield result
+    finally:
+        executor.shutdown(cancel_futures=True)
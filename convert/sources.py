@@ -0,0 +1,48 @@
+import os
+
+import ask_embeddings
+
+# Importers of exports with one file per post, like Substack and Medium, can
+# also define source_filenames(filename), returning the files they would
+# import, and get_source_chunks(filename, source_filenames), yielding
+# (source_filename, id, chunk) for only those files. convert.main then
+# records each file's size, modification time, content hash and chunk ids in
+# the library's import_manifest, and on the next import only parses the files
+# that changed.
+
+
+def manifest_key(root, filename):
+    """
+    Returns the key of filename in an import manifest. Relative to what was
+    imported, so that moving an export doesn't make every file look new.
+    """
+    return os.path.relpath(filename, root)
+
+
+def source_entry(filename, chunk_ids, sha256=None):
+    stat = os.stat(filename)
+    return {
+        'sha256': sha256 or ask_embeddings.file_sha256(filename),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'chunk_ids': chunk_ids
+    }
+
+
+def unchanged_entry(entry, filename):
+    """
+    Returns entry, with its modification time brought up to date, if
+    filename hasn't changed since entry was recorded, and None otherwise.
+    Files whose size and modification time match aren't read; files that
+    were only touched are.
+    """
+    if not entry:
+        return None
+    stat = os.stat(filename)
+    if stat.st_size != entry.get('size'):
+        return None
+    if stat.st_mtime_ns == entry.get('mtime_ns'):
+        return entry
+    if ask_embeddings.file_sha256(filename) != entry.get('sha256'):
+        return None
+    return dict(entry, mtime_ns=stat.st_mtime_ns)
@@ -1,11 +1,13 @@
 import glob
 import json
 import re
-from .og import get_og_data
+from functools import partial
+from .og import default_og_fetcher, get_og_data
 from bs4 import BeautifulSoup
 from typing import Tuple
 from argparse import (ArgumentParser, Namespace)
-from .chunker import generate_chunks
+from .chunker import generate_chunks, get_clean_texts
+from .parsing import HTML_PARSER, parse_in_parallel
 
 HEADERS = ["h1", "h2", "h3", "h4", "h5", "h6"]
 LISTS = ["ul", "ol"]
@@ -18,7 +20,11 @@ def get_issue_slug(file_name: str) -> str:
     return None
 
 
-def get_issue_info(substack_url, issue_slug: str) -> Tuple[str, str, str, str]:
+def get_issue_url(substack_url, issue_slug: str) -> str:
+    return f"{substack_url}/p/{issue_slug}"
+
+
+def get_issue_info(substack_url, issue_slug: str, og_data: dict = None) -> Tuple[str, str, str, str]:
     """"
     Returns issue metadata as a dict following the `info` format,
     specified in https://github.com/dglazkov/polymath/blob/main/format.md
@@ -27,10 +33,11 @@ def get_issue_info(substack_url, issue_slug: str) -> Tuple[str, str, str, str]:
     and fetch each issue's metadata from the Substack site.
 
     This will cause Substack to rate limit us, so this import may
-    take a long time.
+    take a long time. Pass og_data if it has already been fetched.
     """
-    url = f"{substack_url}/p/{issue_slug}"
-    og_data = get_og_data(url)
+    url = get_issue_url(substack_url, issue_slug)
+    if og_data is None:
+        og_data = get_og_data(url)
     return {
         "url": url,
         "image_url": og_data.get("og:image"),
@@ -54,9 +61,17 @@ class SubstackImporter:
         return self._config["substack_url"].replace('https://', '').replace('http://', '').replace('.', '_')
 
     def get_chunks(self, filename: str):
-        pages = get_pages(filename, self._config, self._max)
-        for chunk in generate_chunks(pages):
-            yield chunk
+        for _, id, chunk in self.get_source_chunks(filename, self.source_filenames(filename)):
+            yield (id, chunk)
+
+    def source_filenames(self, filename: str):
+        return get_page_filenames(filename, self._max)
+
+    def get_source_chunks(self, filename: str, source_filenames: list):
+        pages = iter_pages(filename, self._config, clean=True, page_filenames=source_filenames)
+        for source_filename, (page_id, page) in zip(source_filenames, pages):
+            for id, chunk in generate_chunks({page_id: page}, cleaned=True):
+                yield (source_filename, id, chunk)
 
 
 def get_text(node):
@@ -65,9 +80,11 @@ def get_text(node):
 
 def get_sections(filename: str, exclude: list):
     with open(filename, 'r') as file:
-        soup = BeautifulSoup(file, "html.parser")
+        soup = BeautifulSoup(file, HTML_PARSER)
+        # Parsers other than html.parser put the post in a <body>.
+        root = soup.body or soup
         section_content = []
-        for sibling in soup.children:
+        for sibling in root.children:
             if sibling.name in LISTS:
                 section_content.extend([get_text(item)
                                        for item in sibling.children])
@@ -111,21 +128,56 @@ def get_pages(path: str, config: dict, max: int = None):
         ]
     }
     """
+    return dict(iter_pages(path, config, max))
+
+
+def get_page_filenames(path: str, max: int = None):
     page_filenames = glob.glob(f"{path}/posts/*.html")
-    result = {}
-    count = 0
-    for page_filename in page_filenames:
-        if max > 0 and count >= max:
-            break
+    if max and max > 0:
+        page_filenames = page_filenames[:max]
+    return page_filenames
+
+
+def iter_pages(path: str, config: dict, max: int = None, clean: bool = False, page_filenames: list = None):
+    """
+    Yields the same (key, page) pairs as get_pages returns, as each page is
+    ready. The posts are parsed across processes, so chunking the pages
+    already yielded overlaps with parsing the next ones.
+
+    Arguments:
+        clean {bool} -- Whether to also clean the lines of each page with
+        get_clean_text, in the same processes.
+        page_filenames {list} -- The posts to yield the pages of, if not all
+        of them.
+    """
+    if page_filenames is None:
+        page_filenames = get_page_filenames(path, max)
+    parse = partial(parse_sections, exclude=config["exclude"], clean=clean)
+    issue_slugs = [get_issue_slug(page_filename) for page_filename in page_filenames]
+    # Fetch the metadata of several issues at once while the posts are
+    # parsed. zip() starts the parsing processes before the fetching
+    # threads, so they're never forked while a thread holds a lock.
+    og_datas = default_og_fetcher().get_many(
+        [get_issue_url(config["substack_url"], issue_slug) for issue_slug in issue_slugs])
+    for page_filename, issue_slug, sections, og_data in zip(page_filenames, issue_slugs, parse_in_parallel(parse, page_filenames), og_datas):
         print(f"Processing \"{page_filename}\"")
-        issue_slug = get_issue_slug(page_filename)
-        issue_info = get_issue_info(config["substack_url"], issue_slug)
-        result[f"{issue_slug}"] = {
-            "sections": list(get_sections(page_filename, config["exclude"])),
+        issue_info = get_issue_info(config["substack_url"], issue_slug, og_data)
+        yield (f"{issue_slug}", {
+            "sections": sections,
             "info": issue_info
-        }
-        count += 1
-    return result
+        })
+
+
+def parse_sections(filename: str, exclude: list, clean: bool = False):
+    """
+    Returns the list of sections of a post, with their lines cleaned if
+    clean is set. Runs in a parsing process.
+    """
+    sections = list(get_sections(filename, exclude))
+    if not clean:
+        return sections
+    lines = iter(get_clean_texts([line for section in sections for line in section]))
+    return [[next(lines) for _ in section] for section in sections]
 
 
 if __name__ == "__main__":
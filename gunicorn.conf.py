@@ -0,0 +1,25 @@
+import gc
+
+# Import host.server, and so load the libraries, once in the master process
+# before forking the workers. The workers then share the master's copy of the
+# library: the embedding matrix is read-only, and when it comes from the
+# compiled library it is a memory map backed by the page cache, so memory no
+# longer grows with the number of workers.
+preload_app = True
+
+
+def when_ready(server):
+    from host.server import libraries
+    libraries.library.freeze_embeddings()
+    # Move everything loaded so far out of the garbage collector's reach, so
+    # that collections in the workers don't write to (and so copy) the pages
+    # holding the chunk metadata they share with the master.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # Threads don't survive the fork, so each worker watches the libraries
+    # itself. Reloaded libraries aren't shared between workers, but compiled
+    # ones are memory-mapped from the same file.
+    from host.server import libraries
+    libraries.start()
@@ -0,0 +1,20 @@
+import argparse
+import os
+
+from dotenv import load_dotenv
+
+from ask_embeddings import COMPILED_LIBRARY_FILE, load_libraries
+
+# Compiles the libraries the host would serve into a single binary library
+# that host.server loads directly on startup. Run this before deploying so
+# that instances don't have to compile the libraries when they start.
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--output', help='The compiled library file to write', default=os.getenv("COMPILED_LIBRARY_FILENAME", COMPILED_LIBRARY_FILE))
+    args = parser.parse_args()
+
+    library = load_libraries(os.getenv("LIBRARY_FILENAME"), True, args.output)
+    print(f'{args.output} is up to date with {len(library.chunk_ids)} chunks')
@@ -0,0 +1,54 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Checks that importing ask_embeddings, which every host instance does on a
+# cold start, stays fast. Each run imports it in a fresh interpreter. Exits
+# with an error if the median import takes longer than the budget, or if the
+# import pulled in any of the modules only needed to convert libraries.
+
+DEFAULT_BUDGET_SECONDS = 1.0
+HEAVY_MODULES = ['openai', 'transformers', 'torch', 'tensorflow']
+
+IMPORT_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import ask_embeddings
+print(json.dumps({'seconds': time.perf_counter() - start, 'modules': sorted(sys.modules)}))
+'''
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_import():
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], cwd=REPOSITORY_DIR,
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--budget', help=f'The most seconds the median import may take. Defaults to {DEFAULT_BUDGET_SECONDS}', default=DEFAULT_BUDGET_SECONDS, type=float)
+    parser.add_argument(
+        '--runs', help='The number of times to import it', default=5, type=int)
+    args = parser.parse_args()
+
+    results = [time_import() for _ in range(args.runs)]
+    seconds = [result['seconds'] for result in results]
+    median = statistics.median(seconds)
+    print(f'import ask_embeddings: median {median * 1000:.0f} ms, min {min(seconds) * 1000:.0f} ms, max {max(seconds) * 1000:.0f} ms over {args.runs} runs')
+
+    failed = False
+    if median > args.budget:
+        print(f'The median import took longer than the budget of {args.budget * 1000:.0f} ms')
+        failed = True
+    heavy_modules = [module for module in HEAVY_MODULES if module in results[0]['modules']]
+    if heavy_modules:
+        print(f'Importing ask_embeddings also imported {", ".join(heavy_modules)}, which serving queries doesn\'t need')
+        failed = True
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,112 @@
+import argparse
+import time
+
+import numpy as np
+
+from ask_embeddings import (CURRENT_VERSION, EMBEDDINGS_MODEL_ID,
+                            LEGAL_QUANTIZATIONS, SAMPLE_LIBRARIES_FILE,
+                            InvertedFileIndex, Library, base64_from_vector)
+
+# Compares approximate and quantized queries to exact, full precision ones on
+# each library, reporting the memory used by the embeddings that are scored
+# and by all of the embeddings held in memory (the full precision ones too,
+# unless the library is binary and they're memory-mapped), recall@k (the
+# fraction of the exact top k results that were also returned) and query
+# latency, for a range of nprobe values and each quantization.
+#
+# The queries are the library's own embeddings with some noise added, so that
+# the nearest chunk isn't trivially the query itself.
+
+
+def percentile_ms(latencies, percentile):
+    return np.percentile(latencies, percentile) * 1000
+
+
+def run_queries(library, queries, k, search='exact', nprobe=None):
+    results = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        result = library.query(version=CURRENT_VERSION, query_embedding=query,
+                               query_embedding_model=EMBEDDINGS_MODEL_ID, count=k,
+                               count_type='chunk', search=search, nprobe=nprobe)
+        latencies.append(time.perf_counter() - start)
+        results.append(set(result.chunk_ids))
+    return results, latencies
+
+
+def print_row(search, quantization, nprobe, megabytes, total_megabytes, results, latencies, exact_results):
+    recall = np.mean([len(result & exact) / max(1, len(exact))
+                     for result, exact in zip(results, exact_results)])
+    print(f'{search:<12}{quantization:<10}{nprobe:>8}{megabytes:>10.2f}{total_megabytes:>10.2f}{recall:>10.3f}{percentile_ms(latencies, 50):>10.2f}{percentile_ms(latencies, 99):>10.2f}')
+
+
+def report(filename, args):
+    library = Library(filename=filename)
+    chunk_count = len(library.chunk_ids)
+    embeddings = library._embeddings[:library._embedding_count]
+
+    start = time.perf_counter()
+    library.approximate_index = InvertedFileIndex.build(
+        embeddings, list_count=args.lists)
+    build_seconds = time.perf_counter() - start
+    list_count = library.approximate_index.list_count
+
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(embeddings), size=args.queries)
+    vectors = embeddings[rows] + rng.normal(
+        scale=args.noise, size=(args.queries, embeddings.shape[1]))
+    queries = [base64_from_vector(vector) for vector in vectors]
+
+    nprobes = args.nprobe
+    if not nprobes:
+        nprobes = sorted(set([1, 2, 4, 8, 16, 32, list_count // 4, list_count // 2, list_count]))
+        nprobes = [nprobe for nprobe in nprobes if 0 < nprobe <= list_count]
+
+    print(f'{filename}: {chunk_count} chunks, {list_count} lists, index built in {build_seconds:.2f}s')
+    print(f'{args.queries} queries, recall@{args.k}')
+    print()
+    print(f'{"search":<12}{"quantize":<10}{"nprobe":>8}{"MB":>10}{"total MB":>10}{"recall":>10}{"p50 ms":>10}{"p99 ms":>10}')
+
+    full_megabytes = embeddings.nbytes / 1e6
+    exact_results, latencies = run_queries(library, queries, args.k)
+    print_row('exact', '', '', full_megabytes, library.embeddings_nbytes / 1e6,
+              exact_results, latencies, exact_results)
+
+    for quantization in [None] + sorted(LEGAL_QUANTIZATIONS):
+        library.quantization = quantization
+        megabytes = full_megabytes
+        if quantization:
+            megabytes = library.quantized_embeddings.nbytes / 1e6
+        # Computed after quantizing, so that it includes the quantized copy.
+        total_megabytes = library.embeddings_nbytes / 1e6
+        if quantization:
+            results, latencies = run_queries(library, queries, args.k)
+            print_row('exact', quantization, '', megabytes, total_megabytes,
+                      results, latencies, exact_results)
+        for nprobe in nprobes:
+            results, latencies = run_queries(
+                library, queries, args.k, 'approximate', nprobe)
+            print_row('approximate', quantization or '', nprobe, megabytes, total_megabytes,
+                      results, latencies, exact_results)
+    print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--library', help=f'A library file to report on. May be passed multiple times. Defaults to {SAMPLE_LIBRARIES_FILE}', action='append')
+    parser.add_argument(
+        '--k', help='The number of results per query', default=10, type=int)
+    parser.add_argument(
+        '--queries', help='The number of queries to run', default=200, type=int)
+    parser.add_argument(
+        '--noise', help='The standard deviation of the noise added to each query embedding', default=0.01, type=float)
+    parser.add_argument(
+        '--lists', help='The number of lists in the index. Defaults to the square root of the number of chunks', default=None, type=int)
+    parser.add_argument('--nprobe', help='An nprobe value to report on. May be passed multiple times',
+                        action='append', type=int)
+    args = parser.parse_args()
+
+    for filename in args.library or [SAMPLE_LIBRARIES_FILE]:
+        report(filename, args)
@@ -1,13 +1,16 @@
 import argparse
+import json
 import os
 import traceback
 
-import openai
 from dotenv import load_dotenv
 from flask import Flask, jsonify, render_template, request
 from flask_compress import Compress
 
-from ask_embeddings import load_libraries
+from ask_embeddings import (COMPILED_LIBRARY_FILE, LIBRARY_RELOAD_INTERVAL,
+                            QUERY_CACHE_MAX_AGE, QUERY_CACHE_MAX_BYTES,
+                            LibraryWatcher, QueryResultCache,
+                            permitted_access)
 
 DEFAULT_TOKEN_COUNT = 1000
 
@@ -15,10 +18,49 @@ app = Flask(__name__)
 Compress(app)
 
 load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
 library_filename = os.getenv("LIBRARY_FILENAME")
+# Set to an empty string to always load the libraries from their source files.
+compiled_library_filename = os.getenv(
+    "COMPILED_LIBRARY_FILENAME", COMPILED_LIBRARY_FILE)
+
+
+def prepare_library(library):
+    # Optionally one of 'float16' or 'int8'. Queries then score candidates against
+    # a quantized copy of the embeddings, which takes 2-4x less memory, and only
+    # re-rank the best of them with the full precision embeddings.
+    library.quantization = os.getenv("EMBEDDING_QUANTIZATION") or None
+    if library.quantization:
+        # Quantize now rather than on the first query, so that preloaded workers
+        # share the quantized copy.
+        print(f'Quantized embeddings to {library.quantization}: {library.quantized_embeddings.nbytes / 1e6:.1f} MB, '
+              f'{library.embeddings_nbytes / 1e6:.1f} MB of embeddings in memory in all')
+
+
+# Responses to repeated queries are served from this cache. Each worker has its
+# own. Set QUERY_CACHE_MAX_BYTES to 0 to disable it.
+result_cache = QueryResultCache(int(os.getenv("QUERY_CACHE_MAX_BYTES", QUERY_CACHE_MAX_BYTES)),
+                                int(os.getenv("QUERY_CACHE_MAX_AGE", QUERY_CACHE_MAX_AGE)))
+
+# Loads the libraries now, and once started reloads them whenever they change.
+# Set LIBRARY_RELOAD_INTERVAL to 0 to never reload them.
+libraries = LibraryWatcher(library_filename, compiled_library_filename,
+                           float(os.getenv("LIBRARY_RELOAD_INTERVAL", LIBRARY_RELOAD_INTERVAL)),
+                           prepare=prepare_library, on_reload=result_cache.clear)
+
+def optional_form_value(name, type):
+    """
+    Returns the form field name converted to type, or None if it wasn't
+    passed. Raises rather than ignoring a value that doesn't convert, so that
+    a query isn't silently run, and cached, without it.
+    """
+    value = request.form.get(name)
+    if value is None:
+        return None
+    try:
+        return type(value)
+    except ValueError:
+        raise Exception(f'{name} must be a {type.__name__} but it was {value}')
 
-library = load_libraries(library_filename, True)
 
 @app.route("/", methods=["POST"])
 def start():
@@ -34,11 +76,26 @@ def start():
         seed = request.form.get('seed')
         omit = request.form.get('omit')
         access_token = request.form.get('access_token', '')
-        result = library.query(version=version, query_embedding=query_embedding,
-                                    query_embedding_model=query_embedding_model, count=count,
-                                    count_type=count_type, sort=sort, sort_reversed=sort_reversed,
-                                    seed=seed, omit=omit, access_token=access_token)
-        return jsonify(result.serializable())
+        min_similarity = optional_form_value('min_similarity', float)
+        search = request.form.get('search')
+        nprobe = optional_form_value('nprobe', int)
+        query_arguments = dict(version=version, query_embedding=query_embedding,
+                               query_embedding_model=query_embedding_model, count=count,
+                               count_type=count_type, sort=sort, sort_reversed=sort_reversed,
+                               seed=seed, omit=omit, min_similarity=min_similarity,
+                               search=search, nprobe=nprobe)
+        library, generation = libraries.current()
+        permitted = permitted_access(access_token)
+        cache_key = QueryResultCache.key(permitted, generation=generation, **query_arguments)
+        response = result_cache.get(cache_key) if cache_key else None
+        if response is None:
+            result = library.query_serializable(access_token=access_token, permitted=permitted, **query_arguments)
+            # Dump compactly ourselves rather than via jsonify, which sorts keys
+            # and copies the result.
+            response = json.dumps(result, separators=(',', ':')).encode('utf-8')
+            if cache_key:
+                result_cache.put(cache_key, response)
+        return app.response_class(response, mimetype='application/json')
 
     except Exception as e:
         return jsonify({
@@ -46,6 +103,43 @@ def start():
         })
 
 
+@app.route("/batch", methods=["POST"])
+def start_batch():
+    # A batch is a JSON body of the form {"version": 0, "access_token": "...",
+    # "queries": [...]}, where each query has the same fields as the form that
+    # the / endpoint takes, other than version and access_token.
+    try:
+        body = request.get_json(force=True)
+        queries = body.get('queries')
+        if not isinstance(queries, list) or not all(isinstance(query, dict) for query in queries):
+            raise Exception('queries must be a list of objects')
+        queries = [{'count': DEFAULT_TOKEN_COUNT, **query} for query in queries]
+        library = libraries.library
+        results = library.query_batch_serializable(queries, version=body.get('version', -1),
+                                                   access_token=body.get('access_token', ''))
+        return app.response_class(json.dumps({'results': results}, separators=(',', ':')), mimetype='application/json')
+
+    except Exception as e:
+        return jsonify({
+            "error": f"{e}\n{traceback.print_exc()}"
+        })
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    # These are for the worker that handled the request.
+    library, generation = libraries.current()
+    return jsonify({
+        "library": {
+            "generation": generation,
+            "chunks": len(library.chunk_ids),
+            "reload_seconds": libraries.reload_seconds,
+            "reloaded_at": libraries.reloaded_at
+        },
+        "result_cache": result_cache.stats()
+    })
+
+
 @app.route("/", methods=["GET"])
 def start_sample():
     return render_template("query.html")
@@ -56,4 +150,8 @@ if __name__ == "__main__":
     parser.add_argument(
         '--port', help='Number of the port to run the server on (8080 by default).', default=8080, type=int)
     args = parser.parse_args()
+    # The debug reloader runs the app in a child process, which is the only one
+    # that needs to watch the libraries.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        libraries.start()
     app.run(host='127.0.0.1', port=args.port, debug=True)
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+import ask_embeddings
+
+EMBEDDING_LENGTH = ask_embeddings.EXPECTED_EMBEDDING_LENGTH[ask_embeddings.EMBEDDINGS_MODEL_ID]
+
+
+def random_embedding(rng):
+    vector = rng.normal(size=EMBEDDING_LENGTH).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def make_chunk(rng, text='Some text.', access_tag=None):
+    chunk = {
+        'text': text,
+        'token_count': len(text.split()),
+        'embedding': random_embedding(rng),
+        'info': {'url': f'https://example.com/{text}', 'title': 'A title'}
+    }
+    if access_tag:
+        chunk['access_tag'] = access_tag
+    return chunk
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
+
+
+@pytest.fixture
+def library(rng):
+    """
+    A library of 20 chunks, every third of which has an access_tag.
+    """
+    result = ask_embeddings.Library()
+    for i in range(20):
+        result.set_chunk(f'chunk-{i}', make_chunk(rng, f'Text of chunk {i}.', 'private' if i % 3 == 0 else None))
+    return result
@@ -0,0 +1,79 @@
+import json
+import os
+
+import pytest
+
+import ask_embeddings
+
+
+def write_config(filename, tokens, **data):
+    with open(filename, 'w') as f:
+        json.dump(dict(data, tokens=tokens), f)
+
+
+@pytest.fixture
+def config_filename(tmp_path):
+    filename = str(tmp_path / 'host.SECRET.json')
+    write_config(filename, {
+        'alex': {'token': 'alex-token'},
+        'sam': {'token': 'sam-token', 'access_tags': ['private', 'drafts']},
+        'pending': {'access_tags': ['private']},
+        'sam-again': {'token': 'sam-token', 'access_tags': ['other']},
+    }, restricted={'count': True, 'message': 'Ask for a token.'})
+    return filename
+
+
+def test_resolves_tokens(config_filename):
+    access_control = ask_embeddings.AccessControl(config_filename)
+    assert access_control.permitted_access('alex-token') == (frozenset(['unpublished']), True, 'Ask for a token.')
+    # The first record with a token wins.
+    assert access_control.permitted_access('sam-token')[0] == frozenset(['private', 'drafts'])
+    assert access_control.permitted_access('unknown-token')[0] == frozenset()
+    assert access_control.permitted_access('') == (frozenset(), True, 'Ask for a token.')
+
+
+def test_missing_file_grants_nothing(tmp_path):
+    access_control = ask_embeddings.AccessControl(str(tmp_path / 'missing.json'))
+    assert access_control.permitted_access('alex-token') == (frozenset(), False, '')
+
+
+def test_requires_tokens(tmp_path):
+    filename = str(tmp_path / 'host.SECRET.json')
+    with open(filename, 'w') as f:
+        json.dump({'restricted': {'count': True}}, f)
+    access_control = ask_embeddings.AccessControl(filename)
+    assert access_control.permitted_access('') == (frozenset(), True, '')
+    with pytest.raises(Exception, match='tokens'):
+        access_control.permitted_access('alex-token')
+
+
+def test_reloads_when_file_changes(config_filename, monkeypatch):
+    access_control = ask_embeddings.AccessControl(config_filename)
+    reloads = []
+    reload = access_control.reload
+
+    def record_reload():
+        reloads.append(config_filename)
+        reload()
+    monkeypatch.setattr(access_control, 'reload', record_reload)
+    for _ in range(3):
+        assert access_control.permitted_access('alex-token')[0] == frozenset(['unpublished'])
+    assert len(reloads) == 1
+    # Revoked, in a file of exactly the same size, so only its mtime differs.
+    with open(config_filename) as f:
+        text = f.read()
+    stat = os.stat(config_filename)
+    with open(config_filename, 'w') as f:
+        f.write(text.replace('alex-token', 'xxxx-token'))
+    os.utime(config_filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert access_control.permitted_access('alex-token')[0] == frozenset()
+    assert access_control.permitted_access('xxxx-token')[0] == frozenset(['unpublished'])
+    assert len(reloads) == 2
+    # Replaced by a new file, as config.host does.
+    replacement = config_filename + '.new'
+    write_config(replacement, {'alex': {'token': 'alex-token', 'access_tags': ['private']}})
+    os.replace(replacement, config_filename)
+    assert access_control.permitted_access('alex-token') == (frozenset(['private']), False, '')
+    assert len(reloads) == 3
+    os.remove(config_filename)
+    assert access_control.permitted_access('alex-token') == (frozenset(), False, '')
@@ -0,0 +1,61 @@
+import numpy as np
+
+import ask_embeddings
+from convert.binary import convert
+
+
+def assert_same_chunks(library, other, ignore=()):
+    assert list(library.chunk_ids) == list(other.chunk_ids)
+    for chunk_id, chunk in library.chunks:
+        chunk = {field: value for field, value in chunk.items() if field not in ignore}
+        other_chunk = other.chunk(chunk_id)
+        assert sorted(other_chunk) == sorted(chunk)
+        for field, value in chunk.items():
+            if field == 'embedding':
+                assert np.array_equal(other_chunk[field], value)
+            else:
+                assert other_chunk[field] == value
+
+
+def test_binary_round_trip(tmp_path, library):
+    filename = str(tmp_path / 'library.polymath')
+    library.save(filename)
+    loaded = ask_embeddings.Library(filename=filename)
+    # Like JSON files, binary ones get their access_tag from their directory.
+    assert_same_chunks(library, loaded, ignore=('access_tag',))
+    assert loaded.embeddings_memory_mapped
+
+
+def test_convert_json_to_binary_and_back(tmp_path, library):
+    json_filename = str(tmp_path / 'library.json')
+    library.save(json_filename)
+    binary_filename = convert(json_filename)
+    assert binary_filename == str(tmp_path / 'library.polymath')
+    json_again_filename = convert(binary_filename, str(tmp_path / 'again.json'))
+    assert_same_chunks(ask_embeddings.Library(filename=json_filename),
+                       ask_embeddings.Library(filename=binary_filename))
+    assert_same_chunks(ask_embeddings.Library(filename=json_filename),
+                       ask_embeddings.Library(filename=json_again_filename))
+
+
+def test_binary_library_queries_like_json(tmp_path, library, rng):
+    json_filename = str(tmp_path / 'library.json')
+    library.save(json_filename)
+    query_embedding = ask_embeddings.base64_from_vector(rng.normal(size=library._embeddings.shape[1]))
+    results = []
+    for filename in [json_filename, convert(json_filename)]:
+        result = ask_embeddings.Library(filename=filename).query(
+            version=ask_embeddings.CURRENT_VERSION, query_embedding=query_embedding,
+            query_embedding_model=ask_embeddings.EMBEDDINGS_MODEL_ID, count=5, count_type='chunk')
+        results.append(list(result.chunk_ids))
+    assert results[0] == results[1]
+
+
+def test_modifying_memory_mapped_library_copies_embeddings(tmp_path, library, rng):
+    filename = str(tmp_path / 'library.polymath')
+    library.save(filename)
+    loaded = ask_embeddings.Library(filename=filename)
+    loaded.set_chunk('chunk-0', dict(loaded.chunk('chunk-0'), embedding=np.zeros(loaded._embeddings.shape[1], dtype=np.float32)))
+    assert not loaded.embeddings_memory_mapped
+    assert not loaded.chunk('chunk-0')['embedding'].any()
+    assert_same_chunks(library, ask_embeddings.Library(filename=filename), ignore=('access_tag',))
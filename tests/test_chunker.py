@@ -0,0 +1,96 @@
+import random
+
+import pytest
+
+import ask_embeddings
+
+cleantext = pytest.importorskip('cleantext')
+tokenizers = pytest.importorskip('tokenizers')
+transformers = pytest.importorskip('transformers')
+
+from convert import chunker
+
+WORDS = ('the of and a to in is you that it he was for on are as with his they at be this have from or one had by '
+         'word but not what all were when your can said there use an each which she do how their').split()
+
+
+@pytest.fixture(scope='module', autouse=True)
+def tokenizer():
+    """
+    Installs a small byte-level BPE tokenizer in place of GPT-2's, which has
+    to be downloaded. It pre-tokenizes the same way as GPT-2, so it never
+    merges tokens across a newline either, which is what the chunker's token
+    counts rely on.
+    """
+    random.seed(0)
+    corpus = [' '.join(random.choice(WORDS) for _ in range(50)) + '.' for _ in range(500)]
+    model = tokenizers.Tokenizer(tokenizers.models.BPE())
+    model.pre_tokenizer = tokenizers.pre_tokenizers.ByteLevel(add_prefix_space=False)
+    model.decoder = tokenizers.decoders.ByteLevel()
+    model.train_from_iterator(corpus, tokenizers.trainers.BpeTrainer(
+        vocab_size=500, initial_alphabet=tokenizers.pre_tokenizers.ByteLevel.alphabet(), show_progress=False))
+    previous = ask_embeddings._tokenizer
+    ask_embeddings._tokenizer = transformers.PreTrainedTokenizerFast(tokenizer_object=model)
+    yield ask_embeddings._tokenizer
+    ask_embeddings._tokenizer = previous
+
+
+def sentences(count):
+    return ' '.join(' '.join(random.choice(WORDS) for _ in range(random.randint(3, 30))).capitalize() + '.'
+                    for _ in range(count))
+
+
+PLAIN_ASCII_LINES = [
+    'Just a sentence.',
+    '  Leading,   repeated\tand trailing whitespace  ',
+    'A `quoted` word and a link to https://example.com/some/page?x=1.',
+    'Several lines\n\n\nof text\n  indented  ',
+    '',
+    '100% of {braces} [brackets] <angles> and ~tildes~ | pipes',
+]
+
+OTHER_LINES = [
+    'Café crème — with “smart quotes”',
+    'Fish &amp; chips',
+    'A backslash \\n in text',
+    'An emoji \U0001F600 here',
+]
+
+
+@pytest.mark.parametrize('text', PLAIN_ASCII_LINES + OTHER_LINES)
+def test_clean_text_matches_clean(text):
+    assert chunker.get_clean_text(text) == cleantext.clean(text, **chunker.CLEAN_ARGUMENTS)
+
+
+@pytest.mark.parametrize('text', PLAIN_ASCII_LINES)
+def test_plain_ascii_takes_fast_path(text, monkeypatch):
+    def clean(*args, **kwargs):
+        raise AssertionError('clean() was called')
+    monkeypatch.setattr(chunker, 'clean', clean)
+    chunker.get_clean_text(text)
+
+
+def test_clean_texts_in_processes(monkeypatch):
+    monkeypatch.setattr(chunker, 'CLEAN_BATCH_SIZE', 3)
+    texts = (PLAIN_ASCII_LINES + OTHER_LINES) * 2
+    assert chunker.get_clean_texts(texts, processes=2) == [chunker.get_clean_text(text) for text in texts]
+
+
+def test_chunks_are_within_token_limits():
+    random.seed(1)
+    pages = {}
+    for page in range(5):
+        sections = []
+        for _ in range(4):
+            # Lines from a few words to several chunks long.
+            sections.append([sentences(random.choice([1, 3, 10, 40, 120])) for _ in range(random.randint(1, 8))])
+        pages[f'page-{page}'] = {'sections': sections, 'info': {'url': f'https://example.com/{page}'}}
+    chunks = dict(chunker.generate_chunks(pages, processes=0))
+    assert chunks
+    for chunk in chunks.values():
+        assert chunk['token_count'] == ask_embeddings.get_token_count(chunk['text'])
+        assert chunk['token_count'] <= chunker.GOLDIELOCKS['max']
+    # Every line ends up in exactly one chunk, although a short leftover of a
+    # split line is appended to the previous chunk without a space.
+    lines = [line for page in pages.values() for section in page['sections'] for line in section]
+    assert ''.join(''.join(chunk['text'].split()) for chunk in chunks.values()) == ''.join(''.join(line.split()) for line in lines)
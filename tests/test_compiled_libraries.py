@@ -0,0 +1,52 @@
+import os
+
+import pytest
+
+import ask_embeddings
+from conftest import make_chunk
+
+
+@pytest.fixture
+def library_dir(tmp_path, monkeypatch, rng):
+    monkeypatch.chdir(tmp_path)
+    # b.json's chunks get the access_tag 'private' from its directory.
+    for filename, prefix in [('libraries/a.json', 'a'),
+                             ('libraries/access/private/b.json', 'b'),
+                             ('libraries/third_party/c.json', 'c')]:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        library = ask_embeddings.Library()
+        for i in range(5):
+            library.set_chunk(f'{prefix}-{i}', make_chunk(rng, f'Text {prefix} {i}.'))
+        library.save(filename)
+    return 'libraries'
+
+
+def load(previous=None):
+    filenames = ask_embeddings.library_filenames_in_directory('libraries')
+    return ask_embeddings.load_multiple_libraries(filenames, 'compiled/library.polymath', previous=previous)
+
+
+def test_compiled_library_keeps_access_tags(library_dir):
+    library = load()
+    assert len(library.chunk_ids) == 15
+    assert library.chunk('b-0')['access_tag'] == 'private'
+    assert 'access_tag' not in library.chunk('a-0')
+    assert load().chunk('b-0')['access_tag'] == 'private'
+
+
+def test_compiled_library_leaves_out_undeployed_libraries(library_dir):
+    load()
+    compiled = ask_embeddings.Library(filename='compiled/library.polymath', access_tag=False)
+    assert sorted(compiled.chunk_ids) == sorted([f'a-{i}' for i in range(5)] + [f'b-{i}' for i in range(5)])
+    manifest = ask_embeddings.load_data_file('compiled/library.polymath' + ask_embeddings.COMPILED_MANIFEST_EXTENSION)
+    assert not any('third_party' in entry['filename'] for entry in manifest['files'])
+
+
+def test_compiled_library_still_current_without_undeployed_libraries(library_dir, capsys):
+    load()
+    capsys.readouterr()
+    os.remove('libraries/third_party/c.json')
+    library = load()
+    assert 'Compiling' not in capsys.readouterr().out
+    assert len(library.chunk_ids) == 10
+    assert library.embeddings_memory_mapped
@@ -0,0 +1,86 @@
+import numpy as np
+
+import ask_embeddings
+from conftest import make_chunk
+
+
+def assert_rows_consistent(library):
+    """
+    Checks the invariants of the embedding matrix: each chunk with an
+    embedding has exactly one row, the row maps agree with each other, and
+    each chunk's embedding is a view of its row.
+    """
+    embedded_ids = [chunk_id for chunk_id, chunk in library.chunks if 'embedding' in chunk]
+    assert library._embedding_count == len(library._embedding_ids) == len(library._embedding_rows)
+    assert sorted(library._embedding_ids) == sorted(embedded_ids)
+    assert library._embeddings is None or len(library._embeddings) >= library._embedding_count
+    for row, chunk_id in enumerate(library._embedding_ids):
+        assert library._embedding_rows[chunk_id] == row
+        embedding = library.chunk(chunk_id)['embedding']
+        assert np.shares_memory(embedding, library._embeddings[row])
+        assert np.array_equal(embedding, library._embeddings[row])
+
+
+def test_set_and_delete_chunks(library, rng):
+    assert_rows_consistent(library)
+    expected = {chunk_id: np.array(chunk['embedding']) for chunk_id, chunk in library.chunks}
+    for chunk_id in ['chunk-0', 'chunk-7', 'chunk-19']:
+        deleted = library.chunk(chunk_id)
+        library.delete_chunk(chunk_id)
+        del expected[chunk_id]
+        # A deleted chunk keeps its own copy of its embedding.
+        assert not np.shares_memory(deleted['embedding'], library._embeddings)
+        assert_rows_consistent(library)
+    library.set_chunk('chunk-7', make_chunk(rng))
+    expected['chunk-7'] = np.array(library.chunk('chunk-7')['embedding'])
+    library.set_chunk('chunk-3', make_chunk(rng))
+    expected['chunk-3'] = np.array(library.chunk('chunk-3')['embedding'])
+    assert_rows_consistent(library)
+    for chunk_id, embedding in expected.items():
+        assert np.array_equal(library.chunk(chunk_id)['embedding'], embedding)
+
+
+def test_delete_chunk_field_unindexes_embedding(library):
+    library.delete_chunk_field('chunk-4', ['embedding'])
+    assert 'chunk-4' not in library._embedding_rows
+    assert_rows_consistent(library)
+
+
+def test_frozen_matrix_is_copied_without_growing(library, rng):
+    capacity = len(library._embeddings)
+    for _ in range(5):
+        library.freeze_embeddings()
+        library.set_chunk('chunk-5', make_chunk(rng))
+        assert library._embeddings.flags.writeable
+        assert len(library._embeddings) == capacity
+        assert_rows_consistent(library)
+    library.freeze_embeddings()
+    library.delete_chunk('chunk-6')
+    assert len(library._embeddings) == capacity
+    assert_rows_consistent(library)
+
+
+def test_matrix_grows_geometrically(library, rng):
+    capacities = set()
+    for i in range(200):
+        library.set_chunk(f'new-{i}', make_chunk(rng))
+        capacities.add(len(library._embeddings))
+    assert len(capacities) <= 5
+    assert_rows_consistent(library)
+
+
+def test_extend_replaces_chunks(library, rng):
+    replaced = library.chunk('chunk-2')
+    replaced_embedding = np.array(replaced['embedding'])
+    other = ask_embeddings.Library()
+    other.set_chunk('chunk-1', {'text': 'No embedding any more.', 'token_count': 4, 'info': {'url': 'https://example.com'}})
+    other.set_chunk('chunk-2', make_chunk(rng, 'A new embedding.'))
+    other.set_chunk('new', make_chunk(rng, 'A new chunk.'))
+    library.extend(other)
+    assert 'chunk-1' not in library._embedding_rows
+    assert np.array_equal(library.chunk('chunk-2')['embedding'], other.chunk('chunk-2')['embedding'])
+    # The replaced chunk wasn't changed under whoever still holds it.
+    assert np.array_equal(replaced['embedding'], replaced_embedding)
+    assert_rows_consistent(library)
+    library.delete_chunk('chunk-1')
+    assert_rows_consistent(library)
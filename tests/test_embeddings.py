@@ -0,0 +1,150 @@
+import io
+import json
+import threading
+from argparse import Namespace
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+import ask_embeddings
+
+openai = pytest.importorskip('openai')
+
+from convert.embedding_standin import EmbeddingHandler, embedding_for
+
+
+class RecordingEmbeddingHandler(EmbeddingHandler):
+    """
+    Records the texts of each request, and fails requests with the statuses
+    in server.failures until it runs out of them.
+    """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.server.lock:
+            self.server.requests.append(json.loads(body)['input'])
+            failure = self.server.failures.pop(0) if self.server.failures else None
+        if failure == 429:
+            self.send_json(429, {'error': {'message': 'Rate limit reached (stand-in)', 'type': 'requests'}},
+                           {'Retry-After': '0'})
+            return
+        if failure:
+            self.send_json(failure, {'error': {'message': 'The server had an error (stand-in)', 'type': 'server_error'}})
+            return
+        self.rfile = io.BytesIO(body)
+        super().do_POST()
+
+
+@pytest.fixture
+def standin(monkeypatch):
+    """
+    Serves convert/embedding_standin.py's embeddings on a free port, and
+    points the openai module at it.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RecordingEmbeddingHandler)
+    server.args = Namespace(latency=0, latency_per_text=0, rate_limit_rate=0.0, retry_after=0, error_rate=0.0, verbose=False)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.failures = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(openai, 'api_base', f'http://127.0.0.1:{server.server_address[1]}/v1')
+    monkeypatch.setattr(openai, 'api_key', 'sk-stand-in')
+    monkeypatch.setattr(ask_embeddings, 'EMBEDDING_RETRY_BASE_SECONDS', 0.01)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def assert_embeddings(embeddings, texts):
+    assert len(embeddings) == len(texts)
+    for embedding, text in zip(embeddings, texts):
+        assert np.allclose(embedding, embedding_for(text))
+
+
+def test_packs_texts_into_batches(standin):
+    texts = [f'Text {i}.' for i in range(10)]
+    token_counts = [1, 1, 1, 1, 6, 1, 1, 1, 1, 1]
+    client = ask_embeddings.EmbeddingClient(batch_size=3, batch_tokens=8, concurrency=2)
+    assert_embeddings(client.get_embeddings(texts, token_counts), texts)
+    # At most 3 texts and 8 tokens in each request.
+    assert sorted(standin.requests) == sorted([texts[0:3], texts[3:6], texts[6:9], texts[9:10]])
+    assert client.text_count == 10
+    assert client.token_count == 15
+    assert client.request_count == 4
+
+
+def test_rejects_texts_over_the_input_limit(standin):
+    client = ask_embeddings.EmbeddingClient()
+    with pytest.raises(Exception, match='accepts at most'):
+        client.get_embeddings(['A.', 'B.'], [1, 10000])
+    assert standin.requests == []
+
+
+def test_retries_failed_requests(standin):
+    standin.failures = [429, 500, 502]
+    client = ask_embeddings.EmbeddingClient(concurrency=1)
+    assert_embeddings(client.get_embeddings(['A.']), ['A.'])
+    assert len(standin.requests) == 4
+    assert client.retry_count == 3
+
+
+def test_gives_up_after_max_retries(standin):
+    standin.failures = [500] * 10
+    client = ask_embeddings.EmbeddingClient(max_retries=2)
+    with pytest.raises(openai.error.OpenAIError):
+        client.get_embeddings(['A.'])
+    assert len(standin.requests) == 3
+
+
+def test_does_not_retry_invalid_requests(standin):
+    standin.failures = [400]
+    with pytest.raises(openai.error.InvalidRequestError):
+        ask_embeddings.EmbeddingClient().get_embeddings(['A.'])
+    assert len(standin.requests) == 1
+
+
+def test_retry_delays():
+    client = ask_embeddings.EmbeddingClient()
+    for attempt in range(10):
+        delay = client._retry_delay(openai.error.APIError('Server error'), attempt)
+        expected = min(ask_embeddings.EMBEDDING_RETRY_BASE_SECONDS * 2 ** attempt, ask_embeddings.EMBEDDING_RETRY_MAX_SECONDS)
+        assert expected / 2 <= delay <= expected
+    rate_limit_delay = client._retry_delay(openai.error.RateLimitError('Rate limit'), 0)
+    assert rate_limit_delay >= ask_embeddings.EMBEDDING_RETRY_BASE_SECONDS * ask_embeddings.EMBEDDING_RATE_LIMIT_BACKOFF_FACTOR / 2
+    # Never sooner than the API says to.
+    assert client._retry_delay(openai.error.RateLimitError('Rate limit', headers={'retry-after': '100'}), 0) == 100
+    assert client._retry_delay(openai.error.RateLimitError('Quota', code='insufficient_quota'), 0) is None
+    assert client._retry_delay(openai.error.AuthenticationError('Bad key'), 0) is None
+
+
+def test_fetches_only_uncached_texts(standin, tmp_path):
+    cache = ask_embeddings.EmbeddingCache(str(tmp_path / 'embeddings.sqlite'))
+    client = ask_embeddings.EmbeddingClient(cache=cache)
+    assert_embeddings(client.get_embeddings(['A.', 'B.'], [1, 1]), ['A.', 'B.'])
+    assert_embeddings(client.get_embeddings(['B.', 'C.', 'A.'], [1, 1, 1]), ['B.', 'C.', 'A.'])
+    assert standin.requests == [['A.', 'B.'], ['C.']]
+    assert client.cached_count == 2
+    assert len(cache) == 3
+    # Another model's embeddings are cached separately.
+    assert cache.get_embeddings(['A.'], 'openai.com:other-model') == [None]
+
+
+def test_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    clock = iter(range(1000))
+    monkeypatch.setattr(ask_embeddings, 'time', lambda: next(clock))
+    embedding_bytes = len(embedding_for('A.').tobytes())
+    filename = str(tmp_path / 'embeddings.sqlite')
+    cache = ask_embeddings.EmbeddingCache(filename, max_bytes=10 * embedding_bytes)
+    old_texts = [f'Old {i}.' for i in range(8)]
+    cache.put_embeddings(old_texts, [embedding_for(text) for text in old_texts])
+    assert_embeddings(cache.get_embeddings(old_texts[:2]), old_texts[:2])
+    new_texts = [f'New {i}.' for i in range(4)]
+    cache.put_embeddings(new_texts, [embedding_for(text) for text in new_texts])
+    # Evicted down to 90% of max_bytes, starting with the least recently used.
+    assert len(cache) == 9
+    reopened = ask_embeddings.EmbeddingCache(filename, max_bytes=10 * embedding_bytes)
+    assert reopened.get_embeddings(old_texts[2:5]) == [None] * 3
+    kept = old_texts[:2] + old_texts[5:] + new_texts
+    assert_embeddings(reopened.get_embeddings(kept), kept)
@@ -0,0 +1,46 @@
+import numpy as np
+
+import ask_embeddings
+from conftest import make_chunk
+from convert.journal import ImportJournal, journal_filename
+
+
+def test_replays_appended_chunks(tmp_path, rng):
+    journal = ImportJournal(journal_filename(str(tmp_path / 'out.json')))
+    first = {'a': make_chunk(rng, 'A.'), 'b': make_chunk(rng, 'B.')}
+    second = {'c': make_chunk(rng, 'C.'), 'a': make_chunk(rng, 'A again.')}
+    journal.append(first)
+    journal.append(second)
+    chunks = ImportJournal(journal.filename).replay()
+    assert sorted(chunks) == ['a', 'b', 'c']
+    assert chunks['a']['text'] == 'A again.'
+    # Embeddings come back base64 encoded, as in a JSON library.
+    assert isinstance(chunks['b']['embedding'], str)
+    journal.remove()
+    assert ImportJournal(journal.filename).replay() == {}
+
+
+def test_ignores_and_truncates_partial_record(tmp_path, rng):
+    filename = str(tmp_path / 'out.json.journal')
+    journal = ImportJournal(filename)
+    journal.append({'a': make_chunk(rng, 'A.')})
+    # An import that died halfway through writing its next record.
+    with open(filename, 'ab') as f:
+        f.write(b'{"embedding_model": "openai.com:text-embedding-ada-002", "content": {"b"')
+    assert sorted(ImportJournal(filename).replay()) == ['a']
+    resumed = ImportJournal(filename)
+    resumed.append({'c': make_chunk(rng, 'C.')})
+    assert sorted(ImportJournal(filename).replay()) == ['a', 'c']
+
+
+def test_ignores_records_for_other_models(tmp_path, rng):
+    filename = str(tmp_path / 'out.json.journal')
+    with open(filename, 'w') as f:
+        f.write('{"embedding_model": "other:model", "content": {"x": {"text": "X."}}}\n')
+    journal = ImportJournal(filename)
+    chunk = make_chunk(rng, 'A.')
+    journal.append({'a': chunk})
+    chunks = ImportJournal(filename).replay()
+    assert sorted(chunks) == ['a']
+    assert chunks['a']['text'] == 'A.'
+    assert np.array_equal(ask_embeddings.vector_from_base64(chunks['a']['embedding']), chunk['embedding'])
@@ -0,0 +1,104 @@
+import os
+import threading
+
+import numpy as np
+
+import ask_embeddings
+from conftest import make_chunk
+
+
+def write_libraries(tmp_path, rng, count=3):
+    filenames = []
+    for file_index in range(count):
+        library = ask_embeddings.Library()
+        for i in range(5):
+            library.set_chunk(f'file-{file_index}-{i}', make_chunk(rng, f'Text {file_index} {i}.'))
+        filename = str(tmp_path / f'library-{file_index}.json')
+        library.save(filename)
+        filenames.append(filename)
+    return filenames
+
+
+def test_loads_files_in_processes_from_a_thread(tmp_path, rng):
+    filenames = write_libraries(tmp_path, rng)
+    results = []
+    # Like LibraryWatcher, which reloads libraries in a background thread.
+    thread = threading.Thread(target=lambda: results.extend(ask_embeddings._load_library_files(filenames, processes=2)))
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive()
+    for filename, library in zip(filenames, results):
+        expected = ask_embeddings.Library(filename=filename)
+        assert list(library.chunk_ids) == list(expected.chunk_ids)
+        for chunk_id, chunk in expected.chunks:
+            assert np.array_equal(library.chunk(chunk_id)['embedding'], chunk['embedding'])
+            assert library.chunk(chunk_id)['text'] == chunk['text']
+
+
+def test_merging_reports_collisions_and_keeps_the_last_chunk(tmp_path, rng, capsys):
+    filenames = write_libraries(tmp_path, rng, 2)
+    library = ask_embeddings.Library(filename=filenames[1])
+    library.set_chunk('file-0-0', make_chunk(rng, 'A replacement.'))
+    library.save(filenames[1])
+    merged = ask_embeddings.load_multiple_libraries(filenames)
+    assert len(merged.chunk_ids) == 10
+    assert merged.chunk('file-0-0')['text'] == 'A replacement.'
+    assert '1 chunk_ids in' in capsys.readouterr().out
+    # Only the file none of whose chunks were replaced can be reused.
+    assert sorted(merged._sources) == [filenames[1]]
+
+
+def test_watcher_reloads_changed_files(tmp_path, rng, monkeypatch):
+    monkeypatch.setattr(ask_embeddings, 'LIBRARY_DIR', str(tmp_path))
+    filenames = write_libraries(tmp_path, rng)
+    loaded = []
+    load_library_files = ask_embeddings._load_library_files
+
+    def record_load_library_files(library_file_names, processes=None):
+        loaded.append(list(library_file_names))
+        return load_library_files(library_file_names, processes)
+    monkeypatch.setattr(ask_embeddings, '_load_library_files', record_load_library_files)
+    prepared = []
+    watcher = ask_embeddings.LibraryWatcher(interval=0, prepare=prepared.append)
+    first, generation = watcher.current()
+    assert generation == 1
+    assert prepared == [first]
+    assert len(first.chunk_ids) == 15
+    assert not watcher.check()
+    assert watcher.current() == (first, 1)
+
+    library = ask_embeddings.Library(filename=filenames[1])
+    library.set_chunk('file-1-5', make_chunk(rng, 'A new chunk.'))
+    library.save(filenames[1])
+    assert watcher.check()
+    second, generation = watcher.current()
+    assert generation == 2
+    assert prepared == [first, second]
+    assert second.chunk('file-1-5')['text'] == 'A new chunk.'
+    # Only the changed file was loaded again.
+    assert loaded == [filenames, [filenames[1]]]
+    # A library that's already in use is never changed by a reload.
+    assert len(first.chunk_ids) == 15
+    assert len(second.chunk_ids) == 16
+    assert not watcher.check()
+
+    os.remove(filenames[0])
+    assert watcher.check()
+    assert watcher.generation == 3
+    assert sorted(watcher.library.chunk_ids) == sorted(chunk_id for chunk_id in second.chunk_ids if not chunk_id.startswith('file-0-'))
+
+
+def test_watcher_thread_reloads_in_the_background(tmp_path, rng):
+    filename = write_libraries(tmp_path, rng, 1)[0]
+    reloaded = threading.Event()
+    watcher = ask_embeddings.LibraryWatcher(filename, interval=0.01, on_reload=reloaded.set)
+    reloaded.clear()
+    watcher.start()
+    library = ask_embeddings.Library(filename=filename)
+    library.set_chunk('file-0-5', make_chunk(rng, 'A new chunk.'))
+    library.save(filename)
+    assert reloaded.wait(10)
+    # The thread can't be stopped, so just let it sleep.
+    watcher.interval = 3600
+    assert watcher.generation == 2
+    assert len(watcher.library.chunk_ids) == 6
@@ -0,0 +1,65 @@
+import threading
+from argparse import Namespace
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip('urllib3')
+
+from convert.og import OGCache, OGFetcher
+from convert.og_standin import OGHandler
+
+
+@pytest.fixture
+def standin():
+    """
+    Serves convert/og_standin.py's pages on a free port, returning its
+    server so that tests can change its args and count its requests.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), OGHandler)
+    server.args = Namespace(latency=0, body_bytes=1000, rate_limit_rate=0.0, retry_after=0,
+                            error_rate=0.0, empty_rate=0.0, verbose=False)
+    server.request_count = 0
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetches_og_data(standin):
+    og_data = OGFetcher(rate=100).get(f'{standin.url}/p/post')
+    assert og_data == {
+        'og:title': 'Title of /p/post',
+        'og:description': 'Description of /p/post',
+        'og:image': 'https://example.com/p/post.png'
+    }
+
+
+def test_follows_redirects(standin):
+    fetcher = OGFetcher(rate=100, max_retries=0)
+    assert fetcher.get(f'{standin.url}/moved/p/post')['og:title'] == 'Title of /p/post'
+    assert fetcher.get(f'{standin.url}/moved/moved/moved/moved/moved/moved/p/post') == {}
+
+
+def test_caches_and_revalidates(standin, tmp_path):
+    cache = OGCache(str(tmp_path / 'og.sqlite'))
+    urls = [f'{standin.url}/p/{i}' for i in range(6)]
+    results = list(OGFetcher(rate=100, cache=cache).get_many(urls))
+    assert [og_data['og:title'] for og_data in results] == [f'Title of /p/{i}' for i in range(6)]
+    assert standin.request_count == 6
+    assert list(OGFetcher(rate=100, cache=cache).get_many(urls)) == results
+    assert standin.request_count == 6
+    # Every page is unchanged, so revalidating them only gets 304s back.
+    standin.args.body_bytes = 0
+    standin.args.empty_rate = 1.0
+    assert list(OGFetcher(rate=100, cache=cache, max_age=0).get_many(urls)) == results
+    assert standin.request_count == 12
+
+
+def test_gives_up_after_max_retries(standin, monkeypatch):
+    monkeypatch.setattr('convert.og.OG_RETRY_BASE_SECONDS', 0.01)
+    standin.args.error_rate = 1.0
+    assert OGFetcher(rate=100, max_retries=2).get(f'{standin.url}/p/post') == {}
+    assert standin.request_count == 3
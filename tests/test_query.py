@@ -0,0 +1,144 @@
+import numpy as np
+import pytest
+
+import ask_embeddings
+from conftest import EMBEDDING_LENGTH, make_chunk
+
+
+def query(library, query_embedding, **kwargs):
+    return library.query(version=ask_embeddings.CURRENT_VERSION,
+                         query_embedding=ask_embeddings.base64_from_vector(query_embedding),
+                         query_embedding_model=ask_embeddings.EMBEDDINGS_MODEL_ID,
+                         count_type='chunk', **kwargs)
+
+
+@pytest.mark.parametrize('quantization', [None, 'float16', 'int8'])
+@pytest.mark.parametrize('visible_access_tags', [None, set(), {'private'}, {'private', 'other'}])
+def test_candidates_are_the_visible_rows(library, rng, quantization, visible_access_tags):
+    library.quantization = quantization
+    query_embedding = rng.normal(size=library._embeddings.shape[1]).astype(np.float32)
+    rows, scores = library._candidate_scores(query_embedding, visible_access_tags=visible_access_tags)
+    visible = set([None]) | set(visible_access_tags or ())
+    expected_rows = [row for row, chunk_id in enumerate(library._embedding_ids)
+                     if library.chunk(chunk_id).get('access_tag') in visible]
+    assert sorted(rows.tolist()) == expected_rows
+    assert np.allclose(scores, library._score_rows(query_embedding, slice(0, library._embedding_count))[rows])
+
+
+def test_query_only_returns_visible_chunks(library):
+    query_embedding = library.chunk('chunk-3')['embedding']
+    result = query(library, query_embedding, count=20)
+    assert 'chunk-3' not in result.chunk_ids
+    assert len(result.chunk_ids) == 13
+    for search in ['exact', 'approximate']:
+        result = query(library, query_embedding, count=1, search=search)
+        assert all(library.chunk(chunk_id).get('access_tag') is None for chunk_id in result.chunk_ids)
+
+
+def test_quantized_query_finds_the_same_chunks(library, rng):
+    query_embedding = library.chunk('chunk-4')['embedding'] + rng.normal(scale=0.01, size=library._embeddings.shape[1])
+    expected = list(query(library, query_embedding, count=5).chunk_ids)
+    for quantization in sorted(ask_embeddings.LEGAL_QUANTIZATIONS):
+        library.quantization = quantization
+        assert list(query(library, query_embedding, count=5).chunk_ids) == expected
+
+
+@pytest.mark.parametrize('quantization', sorted(ask_embeddings.LEGAL_QUANTIZATIONS))
+@pytest.mark.parametrize('sort', ['similarity', 'random'])
+def test_quantized_min_similarity_uses_exact_scores(rng, quantization, sort):
+    # Embeddings clustered around a few topics, like real ones, so that many
+    # chunks have similar scores near the cutoff.
+    topics = rng.normal(size=(5, EMBEDDING_LENGTH))
+    library = ask_embeddings.Library()
+    for i in range(3000):
+        embedding = (topics[i % 5] + rng.normal(scale=1.5, size=EMBEDDING_LENGTH)).astype(np.float32)
+        library.set_chunk(f'chunk-{i}', {'text': f'Chunk {i}.', 'token_count': 2, 'info': {'url': 'https://example.com'},
+                                         'embedding': embedding / np.linalg.norm(embedding)})
+    library.quantization = quantization
+    for _ in range(20):
+        query_embedding = library.chunk(f'chunk-{rng.integers(3000)}')['embedding'] + rng.normal(scale=0.03, size=EMBEDDING_LENGTH)
+        query_embedding = (query_embedding / np.linalg.norm(query_embedding)).astype(np.float32)
+        exact = library._embeddings[:library._embedding_count] @ query_embedding
+        min_similarity = float(np.sort(exact)[-20])
+        expected = set(library._embedding_ids[row] for row in np.flatnonzero(exact >= min_similarity))
+        result = query(library, query_embedding, count=100, sort=sort, min_similarity=min_similarity)
+        assert set(result.chunk_ids) == expected
+
+
+@pytest.mark.parametrize('chunks_per_file', [3, 100])
+def test_restricted_rows_are_never_scored(rng, monkeypatch, chunks_per_file):
+    # Like a.json, access/private/b.json and z.json merged, so the public rows
+    # are on both sides of the private ones.
+    library = ask_embeddings.Library()
+    for prefix, access_tag in [('a', None), ('b', 'private'), ('z', None)]:
+        other = ask_embeddings.Library()
+        for i in range(chunks_per_file):
+            other.set_chunk(f'{prefix}-{i}', make_chunk(rng, f'Text {prefix} {i}.', access_tag))
+        library.extend(other)
+    scored = []
+    score_rows = library._score_rows
+
+    def record_score_rows(query_embedding, rows):
+        scored.extend(range(rows.start, rows.stop) if isinstance(rows, slice) else rows.tolist())
+        return score_rows(query_embedding, rows)
+    monkeypatch.setattr(library, '_score_rows', record_score_rows)
+    query_embedding = rng.normal(size=EMBEDDING_LENGTH).astype(np.float32)
+    rows, _ = library._candidate_scores(query_embedding)
+    public_rows = [library._embedding_rows[chunk_id] for chunk_id in library.chunk_ids if chunk_id[0] != 'b']
+    assert sorted(scored) == sorted(rows.tolist()) == sorted(public_rows)
+
+
+@pytest.mark.parametrize('nprobe', [0, -1, 1.5, '2', True])
+def test_rejects_bad_nprobe(library, rng, nprobe):
+    with pytest.raises(Exception, match='nprobe'):
+        query(library, rng.normal(size=EMBEDDING_LENGTH), count=5, search='approximate', nprobe=nprobe)
+
+
+def test_nprobe_limits_approximate_candidates(library, rng):
+    query_embedding = rng.normal(size=EMBEDDING_LENGTH).astype(np.float32)
+    index = library.approximate_index
+    one_list = index.candidate_rows(query_embedding, 1)
+    assert 0 < len(one_list) < len(index.candidate_rows(query_embedding, index.list_count)) == 20
+
+
+def split_similarities(result):
+    """
+    Returns a serialized query result without its similarities, and the
+    similarities. Scoring a batch of queries as a matrix rounds differently
+    than scoring them one at a time, so those only match approximately.
+    """
+    content = {chunk_id: {field: value for field, value in chunk.items() if field != 'similarity'}
+               for chunk_id, chunk in result['content'].items()}
+    similarities = [chunk.get('similarity', 0) for chunk in result['content'].values()]
+    return dict(result, content=content), similarities
+
+
+@pytest.mark.parametrize('quantization', [None, 'int8'])
+def test_query_batch_matches_sequential_queries(library, rng, monkeypatch, quantization):
+    # Smaller blocks, so that the batch is scored in several of them.
+    monkeypatch.setattr(ask_embeddings, 'QUERY_BATCH_SIZE', 3)
+    library.quantization = quantization
+    queries = []
+    for i in range(8):
+        query_embedding = rng.normal(size=EMBEDDING_LENGTH).astype(np.float32)
+        query_embedding = ask_embeddings.base64_from_vector(query_embedding / np.linalg.norm(query_embedding))
+        queries += [
+            {'query_embedding': query_embedding, 'count': 5},
+            {'query_embedding': query_embedding, 'count': 100, 'count_type': 'token', 'omit': 'embedding,similarity'},
+            {'query_embedding': query_embedding, 'count': 20, 'min_similarity': 0.0},
+            {'query_embedding': query_embedding, 'count': 3, 'sort': 'random', 'seed': i + 1},
+            {'query_embedding': query_embedding, 'count': 5, 'search': 'approximate', 'nprobe': 2},
+        ]
+    for query in queries:
+        query.setdefault('query_embedding_model', ask_embeddings.EMBEDDINGS_MODEL_ID)
+        query.setdefault('count_type', 'chunk')
+    expected = [split_similarities(library.query_serializable(version=ask_embeddings.CURRENT_VERSION, **query))
+                for query in queries]
+    batches = [library.query_batch_serializable(queries, version=ask_embeddings.CURRENT_VERSION),
+               [result.serializable() for result in library.query_batch(queries, version=ask_embeddings.CURRENT_VERSION)]]
+    for batch in batches:
+        assert len(batch) == len(queries)
+        for result, (expected_result, expected_similarities) in zip(batch, expected):
+            result, similarities = split_similarities(result)
+            assert result == expected_result
+            assert np.allclose(similarities, expected_similarities, atol=1e-5)
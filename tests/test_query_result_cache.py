@@ -0,0 +1,58 @@
+import ask_embeddings
+from ask_embeddings import QueryResultCache
+
+
+def test_evicts_least_recently_used():
+    cache = QueryResultCache(max_bytes=30)
+    cache.put('a', b'x' * 10)
+    cache.put('b', b'x' * 10)
+    cache.put('c', b'x' * 10)
+    assert cache.get('a') == b'x' * 10
+    cache.put('d', b'x' * 10)
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.get('c') is not None
+    assert cache.get('d') is not None
+    assert cache.stats() == {'entries': 3, 'bytes': 30, 'hits': 4, 'misses': 1, 'evictions': 1}
+
+
+def test_replacing_an_entry_counts_its_bytes_once():
+    cache = QueryResultCache(max_bytes=30)
+    cache.put('a', b'x' * 10)
+    cache.put('a', b'y' * 20)
+    assert cache.nbytes == 20
+    assert cache.get('a') == b'y' * 20
+
+
+def test_skips_values_larger_than_the_cache():
+    cache = QueryResultCache(max_bytes=10)
+    cache.put('a', b'x' * 5)
+    cache.put('b', b'x' * 11)
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+
+
+def test_expires_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ask_embeddings, 'monotonic', lambda: now[0])
+    cache = QueryResultCache(max_bytes=100, max_age=60)
+    cache.put('a', b'x')
+    now[0] += 30
+    cache.put('b', b'x')
+    assert cache.get('a') is not None
+    now[0] += 31
+    assert cache.get('a') is None
+    assert cache.get('b') is not None
+    # Entries that are never asked for again are swept by later puts.
+    now[0] += 61
+    cache.put('c', b'x')
+    assert cache.stats()['entries'] == 1
+
+
+def test_key_ignores_access_token_but_not_access():
+    permitted = (frozenset(['private']), False, None)
+    key = QueryResultCache.key(permitted, query_embedding='q', count=5)
+    assert key == QueryResultCache.key(permitted, count=5, query_embedding='q')
+    assert key != QueryResultCache.key((frozenset(), False, None), query_embedding='q', count=5)
+    assert QueryResultCache.key(permitted, sort='random') is None
+    assert QueryResultCache.key(permitted, sort='random', seed=1) is not None
@@ -0,0 +1,46 @@
+import io
+import json
+
+import pytest
+
+import ask_embeddings
+
+
+def expected_json(library, indent):
+    separators = (',', ':') if indent is None else None
+    return json.dumps(library.serializable(), indent=indent, separators=separators)
+
+
+def streamed_json(library, indent):
+    f = io.StringIO()
+    library._write_json(f, indent)
+    return f.getvalue()
+
+
+@pytest.mark.parametrize('indent', ['\t', 2, '', None])
+def test_streamed_json_matches_json_dump(library, indent):
+    library.set_chunk('unicode', {'text': 'Café “quoted”\nand a new line \U0001F600', 'token_count': 9,
+                                  'info': {'url': 'https://example.com/café', 'title': 'Nested', 'tags': [1, [2, {}], []]}})
+    library._details = {'counts': {'chunks': 21}, 'message': 'Tab\tand "quotes"'}
+    assert streamed_json(library, indent) == expected_json(library, indent)
+    library.omit = 'embedding'
+    assert streamed_json(library, indent) == expected_json(library, indent)
+
+
+@pytest.mark.parametrize('indent', ['\t', None])
+def test_streamed_json_of_empty_libraries(indent):
+    library = ask_embeddings.Library()
+    assert streamed_json(library, indent) == expected_json(library, indent)
+    library._data = {}
+    assert streamed_json(library, indent) == '{}'
+
+
+def test_save_writes_the_same_bytes_without_caching_embeddings(library, tmp_path):
+    filename = str(tmp_path / 'library.json')
+    library.save(filename)
+    with open(filename) as f:
+        assert f.read() == expected_json(ask_embeddings.Library(filename=filename), '\t')
+    library._base64_embeddings.clear()
+    library.save(filename)
+    assert not library._base64_embeddings
+    assert list(tmp_path.iterdir()) == [tmp_path / 'library.json']
@@ -0,0 +1,64 @@
+import importlib
+import os
+
+import pytest
+
+import ask_embeddings
+
+pytest.importorskip('flask')
+pytest.importorskip('flask_compress')
+
+SAMPLE_LIBRARY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sample-content.json')
+
+
+@pytest.fixture(scope='module')
+def server():
+    environ = dict(os.environ)
+    os.environ.update(LIBRARY_FILENAME=SAMPLE_LIBRARY, COMPILED_LIBRARY_FILENAME='', LIBRARY_RELOAD_INTERVAL='0',
+                      EMBEDDING_QUANTIZATION='')
+    try:
+        import host.server
+        yield importlib.reload(host.server)
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+
+
+@pytest.fixture
+def client(server):
+    server.result_cache.clear()
+    return server.app.test_client()
+
+
+def query_form(**fields):
+    library = ask_embeddings.Library(filename=SAMPLE_LIBRARY)
+    chunk_id = next(iter(library.chunk_ids))
+    form = {
+        'version': str(ask_embeddings.CURRENT_VERSION),
+        'query_embedding': ask_embeddings.base64_from_vector(library.chunk(chunk_id)['embedding']).decode('ascii'),
+        'query_embedding_model': ask_embeddings.EMBEDDINGS_MODEL_ID,
+        'count': '3',
+        'count_type': 'chunk'
+    }
+    form.update(fields)
+    return form
+
+
+def test_query(client):
+    response = client.post('/', data=query_form()).get_json()
+    assert 'error' not in response
+    assert len(response['content']) == 3
+
+
+@pytest.mark.parametrize('fields', [{'min_similarity': 'high'}, {'min_similarity': ''},
+                                    {'search': 'approximate', 'nprobe': 'many'}, {'search': 'approximate', 'nprobe': '0'}])
+def test_rejects_bad_numbers(client, server, fields):
+    response = client.post('/', data=query_form(**fields)).get_json()
+    assert list(fields)[-1] in response['error']
+    assert server.result_cache.stats()['entries'] == 0
+
+
+def test_min_similarity(client):
+    response = client.post('/', data=query_form(min_similarity='0.99', count='10')).get_json()
+    assert 'error' not in response
+    assert all(chunk['similarity'] >= 0.99 for chunk in response['content'].values())
@@ -0,0 +1,77 @@
+import os
+import runpy
+import sys
+
+import ask_embeddings
+from convert.embedding_standin import embedding_for
+from convert.sources import source_entry, unchanged_entry
+
+
+def test_unchanged_entry(tmp_path):
+    filename = str(tmp_path / 'post.html')
+    with open(filename, 'w') as f:
+        f.write('<p>A post.</p>')
+    entry = source_entry(filename, ['a', 'b'])
+    assert entry['sha256'] == ask_embeddings.file_sha256(filename)
+    assert unchanged_entry(entry, filename) is entry
+    # Only touched, so the content hash is checked and matches.
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    touched = unchanged_entry(entry, filename)
+    assert touched == dict(entry, mtime_ns=stat.st_mtime_ns + 10**9)
+    # Edited without changing its size.
+    with open(filename, 'w') as f:
+        f.write('<p>A pest.</p>')
+    assert unchanged_entry(touched, filename) is None
+    assert unchanged_entry(None, filename) is None
+
+
+def write_post(export, slug, paragraphs):
+    filename = os.path.join(export, 'posts', f'2023-01-01_Post-{slug}.html')
+    body = ''.join(f'<p>{paragraph}</p>' for paragraph in paragraphs)
+    with open(filename, 'w') as f:
+        f.write(f'<html><body><h1 class="p-name">Post {slug}</h1>'
+                f'<section class="e-content">{body}</section>'
+                f'<a class="p-canonical" href="https://medium.com/p/{slug}">Link</a></body></html>')
+    return filename
+
+
+def paragraph(slug, index):
+    return f'Paragraph {index} of post {slug}, which is long enough for the Medium importer to keep.'
+
+
+def test_incremental_import_deletes_chunks_of_removed_files(tmp_path, monkeypatch):
+    # Runs convert.main on a Medium export, with stand-in embeddings and
+    # token counts so that it needs neither the API nor GPT-2's tokenizer.
+    fetched = []
+
+    def fetch_embeddings(self, texts, token_counts=None):
+        fetched.extend(texts)
+        return [embedding_for(text) for text in texts]
+    monkeypatch.setattr(ask_embeddings.EmbeddingClient, '_fetch_embeddings', fetch_embeddings)
+    monkeypatch.setattr(ask_embeddings, 'get_token_counts', lambda texts: [len(text.split()) for text in texts])
+    monkeypatch.chdir(tmp_path)
+    export = str(tmp_path / 'export')
+    os.makedirs(os.path.join(export, 'posts'))
+    kept = write_post(export, 'a', [paragraph('a', 0), paragraph('a', 1)])
+    removed = write_post(export, 'b', [paragraph('b', 0)])
+    edited = write_post(export, 'c', [paragraph('c', 0), paragraph('c', 1)])
+    output = os.path.join(ask_embeddings.LIBRARY_DIR, 'medium.json')
+
+    def run_import():
+        monkeypatch.setattr(sys, 'argv', ['convert.main', export, '--importer', 'medium', '--output', 'medium.json',
+                                          '--embedding-cache', ''])
+        runpy.run_module('convert.main', run_name='__main__')
+        return ask_embeddings.Library(filename=output)
+
+    library = run_import()
+    assert sorted(library.chunk_ids) == ['a_0', 'a_1', 'b_0', 'c_0', 'c_1']
+    assert len(library.import_manifest) == 3
+    os.remove(removed)
+    write_post(export, 'c', [paragraph('c', 0)])
+    fetched.clear()
+    library = run_import()
+    assert sorted(library.chunk_ids) == ['a_0', 'a_1', 'c_0']
+    assert sorted(library.import_manifest) == sorted(os.path.relpath(filename, export) for filename in [kept, edited])
+    # Nothing that was already embedded was embedded again.
+    assert fetched == []